@@ -0,0 +1,92 @@
+"""
+Creates sessions from many concurrent threads, and reports how many virtual
+TNs were allocated per second, and how many allocations collided, with the
+atomic VirtualTN.claim against reading the next available virtual TN and
+then reserving it.
+
+    python -m benchmarks.bench_allocation [virtual TNs] [threads] [policy]
+"""
+import sys
+import threading
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.database import db_session
+from sms_proxy.models import VirtualTN, ProxySession
+
+
+def read_then_reserve(policy):
+    session = ProxySession(None, '12223334444', '12223335555')
+    virtual_tn = VirtualTN.get_next_available()
+    if virtual_tn is None:
+        return None
+    virtual_tn.session_id = session.id
+    session.virtual_TN = virtual_tn.value
+    db_session.add(session)
+    db_session.add(virtual_tn)
+    db_session.commit()
+    return virtual_tn.value
+
+
+def claim(policy):
+    session = ProxySession(None, '12223334444', '12223335555')
+    session.virtual_TN = VirtualTN.claim(session.id, policy=policy)
+    if session.virtual_TN is None:
+        db_session.rollback()
+        return None
+    db_session.add(session)
+    db_session.commit()
+    return session.virtual_TN
+
+
+def run(allocate, pool_size, threads, policy):
+    VirtualTN.query.delete()
+    ProxySession.query.delete()
+    for i in range(pool_size):
+        db_session.add(VirtualTN(str(10000000000 + i)))
+    db_session.commit()
+    counts = {'allocated': 0, 'collisions': 0}
+    lock = threading.Lock()
+
+    def creator():
+        while True:
+            try:
+                value = allocate(policy)
+            except (IntegrityError, OperationalError):
+                db_session.rollback()
+                outcome = 'collisions'
+            else:
+                if value is None:
+                    break
+                outcome = 'allocated'
+            finally:
+                db_session.remove()
+            with lock:
+                counts[outcome] += 1
+    workers = [threading.Thread(target=creator) for i in range(threads)]
+    with Timer() as timer:
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    sessions = ProxySession.query.count()
+    reserved = VirtualTN.query.filter(VirtualTN.session_id != None).count()
+    # Each session must hold its own virtual TN
+    assert sessions == reserved == counts['allocated']
+    return counts, timer.elapsed
+
+
+def main(pool_size=2000, threads=16, policy='first'):
+    engine, path = bind_temp_db()
+    for name, allocate in (('read_then_reserve', read_then_reserve),
+                           ('claim', claim)):
+        counts, elapsed = run(allocate, int(pool_size), int(threads), policy)
+        print("{:<18} {:>6} allocated  {:>6} collisions  {:9.1f} "
+              "allocations/s".format(name, counts['allocated'],
+                                     counts['collisions'],
+                                     counts['allocated'] / elapsed))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,45 @@
+"""
+Reports how many virtual TNs per second are provisioned, and removed, one
+per transaction, as POST and DELETE /tn do, against the batched
+transactions of POST and DELETE /tn/bulk.
+
+    python -m benchmarks.bench_bulk [virtual TNs]
+"""
+import sys
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.database import db_session
+from sms_proxy.models import VirtualTN
+
+
+def add_one_by_one(values):
+    for value in values:
+        db_session.add(VirtualTN(value))
+        db_session.commit()
+
+
+def remove_one_by_one(values):
+    for value in values:
+        db_session.delete(VirtualTN.query.filter_by(value=value).one())
+        db_session.commit()
+
+
+def main(count=5000):
+    count = int(count)
+    bind_temp_db()
+    values = [str(10000000000 + n) for n in range(count)]
+    for name, add, remove in (
+            ('single', add_one_by_one, remove_one_by_one),
+            ('bulk', VirtualTN.add_many, VirtualTN.remove_many)):
+        with Timer() as added:
+            add(values)
+        assert VirtualTN.query.count() == count
+        with Timer() as removed:
+            remove(values)
+        assert VirtualTN.query.count() == 0
+        print("{:<7} {:9.1f} added/s {:9.1f} removed/s".format(
+            name, count / added.elapsed, count / removed.elapsed))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,54 @@
+"""
+Measures the cost of expiring sessions, per 1k expired sessions, with the
+set based ProxySession.clean_expired against terminating each session one
+at a time.
+
+    python -m benchmarks.bench_expiry [number of sessions]
+"""
+import sys
+from datetime import datetime
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.database import db_session
+from sms_proxy.models import VirtualTN, ProxySession
+
+
+def populate(count):
+    VirtualTN.query.delete()
+    ProxySession.query.delete()
+    now = datetime.utcnow()
+    for i in range(count):
+        virtual_tn = VirtualTN(str(10000000000 + i))
+        session = ProxySession(virtual_tn.value, '12223334444', '12223335555')
+        session.expiry_date = now
+        virtual_tn.session_id = session.id
+        db_session.add(virtual_tn)
+        db_session.add(session)
+    db_session.commit()
+
+
+def per_row():
+    expired = db_session.query(ProxySession.id).filter(
+        ProxySession.expiry_date <= datetime.utcnow()).all()
+    for session_id, in expired:
+        ProxySession.terminate(session_id)
+
+
+def bulk():
+    ProxySession.clean_expired()
+
+
+def main(count=10000):
+    bind_temp_db()
+    for name, expire in (('per_row', per_row), ('bulk', bulk)):
+        populate(count)
+        with Timer() as timer:
+            expire()
+        assert ProxySession.query.count() == 0
+        assert VirtualTN.query.filter_by(session_id=None).count() == count
+        print("{:<8} {:>6} sessions  {:8.3f}s total  {:8.2f}ms per 1k".format(
+            name, count, timer.elapsed, timer.elapsed * 1000000.0 / count))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,77 @@
+"""
+Reports the peak memory used to list every virtual TN by building the whole
+listing and serializing it at once, against streaming it with
+'GET /tn?stream=ndjson', for pools of increasing size. The streamed peak
+only grows as far as SQLite's page cache and memory map, which are bounded
+by SQLITE_CACHE_SIZE and SQLITE_MMAP_SIZE.
+
+    python -m benchmarks.bench_export [largest pool size]
+"""
+import os
+import resource
+import sys
+import tempfile
+from multiprocessing import Process, Queue
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of this process, in MiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def buffered(queue):
+    import simplejson as json
+    from sms_proxy.api import tn_to_dict
+    from sms_proxy.models import VirtualTN
+    before = peak_rss()
+    body = json.dumps({"virtual_tns": [tn_to_dict(row) for row
+                                       in VirtualTN.listing().all()]})
+    queue.put((len(body), peak_rss() - before))
+
+
+def streamed(queue):
+    from sms_proxy.api import app
+    client = app.test_client()
+    before = peak_rss()
+    response = client.get('/tn?stream=ndjson', buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    queue.put((size, peak_rss() - before))
+
+
+def measure(export):
+    # Each export runs in its own process, so that its peak memory is not
+    # hidden by the peak of an earlier run
+    queue = Queue()
+    process = Process(target=export, args=(queue,))
+    process.start()
+    result = queue.get(timeout=600)
+    process.join()
+    return result
+
+
+def main(largest=200000):
+    largest = int(largest)
+    path = os.path.join(tempfile.mkdtemp(prefix='sms_proxy_bench'),
+                        'bench.db')
+    # Point the application at the benchmark database before it is imported
+    os.environ['DATABASE_URL'] = 'sqlite:///{}'.format(path)
+    os.environ['TEST_DATABASE_URL'] = os.environ['DATABASE_URL']
+    from sms_proxy.database import engine, init_db
+    from sms_proxy.models import VirtualTN
+    init_db()
+    pool_size = 0
+    for size in (largest // 100, largest // 10, largest):
+        engine.execute(VirtualTN.__table__.insert(), [
+            {'value': str(10000000000 + n), 'session_id': None}
+            for n in range(pool_size, size)])
+        pool_size = size
+        for name, export in (('buffered', buffered), ('streamed', streamed)):
+            length, rss = measure(export)
+            print("{:>8} TNs {:<8} {:7.1f} MiB peak {:>11} bytes".format(
+                size, name, rss, length))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,69 @@
+"""
+Reports the time recording a message event adds to the request path,
+inserting and committing each event as it happens, against buffering
+events in a MessageLog whose background thread writes them in batches,
+and how long each takes until every event is written.
+
+    python -m benchmarks.bench_history [events] [batch size]
+"""
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.database import db_session
+from sms_proxy.history import MessageLog
+from sms_proxy.models import MessageEvent
+
+
+def event(n):
+    return ('inbound', 'received', '12223334444', '13334445555',
+            'message {}'.format(n), 'session-{}'.format(n % 100))
+
+
+def per_message(count, batch_size):
+    latencies = []
+    with Timer() as total:
+        for n in range(count):
+            start = time.time()
+            direction, status, from_number, to_number, body, session_id = (
+                event(n))
+            db_session.add(MessageEvent(
+                session_id=session_id, tenant_id='default',
+                direction=direction, status=status, from_number=from_number,
+                to_number=to_number, body=body,
+                created_at=datetime.utcnow()))
+            db_session.commit()
+            latencies.append(time.time() - start)
+    return latencies, total.elapsed
+
+
+def buffered(count, batch_size):
+    history = MessageLog(enabled=True, buffer_size=count,
+                         batch_size=batch_size)
+    latencies = []
+    with Timer() as total:
+        for n in range(count):
+            start = time.time()
+            history.record(*event(n))
+            latencies.append(time.time() - start)
+        history.flush()
+    return latencies, total.elapsed
+
+
+def main(count=5000, batch_size=500):
+    count, batch_size = int(count), int(batch_size)
+    for name, run in (('per-message', per_message), ('buffered', buffered)):
+        bind_temp_db()
+        latencies, elapsed = run(count, batch_size)
+        db_session.remove()
+        assert MessageEvent.query.count() == count
+        latencies.sort()
+        print("{:<12} {:8.1f} us mean {:8.1f} us p99 {:6.2f}s until "
+              "written".format(name, sum(latencies) * 1e6 / count,
+                               latencies[int(count * 0.99)] * 1e6, elapsed))
+        db_session.remove()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
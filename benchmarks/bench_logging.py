@@ -0,0 +1,79 @@
+"""
+Reports the time a log call adds to the calling thread, writing JSON
+records straight to the stream as the service used to, against handing
+them to the background writer of the QueueHandler. The stream is either a
+file, or one that is slow to write to, as stdout is when the log collector
+falls behind.
+
+    python -m benchmarks.bench_logging [records] [slow write ms]
+"""
+import logging
+import sys
+import tempfile
+import time
+
+from pythonjsonlogger import jsonlogger
+
+from benchmarks.common import Timer
+from sms_proxy.log import QueueHandler
+
+
+class SlowStream(object):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def sync_handler(stream):
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(jsonlogger.JsonFormatter())
+    return handler
+
+
+def queue_handler(stream):
+    return QueueHandler(stream, jsonlogger.JsonFormatter())
+
+
+def run(make_handler, stream, count):
+    handler = make_handler(stream)
+    logger = logging.getLogger('bench_logging_{}'.format(id(handler)))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    latencies = []
+    with Timer() as total:
+        for n in range(count):
+            start = time.time()
+            logger.info({"message": "Message sent to 12223334444 for "
+                         "session {}".format(n),
+                         "status": "succeeded"})
+            latencies.append(time.time() - start)
+        handler.close()
+    latencies.sort()
+    return (sum(latencies) / count, latencies[int(count * 0.99)],
+            total.elapsed)
+
+
+def main(count=20000, slow_ms=1):
+    count, slow_ms = int(count), float(slow_ms)
+    streams = (('file', lambda: tempfile.TemporaryFile(mode='w+')),
+               ('slow', lambda: SlowStream(slow_ms / 1000)))
+    for stream_name, make_stream in streams:
+        # Fewer records to a slow stream, as writing them one at a time
+        # would take count * slow_ms
+        n = count if stream_name == 'file' else count // 20
+        for name, make_handler in (('sync', sync_handler),
+                                   ('queue', queue_handler)):
+            mean, p99, elapsed = run(make_handler, make_stream(), n)
+            print("{:<5} {:<6} {:8.1f} us mean {:8.1f} us p99 "
+                  "{:6.2f}s until written".format(
+                      stream_name, name, mean * 1e6, p99 * 1e6, elapsed))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
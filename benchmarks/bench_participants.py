@@ -0,0 +1,67 @@
+"""
+Reports the time to list the sessions a phone number takes part in, and to
+count its active sessions as starting a session under a participant limit
+does, filtering the session table on either participant column, against
+reading the participant's range of the session_participant table.
+
+    python -m benchmarks.bench_participants [sessions] [lookups]
+"""
+import random
+import sys
+from datetime import datetime
+
+from sqlalchemy import or_, func
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.database import db_session
+from sms_proxy.models import ProxySession, SessionParticipant
+
+PARTICIPANTS = 10000
+PAGE = 20
+
+
+def populate(sessions):
+    for n in range(sessions):
+        session = ProxySession(
+            str(10000000000 + n), str(12000000000 + n % PARTICIPANTS),
+            str(12000000000 + random.randrange(PARTICIPANTS)),
+            random.choice([None, 60]))
+        db_session.add(session)
+        db_session.add_all(SessionParticipant.of(session))
+        if n % 5000 == 4999:
+            db_session.commit()
+    db_session.commit()
+
+
+def scanned(participant):
+    ProxySession.page(PAGE, participant=participant, tenant_id='default')
+    db_session.query(func.count(ProxySession.id)).filter(
+        or_(ProxySession.participant_a == participant,
+            ProxySession.participant_b == participant),
+        ProxySession.tenant_id == 'default',
+        or_(ProxySession.expiry_date.is_(None),
+            ProxySession.expiry_date > datetime.utcnow())).scalar()
+
+
+def mapped(participant):
+    SessionParticipant.sessions(participant, 'default', PAGE)
+    SessionParticipant.count_active([participant], 'default')
+
+
+def main(sessions=100000, lookups=2000):
+    sessions, lookups = int(sessions), int(lookups)
+    bind_temp_db()
+    populate(sessions)
+    participants = [str(12000000000 + random.randrange(PARTICIPANTS))
+                    for _ in range(lookups)]
+    for name, lookup in (('scanned', scanned), ('mapped', mapped)):
+        with Timer() as timer:
+            for participant in participants:
+                lookup(participant)
+                db_session.remove()
+        print("{:<8} {:8.1f} us per participant lookup".format(
+            name, timer.elapsed * 1e6 / lookups))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,49 @@
+"""
+Reports the time to claim a virtual TN from one pool, as the number of
+virtual TNs in the other pools grows, for each allocation policy.
+
+    python -m benchmarks.bench_pools [claims] [pools]
+"""
+import sys
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.database import db_session
+from sms_proxy.models import VirtualTN
+
+TOTALS = (10000, 100000, 400000)
+
+
+def populate(total, pools):
+    # Every pool holds total / pools virtual TNs, numbered so that the pools
+    # are interleaved in the table
+    values = [str(10000000000 + n) for n in range(total)]
+    for pool in range(pools):
+        VirtualTN.add_many(values[pool::pools], batch_size=5000,
+                           pool='pool-{}'.format(pool))
+
+
+def claim(count, policy, pool):
+    with Timer() as timer:
+        for n in range(count):
+            value = VirtualTN.claim('session-{}'.format(n), policy,
+                                    pools=[pool])
+            assert value is not None
+            db_session.commit()
+    return timer.elapsed
+
+
+def main(claims=500, pools=10):
+    claims, pools = int(claims), int(pools)
+    for total in TOTALS:
+        bind_temp_db()
+        populate(total, pools)
+        for policy in ('first', 'lru', 'random'):
+            VirtualTN.query.update({VirtualTN.session_id: None})
+            db_session.commit()
+            elapsed = claim(claims, policy, 'pool-{}'.format(pools // 2))
+            print("{:>7} virtual TNs  {:<7} {:8.1f} us per claim".format(
+                total, policy, elapsed * 1e6 / claims))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
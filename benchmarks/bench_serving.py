@@ -0,0 +1,79 @@
+"""
+Load tests the inbound webhook under gunicorn, with sync workers as
+'entry serve' runs it, against gevent workers as 'entry serve-async' runs
+it. Flowroute's API is stubbed, taking 'upstream delay' seconds to accept
+each message. Reports the sustained webhooks per second, and their p50 and
+p99 latencies, with 'clients' webhooks in flight at a time.
+
+    python -m benchmarks.bench_serving [seconds] [clients] [upstream delay]
+"""
+import logging
+import random
+import sys
+
+import simplejson as json
+
+from benchmarks.common import bind_temp_db, GunicornServer, run_load
+from benchmarks.stub_upstream import StubUpstream
+from sms_proxy.database import db_session
+from sms_proxy.log import log
+from sms_proxy.models import VirtualTN, ProxySession
+
+WORKERS = 4
+SESSIONS = 100
+
+SCENARIOS = (
+    ('sync', ['-w', str(WORKERS)], {}),
+    ('gevent', ['-w', str(WORKERS), '-k', 'gevent',
+                '--worker-connections', '1000'],
+     {'DISPATCH_POOL_SIZE': '100', 'TRANSPORT_POOL_SIZE': '100'}),
+)
+
+
+def populate(count):
+    sessions = []
+    for i in range(count):
+        virtual_tn = VirtualTN(str(10000000000 + i))
+        session = ProxySession(virtual_tn.value, str(12220000000 + i),
+                               str(13330000000 + i))
+        virtual_tn.session_id = session.id
+        db_session.add(virtual_tn)
+        db_session.add(session)
+        sessions.append((session.virtual_TN, session.participant_a))
+    db_session.commit()
+    return sessions
+
+
+def inbound(url, sessions):
+    def request(http):
+        virtual_tn, participant = random.choice(sessions)
+        body = json.dumps({'to': virtual_tn, 'from': participant,
+                           'body': 'hello'})
+        return http.post(url + '/', data=body,
+                         headers={'content-type': 'application/json'})
+    return request
+
+
+def main(seconds=10, clients=64, delay=0.05):
+    seconds, clients, delay = float(seconds), int(clients), float(delay)
+    # Keep the load generator's connection logging out of the results
+    log.setLevel(logging.WARNING)
+    engine, path = bind_temp_db()
+    sessions = populate(SESSIONS)
+    db_session.remove()
+    upstream = StubUpstream(delay=delay).start()
+    for name, args, env in SCENARIOS:
+        upstream.messages = 0
+        with GunicornServer(path, upstream.url, args, env) as server:
+            result = run_load(inbound(server.url, sessions), seconds,
+                              clients)
+        print("{:<7} {:8.1f} webhooks/s  {:7.1f} ms p50  {:7.1f} ms p99  "
+              "{:>6} sent  {} errors".format(
+                  name, result['rate'], result['p50_ms'], result['p99_ms'],
+                  upstream.messages, result['errors']))
+    upstream.shutdown()
+    upstream.server_close()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,94 @@
+"""
+Runs writer processes, creating and ending sessions, alongside reader
+processes, looking up session routes, against one SQLite database. Reports
+the throughput and "database is locked" errors with SQLite's default
+PRAGMAs and with the PRAGMAs from settings.
+
+    python -m benchmarks.bench_sqlite [writers] [readers] [seconds]
+"""
+import multiprocessing
+import sys
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import bind_db, bind_temp_db
+from sms_proxy.database import db_session, SQLITE_PRAGMAS
+from sms_proxy.models import VirtualTN, ProxySession
+
+POOL_SIZE = 1000
+
+
+def writer(path, pragmas, seconds, results):
+    bind_db(path, pragmas)
+    ops = errors = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            session = ProxySession(None, '12223334444', '12223335555')
+            session.virtual_TN = VirtualTN.claim(session.id)
+            db_session.add(session)
+            db_session.commit()
+            ProxySession.terminate(session.id)
+            ops += 1
+        except OperationalError:
+            db_session.rollback()
+            errors += 1
+        finally:
+            db_session.remove()
+    results.put(('write', ops, errors))
+
+
+def reader(path, pragmas, seconds, results):
+    bind_db(path, pragmas)
+    ops = errors = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            ProxySession.load_route(str(10000000000 + ops % POOL_SIZE))
+            ops += 1
+        except OperationalError:
+            errors += 1
+        finally:
+            db_session.remove()
+    results.put(('read', ops, errors))
+
+
+def run(pragmas, writers, readers, seconds):
+    engine, path = bind_temp_db(pragmas)
+    for i in range(POOL_SIZE):
+        db_session.add(VirtualTN(str(10000000000 + i)))
+    db_session.commit()
+    db_session.remove()
+    engine.dispose()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=writer,
+                                         args=(path, pragmas, seconds, results))
+                 for i in range(writers)]
+    processes += [multiprocessing.Process(target=reader,
+                                          args=(path, pragmas, seconds, results))
+                  for i in range(readers)]
+    for process in processes:
+        process.start()
+    totals = {'write': [0, 0], 'read': [0, 0]}
+    for process in processes:
+        kind, ops, errors = results.get(timeout=seconds + 60)
+        totals[kind][0] += ops
+        totals[kind][1] += errors
+    for process in processes:
+        process.join()
+    return totals
+
+
+def main(writers=4, readers=4, seconds=5):
+    writers, readers, seconds = int(writers), int(readers), float(seconds)
+    for name, pragmas in (('default', []), ('tuned', SQLITE_PRAGMAS)):
+        totals = run(pragmas, writers, readers, seconds)
+        print("{:<8} {:9.1f} writes/s {:9.1f} reads/s  {:>5} locked "
+              "errors".format(name, totals['write'][0] / seconds,
+                              totals['read'][0] / seconds,
+                              totals['write'][1] + totals['read'][1]))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
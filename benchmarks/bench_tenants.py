@@ -0,0 +1,70 @@
+"""
+Reports the time to find the tenant, and the messaging controller, of an
+inbound message's virtual TN, reading them from the database for every
+message, against through the tenant caches of the TenantRegistry.
+
+    python -m benchmarks.bench_tenants [lookups] [tenants]
+"""
+import random
+import sys
+
+from benchmarks.common import bind_temp_db, Timer
+from sms_proxy.cache import tenant_cache, tn_tenant_cache
+from sms_proxy.database import db_session
+from sms_proxy.models import Tenant, VirtualTN
+from sms_proxy.tenants import TenantConfig, TenantRegistry
+
+TNS_PER_TENANT = 100
+
+
+class NullController(object):
+    def __init__(self, username, password):
+        pass
+
+
+def populate(tenants):
+    values = []
+    for n in range(tenants):
+        tenant = Tenant('tenant-{}'.format(n))
+        tenant.flowroute_access_key = 'key-{}'.format(n)
+        tenant.flowroute_secret_key = 'secret'
+        db_session.add(tenant)
+        tenant_values = [str(10000000000 + n * TNS_PER_TENANT + i)
+                         for i in range(TNS_PER_TENANT)]
+        VirtualTN.add_many(tenant_values, tenant_id=tenant.id)
+        values.extend(tenant_values)
+    db_session.commit()
+    return values
+
+
+def uncached(registry, value):
+    tenant_id = db_session.query(VirtualTN.tenant_id).filter_by(
+        value=value).scalar()
+    tenant = TenantConfig.from_tenant(db_session.query(Tenant).get(tenant_id))
+    # The controller was created per message before tenants were cached
+    return registry.create_controller(username=tenant.access_key,
+                                      password=tenant.secret_key)
+
+
+def cached(registry, value):
+    return registry.controller(registry.for_virtual_tn(value))
+
+
+def main(lookups=20000, tenants=20):
+    lookups, tenants = int(lookups), int(tenants)
+    bind_temp_db()
+    values = populate(tenants)
+    registry = TenantRegistry(create_controller=NullController)
+    for name, lookup in (('uncached', uncached), ('cached', cached)):
+        tenant_cache.clear()
+        tn_tenant_cache.clear()
+        with Timer() as timer:
+            for n in range(lookups):
+                lookup(registry, random.choice(values))
+                db_session.remove()
+        print("{:<9} {:8.1f} us per inbound message".format(
+            name, timer.elapsed * 1e6 / lookups))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,59 @@
+"""
+Measures messages per second sent to a local stub of Flowroute's API by the
+pooled transport, against opening a new connection for every message.
+
+    python -m benchmarks.bench_transport [number of messages] [threads]
+"""
+import sys
+import threading
+
+from FlowrouteMessagingLib.Models.Message import Message
+
+from benchmarks.common import Timer
+from benchmarks.stub_upstream import StubUpstream
+from sms_proxy.transport import PooledMessagingController
+
+
+def send(get_controller, count, threads):
+    def worker(n):
+        for i in range(n):
+            get_controller().create_message(
+                Message(to='12223334444', from_='13334445555',
+                        content='hello'))
+    workers = [threading.Thread(target=worker, args=(count // threads,))
+               for i in range(threads)]
+    with Timer() as timer:
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    return timer.elapsed
+
+
+def main(count=2000, threads=4):
+    server = StubUpstream().start()
+    pooled = PooledMessagingController('user', 'pass', base_uri=server.url,
+                                       pool_size=threads)
+    def unpooled():
+        controller = PooledMessagingController('user', 'pass',
+                                               base_uri=server.url)
+        # Close the connection once the message has been sent
+        controller.session.headers['connection'] = 'close'
+        return controller
+    scenarios = (
+        ('unpooled', unpooled),
+        ('pooled', lambda: pooled),
+    )
+    for name, get_controller in scenarios:
+        server.messages = server.connections = 0
+        elapsed = send(get_controller, count, threads)
+        print("{:<9} {:>6} messages  {:>5} connections  {:9.1f} msg/s".format(
+            name, server.messages, server.connections,
+            server.messages / elapsed))
+    pooled.close()
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
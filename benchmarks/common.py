@@ -0,0 +1,161 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from sms_proxy import migrations
+from sms_proxy.database import db_session, create_db_engine, SQLITE_PRAGMAS
+
+
+def bind_db(path, sqlite_pragmas=SQLITE_PRAGMAS):
+    """
+    Points the scoped db_session at the SQLite database at 'path', creating
+    or upgrading its schema. Returns the engine.
+    """
+    engine = create_db_engine('sqlite:///{}'.format(path), sqlite_pragmas)
+    db_session.remove()
+    db_session.configure(bind=engine)
+    migrations.upgrade(engine)
+    return engine
+
+
+def bind_temp_db(sqlite_pragmas=SQLITE_PRAGMAS):
+    """
+    Points the scoped db_session at a fresh SQLite database in a temporary
+    directory, so that benchmarks never touch the test or production
+    databases. Returns the engine and the path of the database file.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='sms_proxy_bench'),
+                        'bench.db')
+    return bind_db(path, sqlite_pragmas), path
+
+
+class Timer(object):
+    """
+    Context manager recording the wall clock time of its block in 'elapsed'.
+    """
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class GunicornServer(object):
+    """
+    Runs the service under gunicorn, in production mode against the SQLite
+    database at 'path', sending messages to the stub of Flowroute's API at
+    'upstream_url'. 'args' are passed to gunicorn, and 'env' added to its
+    environment. Started and stopped as a context manager.
+    """
+    def __init__(self, path, upstream_url, args=('-w', '4'), env=None):
+        self.path = path
+        self.upstream_url = upstream_url
+        self.args = list(args)
+        self.env = env or {}
+        self.url = None
+        self.process = None
+
+    def start(self):
+        port = free_port()
+        env = dict(os.environ, DEBUG_MODE='false',
+                   DATABASE_URL='sqlite:///{}'.format(self.path),
+                   FLOWROUTE_API_URL=self.upstream_url,
+                   FLOWROUTE_ACCESS_KEY='user', FLOWROUTE_SECRET_KEY='pass',
+                   LOG_LEVEL='40')
+        env.update(self.env)
+        env.pop('prometheus_multiproc_dir', None)
+        gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+        self.process = subprocess.Popen(
+            [gunicorn, '-c', 'python:sms_proxy.gunicorn_conf',
+             '-b', '127.0.0.1:{}'.format(port), '--log-level', 'warning'] +
+            self.args + ['sms_proxy.api:app'], env=env)
+        self.url = 'http://127.0.0.1:{}'.format(port)
+        for attempt in range(100):
+            try:
+                requests.get(self.url + '/outbox')
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("gunicorn did not start on {}".format(self.url))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Returns the count, rate, p50 and p99 latency, in milliseconds, and
+    error count of operations that took 'latencies' seconds each, over
+    'elapsed' seconds.
+    """
+    latencies = sorted(latencies)
+    return OrderedDict([
+        ('count', len(latencies)),
+        ('rate', len(latencies) / elapsed if elapsed else 0.0),
+        ('p50_ms', percentile(latencies, 0.5) * 1000),
+        ('p99_ms', percentile(latencies, 0.99) * 1000),
+        ('errors', errors)])
+
+
+def run_load(request, seconds, clients):
+    """
+    Calls 'request(http)' repeatedly from 'clients' threads for 'seconds'
+    seconds, each thread with its own requests.Session, and returns the
+    summary of the calls. A call fails if it raises, or returns a response
+    with an error status.
+    """
+    latencies = []
+    errors = []
+    deadline = time.time() + seconds
+
+    def client():
+        http = requests.Session()
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                resp = request(http)
+            except Exception as e:
+                errors.append(e)
+                continue
+            latencies.append(time.time() - start)
+            if resp is not None and resp.status_code >= 400:
+                errors.append(resp.status_code)
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return summarize(latencies, len(errors), timer.elapsed)
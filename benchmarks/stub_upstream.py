@@ -0,0 +1,90 @@
+"""
+A stub of Flowroute's messaging API, accepting POST /messages over HTTP/1.1
+keep-alive connections, optionally taking 'delay' seconds to respond to
+each message, as the real API does, and rejecting an 'error_rate' fraction
+of them with a 500.
+
+    python -m benchmarks.stub_upstream [port] [delay] [error rate]
+"""
+import random
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Responses are written in several small writes, which Nagle's algorithm
+    # would otherwise hold back on a keep-alive connection
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        self.rfile.read(length)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if random.random() < self.server.error_rate:
+            self.server.record(error=True)
+            body = b'{"errors": [{"detail": "Injected error"}]}'
+            self.send_response(500)
+        else:
+            self.server.record()
+            body = b'{"data": {"id": "mdr1-stub"}}'
+            self.send_response(202)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstream(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves StubHandler on a background thread, counting the messages it
+    accepts, the errors it injects, and the connections it receives.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0, error_rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           StubHandler)
+        self.delay = delay
+        self.error_rate = error_rate
+        self.messages = 0
+        self.errors = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def record(self, error=False):
+        with self._lock:
+            if error:
+                self.errors += 1
+            else:
+                self.messages += 1
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    server = StubUpstream(*[parse(arg) for parse, arg
+                            in zip((int, float, float), sys.argv[1:])])
+    print("Serving stub messaging API on {}".format(server.url))
+    server.serve_forever()
@@ -0,0 +1,250 @@
+"""
+Runs the benchmark scenarios against the service under gunicorn, with a
+stub of Flowroute's API that takes 'upstream delay' seconds to respond and
+rejects an 'upstream error rate' fraction of messages. Reports, for each
+scenario, the operations per second and their p50 and p99 latencies, and
+writes them as JSON with --output, so that the results of two releases can
+be compared with --baseline.
+
+    python -m benchmarks.suite [scenario ...] [--seconds 10] [--clients 32]
+        [--worker-class sync] [--upstream-delay 0.05]
+        [--upstream-error-rate 0] [--output results.json]
+        [--baseline results.json]
+
+Scenarios:
+    inbound_storm   Inbound webhooks to active sessions
+    session_churn   Sessions created, then deleted, from a pool of TNs
+    expiry_sweep    The reaper expiring a large table of expired sessions
+    listing_pages   GET /tn, a page at a time, over a large pool
+    listing_stream  GET /tn?stream=ndjson over a large pool
+"""
+import argparse
+import logging
+import random
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import simplejson as json
+
+from benchmarks import bench_expiry
+from benchmarks.bench_serving import populate, inbound
+from benchmarks.common import (bind_temp_db, GunicornServer, run_load,
+                               summarize)
+from benchmarks.stub_upstream import StubUpstream
+from sms_proxy.database import db_session
+from sms_proxy.log import log
+from sms_proxy.models import VirtualTN, ProxySession
+
+JSON_HEADERS = {'content-type': 'application/json'}
+
+WORKER_CLASSES = {
+    'sync': (['-w', '4'], {}),
+    'gevent': (['-w', '4', '-k', 'gevent', '--worker-connections', '1000'],
+               {'DISPATCH_POOL_SIZE': '100', 'TRANSPORT_POOL_SIZE': '100'}),
+}
+
+
+def serve(path, upstream, options):
+    args, env = WORKER_CLASSES[options.worker_class]
+    return GunicornServer(path, upstream.url, args, env)
+
+
+def inbound_storm(options, upstream):
+    engine, path = bind_temp_db()
+    sessions = populate(options.sessions)
+    db_session.remove()
+    with serve(path, upstream, options) as server:
+        return 'webhooks', run_load(inbound(server.url, sessions),
+                                    options.seconds, options.clients)
+
+
+def session_churn(options, upstream):
+    engine, path = bind_temp_db()
+    # Enough virtual TNs that every client always finds one free
+    VirtualTN.add_many([str(10000000000 + n)
+                        for n in range(options.clients * 2)])
+    db_session.remove()
+    with serve(path, upstream, options) as server:
+        def request(http):
+            n = random.randint(0, 9999999)
+            resp = http.post(server.url + '/session', headers=JSON_HEADERS,
+                             data=json.dumps({
+                                 'participant_a': str(12220000000 + n),
+                                 'participant_b': str(13330000000 + n)}))
+            if resp.status_code != 200:
+                return resp
+            return http.delete(server.url + '/session', headers=JSON_HEADERS,
+                               data=json.dumps({
+                                   'session_id': resp.json()['session_id']}))
+        return 'sessions', run_load(request, options.seconds,
+                                    options.clients)
+
+
+def expiry_sweep(options, upstream):
+    bind_temp_db()
+    bench_expiry.populate(options.rows)
+    latencies = []
+    swept = 0
+    start = time.time()
+    while True:
+        batch_start = time.time()
+        expired = ProxySession.clean_expired(limit=options.batch_size)
+        latencies.append(time.time() - batch_start)
+        db_session.remove()
+        swept += len(expired)
+        if len(expired) < options.batch_size:
+            break
+    elapsed = time.time() - start
+    assert swept == options.rows
+    # The rate is of sessions, the latencies are of each batch
+    result = summarize(latencies, 0, elapsed)
+    result['count'] = swept
+    result['rate'] = swept / elapsed
+    return 'sessions', result
+
+
+def populate_pool(count):
+    engine, path = bind_temp_db()
+    VirtualTN.add_many([str(10000000000 + n) for n in range(count)])
+    db_session.remove()
+    return path
+
+
+def listing_pages(options, upstream):
+    path = populate_pool(options.rows)
+    with serve(path, upstream, options) as server:
+        def request(http):
+            # Each request reads the page after a random virtual TN, as a
+            # client walking the pool would
+            after = 10000000000 + random.randint(0, options.rows)
+            return http.get(server.url + '/tn', params={
+                'limit': options.page_size, 'after': str(after)})
+        return 'pages', run_load(request, options.seconds, options.clients)
+
+
+def listing_stream(options, upstream):
+    path = populate_pool(options.rows)
+    with serve(path, upstream, options) as server:
+        def request(http):
+            resp = http.get(server.url + '/tn',
+                            params={'stream': 'ndjson'}, stream=True)
+            lines = sum(1 for line in resp.iter_lines() if line)
+            assert lines == options.rows, lines
+            return resp
+        return 'listings', run_load(request, options.seconds,
+                                    max(1, options.clients // 8))
+
+
+SCENARIOS = OrderedDict([
+    ('inbound_storm', inbound_storm),
+    ('session_churn', session_churn),
+    ('expiry_sweep', expiry_sweep),
+    ('listing_pages', listing_pages),
+    ('listing_stream', listing_stream),
+])
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline):
+    """
+    Returns the change, as a percentage, of the rate and p99 latency of a
+    scenario against the same scenario in a baseline run.
+    """
+    def change(key):
+        if not baseline.get(key):
+            return None
+        return (result[key] - baseline[key]) * 100.0 / baseline[key]
+    return change('rate'), change('p99_ms')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the service against a stub upstream")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        default=list(SCENARIOS),
+                        help=', '.join(SCENARIOS))
+    parser.add_argument('--seconds', type=float, default=10,
+                        help="How long to load each scenario for")
+    parser.add_argument('--clients', type=int, default=32,
+                        help="The number of concurrent clients")
+    parser.add_argument('--worker-class', choices=sorted(WORKER_CLASSES),
+                        default='sync')
+    parser.add_argument('--upstream-delay', type=float, default=0.05,
+                        help="Seconds the stub upstream takes per message")
+    parser.add_argument('--upstream-error-rate', type=float, default=0,
+                        help="The fraction of messages the stub rejects")
+    parser.add_argument('--sessions', type=int, default=100,
+                        help="Active sessions for inbound_storm")
+    parser.add_argument('--rows', type=int, default=50000,
+                        help="Rows for expiry_sweep and the listings")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Sessions expired per batch by expiry_sweep")
+    parser.add_argument('--page-size', type=int, default=100,
+                        help="Virtual TNs per page for listing_pages")
+    parser.add_argument('--output', help="Write the results as JSON here")
+    parser.add_argument('--baseline',
+                        help="Compare against the JSON results of a "
+                             "previous run")
+    options = parser.parse_args(argv)
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("Unknown scenarios: {}".format(', '.join(unknown)))
+    return options
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    # Keep the load generator's connection logging out of the results
+    log.setLevel(logging.WARNING)
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+    upstream = StubUpstream(delay=options.upstream_delay,
+                            error_rate=options.upstream_error_rate).start()
+    results = OrderedDict()
+    try:
+        for name in options.scenarios:
+            upstream.messages = upstream.errors = 0
+            unit, result = SCENARIOS[name](options, upstream)
+            result['unit'] = unit
+            result['upstream_messages'] = upstream.messages
+            result['upstream_errors'] = upstream.errors
+            results[name] = result
+            rate = "{:.1f} {}/s".format(result['rate'], unit)
+            line = ("{:<15} {:>20} {:8.1f} ms p50 {:8.1f} ms p99 "
+                    "{:>6} errors".format(name, rate, result['p50_ms'],
+                                          result['p99_ms'], result['errors']))
+            if name in baseline:
+                rate, p99 = compare(result, baseline[name])
+                line += "  rate {:+.1f}% p99 {:+.1f}%".format(
+                    rate or 0, p99 or 0)
+            print(line)
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
+    if options.output:
+        report = OrderedDict([
+            ('revision', revision()),
+            ('created_at', datetime.utcnow().isoformat() + 'Z'),
+            ('options', OrderedDict(
+                (key, value) for key, value in sorted(vars(options).items())
+                if key not in ('output', 'baseline'))),
+            ('results', results)])
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
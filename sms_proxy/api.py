@@ -1,16 +1,31 @@
+import time
 import simplejson as json
+from collections import Counter, OrderedDict
+from datetime import datetime
 
-from flask import request, Response, jsonify
+from six import string_types, integer_types
+
+from flask import request, Response, jsonify, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from FlowrouteMessagingLib.Models.Message import Message
 
-from sms_proxy.settings import (ORG_NAME, SESSION_START_MSG, SESSION_END_MSG,
-                                NO_SESSION_MSG)
+from sms_proxy.settings import (OUTBOX_ENABLED, PAGE_SIZE, MAX_PAGE_SIZE,
+                                EXPORT_BATCH_SIZE, STATS_EXPIRY_WINDOW,
+                                BULK_MAX_ITEMS, SESSION_BATCH_MAX,
+                                RATE_LIMIT_MAX_DELAY, TN_POOL_FALLBACK,
+                                DEFAULT_TENANT, PARTICIPANT_MAX_SESSIONS)
+from sms_proxy.cache import routing_cache, stats_cache, tn_tenant_cache
 from sms_proxy.database import db_session
+from sms_proxy.dedup import inbound_key
+from sms_proxy.dispatch import DispatchResult
+from sms_proxy.history import event_to_dict
 from sms_proxy.log import log
-from sms_proxy.models import VirtualTN, ProxySession
+from sms_proxy.metrics import RATE_LIMITED, RATE_LIMIT_DELAY, export
+from sms_proxy.models import (VirtualTN, ProxySession, SessionParticipant,
+                              Tenant, MessageEvent, InboundMessage)
 from sms_proxy.app import create_app
 
 app = create_app()
@@ -34,38 +49,148 @@ class InternalSMSDispatcherError(Exception):
         return rv
 
 
-def send_message(recipients, virtual_tn, msg, session_id, is_system_msg=False):
+def rate_limit_delay(virtual_tn, count):
+    """
+    Returns how long, in seconds, to wait before sending 'count' messages
+    from 'virtual_tn' within the rate limits.
+    """
+    if not app.rate_limiter.enabled:
+        return 0
+    return app.rate_limiter.reserve(virtual_tn, count)
+
+
+def dispatch_paced(controller, messages):
+    """
+    Sends each (delay, message) pair once 'delay' seconds have passed,
+    sending the messages that are due at the same time concurrently, and
+    returns the outcome of all of them as a single DispatchResult
+    """
+    result = DispatchResult()
+    pending = sorted(messages, key=lambda pair: pair[0])
+    start = time.time()
+    while pending:
+        wait = pending[0][0] - (time.time() - start)
+        if wait > 0:
+            time.sleep(wait)
+        due_by = max(time.time() - start, pending[0][0])
+        due = [message for delay, message in pending if delay <= due_by]
+        pending = [pair for pair in pending if pair[0] > due_by]
+        # Allow each wave of concurrent sends the time of a single session
+        waves = -(-len(due) // app.dispatcher.max_workers)
+        sent = app.dispatcher.dispatch(
+            controller, due, timeout=app.dispatcher.timeout * max(waves, 1))
+        result.sent.extend(sent.sent)
+        result.failed.extend(sent.failed)
+    return result
+
+
+def tenant_controller(tenant):
+    """
+    Returns the messaging controller of the tenant's Flowroute account, or
+    the service's own if the tenant has none.
+    """
+    return app.tenants.controller(tenant) or app.sms_controller
+
+
+def system_message(tenant, msg):
+    """
+    Prefixes a system message with the tenant's org name for context.
+    """
+    return "[{}]: {}".format(tenant.org_name.upper(), msg)
+
+
+def record_dispatch(result, session_ids, tenant):
+    """
+    Records the messages of a DispatchResult in the history as sent or
+    failed. 'session_ids' maps the virtual TN of each message to the
+    session it was sent for.
+    """
+    for status, messages in (('sent', result.sent),
+                             ('failed', [m for m, e in result.failed])):
+        for message in messages:
+            app.history.record('outbound', status, message.mfrom, message.to,
+                               message.content, session_ids.get(message.mfrom),
+                               tenant.id)
+
+
+def send_message(recipients, virtual_tn, msg, session_id, is_system_msg=False,
+                 tenant=None):
     """
-    For each recipient, passes a Message to Flowroute's messaging controller.
-    The message will be sent from the 'virtual_tn' number. If this is a system
-    message, the message body will be prefixed with the org name for context.
-    If an exception is raised by the controller, an error is logged, and an
-    internal error is raised with the exception content.
+    Passes a Message for each recipient to the messaging controller of the
+    'tenant', or of the default tenant, sending to all recipients
+    concurrently. The message will be sent from the 'virtual_tn' number. If
+    this is a system message, the message body will be prefixed with the
+    tenant's org name for context. If the controller raises an exception
+    for any recipient, an error is logged, and an internal error is raised
+    with the exception content. A message held back by the rate limits for
+    longer than RATE_LIMIT_MAX_DELAY is queued in the outbox instead.
     """
+    tenant = tenant or app.tenants.get(DEFAULT_TENANT)
     if is_system_msg:
-        msg = "[{}]: {}".format(ORG_NAME.upper(), msg)
+        msg = system_message(tenant, msg)
+    delay = rate_limit_delay(virtual_tn, len(recipients))
+    if delay > RATE_LIMIT_MAX_DELAY:
+        queue_message(recipients, virtual_tn, msg, session_id, delay=delay,
+                      tenant=tenant)
+        return
+    elif delay > 0:
+        RATE_LIMITED.labels('delayed').inc(len(recipients))
+        RATE_LIMIT_DELAY.observe(delay)
+        time.sleep(delay)
+    messages = [Message(to=recipient, from_=virtual_tn, content=msg)
+                for recipient in recipients]
+    result = app.dispatcher.dispatch(tenant_controller(tenant), messages)
+    record_dispatch(result, {virtual_tn: session_id}, tenant)
+    for message in result.sent:
+        log.info(
+            {"message": "Message sent to {} for session {}".format(
+             message.to, session_id),
+             "status": "succeeded"})
+    for message, e in result.failed:
+        log.critical({"message": "Raised an exception sending SMS",
+                      "status": "failed",
+                      "exc": e,
+                      "recipient": message.to,
+                      "strerr": vars(e).get('response_body', None)})
+    if not result.ok:
+        message, e = result.failed[0]
+        strerr = vars(e).get('response_body', None)
+        raise InternalSMSDispatcherError(
+            "An error occured when requesting against Flowroute's API.",
+            payload={"strerr": strerr,
+                     "failed_recipients": [m.to for m, _ in result.failed],
+                     "reason": "InternalSMSDispatcherError"})
+
+
+def queue_message(recipients, virtual_tn, msg, session_id,
+                  is_system_msg=False, delay=None, tenant=None):
+    """
+    Queues a message for each recipient in the outbox, to be sent from the
+    'virtual_tn' number by the outbox workers, with the credentials of the
+    'tenant', or of the default tenant. If this is a system message, the
+    message body will be prefixed with the tenant's org name for context.
+    The message is sent once it fits the rate limits, or after 'delay'
+    seconds if the sending has already been reserved.
+    """
+    tenant = tenant or app.tenants.get(DEFAULT_TENANT)
+    if is_system_msg:
+        msg = system_message(tenant, msg)
+    if delay is None:
+        delay = rate_limit_delay(virtual_tn, len(recipients))
+    if delay > 0:
+        RATE_LIMITED.labels('queued').inc(len(recipients))
+        RATE_LIMIT_DELAY.observe(delay)
+    app.outbox.enqueue(recipients, virtual_tn, msg, session_id, delay=delay,
+                       tenant_id=tenant.id)
     for recipient in recipients:
-        message = Message(
-            to=recipient,
-            from_=virtual_tn,
-            content=msg)
-        try:
-            app.sms_controller.create_message(message)
-        except Exception as e:
-            strerr = vars(e).get('response_body', None)
-            log.critical({"message": "Raised an exception sending SMS",
-                          "status": "failed",
-                          "exc": e,
-                          "strerr": vars(e).get('response_body', None)})
-            raise InternalSMSDispatcherError(
-                "An error occured when requesting against Flowroute's API.",
-                payload={"strerr": strerr,
-                         "reason": "InternalSMSDispatcherError"})
-        else:
-            log.info(
-                {"message": "Message sent to {} for session {}".format(
-                 recipient, session_id),
-                 "status": "succeeded"})
+        app.history.record('outbound', 'queued', virtual_tn, recipient, msg,
+                           session_id, tenant.id)
+    if app.outbox_workers.workers and not app.outbox_workers.started:
+        app.outbox_workers.start()
+    log.info(
+        {"message": "Message queued for {} for session {}".format(
+         ", ".join(recipients), session_id),
+         "status": "succeeded"})
 
 
 class InvalidAPIUsage(Exception):
@@ -84,11 +209,239 @@ class InvalidAPIUsage(Exception):
         return rv
 
 
+TENANT_HEADER = 'X-Tenant'
+
+
+def current_tenant():
+    """
+    Returns the TenantConfig of the tenant named by the X-Tenant header of
+    the request, or of the default tenant without one.
+    """
+    tenant_id = request.headers.get(TENANT_HEADER, DEFAULT_TENANT)
+    tenant = app.tenants.get(tenant_id)
+    if tenant is None:
+        raise InvalidAPIUsage(
+            "Tenant {} does not exist".format(tenant_id),
+            status_code=404,
+            payload={'reason': 'tenant not found'})
+    return tenant
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_date(date):
+    return date.strftime(DATE_FORMAT) if date else None
+
+
+def page_args():
+    """
+    Returns the 'limit' and 'after' cursor of a listing request. The cursor
+    is the key of the last item of the previous page.
+    """
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        assert 0 < limit <= MAX_PAGE_SIZE
+    except (AssertionError, ValueError):
+        raise InvalidAPIUsage(
+            "Optional argument: 'limit' (int, 1 to {})".format(MAX_PAGE_SIZE),
+            payload={'reason': 'invalidAPIUsage'})
+    return limit, request.args.get('after')
+
+
+def valid_pool(pool):
+    return isinstance(pool, string_types) and 0 < len(pool) <= 32
+
+
+POOL_USAGE = ("Optional arguments: 'pool' (str, or list of str, "
+              "length <= 32), 'fallback' ('any' or 'none')")
+
+
+def session_pools(pool=None, fallback=TN_POOL_FALLBACK):
+    """
+    Returns the pools to claim a session's virtual TN from, in order, given
+    the preferred 'pool', or list of pools, and whether to 'fallback' to
+    'any' other pool or 'none'. A pool of None stands for any pool. Raises
+    ValueError if either is invalid.
+    """
+    if pool is None:
+        pools = []
+    elif isinstance(pool, list):
+        pools = list(pool)
+    else:
+        pools = [pool]
+    if not all(valid_pool(p) for p in pools) or fallback not in ('any',
+                                                                  'none'):
+        raise ValueError(POOL_USAGE)
+    if not pools or fallback == 'any':
+        pools.append(None)
+    return pools
+
+
+def session_quota(tenant):
+    """
+    Returns how many more sessions the tenant may have active at once, or
+    None if its sessions are not limited. The tenant is locked until the
+    transaction ends, so that requests starting its sessions at once count
+    them one after another. Reclaiming expired sessions when the pool runs
+    out ends the transaction early, and SQLite does not lock rows, so a
+    tenant may then go over its quota by the sessions started at once.
+    """
+    if tenant.max_sessions is None:
+        return None
+    Tenant.lock(tenant.id)
+    return max(0, tenant.max_sessions - ProxySession.count_active(tenant.id))
+
+
+def quota_message(tenant):
+    return "Tenant {} may have at most {} active sessions".format(
+        tenant.id, tenant.max_sessions)
+
+
+def busy_participant(counts, participants):
+    """
+    Returns the first of the participants already taking part in as many
+    active sessions as PARTICIPANT_MAX_SESSIONS, given their 'counts', or
+    None if they may all start another
+    """
+    if PARTICIPANT_MAX_SESSIONS <= 0:
+        return None
+    for participant in participants:
+        if counts.get(participant, 0) >= PARTICIPANT_MAX_SESSIONS:
+            return participant
+    return None
+
+
+def participant_limit_message(participant):
+    return "{} may take part in at most {} active sessions".format(
+        participant, PARTICIPANT_MAX_SESSIONS)
+
+
+def next_cursor(rows, limit):
+    """
+    Returns the cursor of the page following 'rows', or None if it is the
+    last page. One row more than 'limit' is read to tell the two apart.
+    """
+    return rows[limit - 1][0] if len(rows) > limit else None
+
+
+def stream_format():
+    """
+    Returns the format a full listing is streamed in, 'ndjson' or 'json',
+    or None if the listing is paginated.
+    """
+    fmt = request.args.get('stream')
+    if fmt is not None and fmt not in ('ndjson', 'json'):
+        raise InvalidAPIUsage(
+            "Optional argument: 'stream' (ndjson or json)",
+            payload={'reason': 'invalidAPIUsage'})
+    return fmt
+
+
+def stream_rows(key, rows, to_dict, fmt):
+    """
+    Returns a Response streaming 'rows' while they are read from the
+    database, as newline delimited JSON objects, or as a JSON object
+    holding them in a 'key' array. Rows are serialized, and sent,
+    EXPORT_BATCH_SIZE at a time, so memory use does not grow with the
+    number of rows.
+    """
+    if fmt == 'ndjson':
+        head, tail = '', ''
+        content_type = 'application/x-ndjson'
+
+        def encode(n, row):
+            return json.dumps(to_dict(row)) + '\n'
+    else:
+        head, tail = '{{"{}": ['.format(key), ']}'
+        content_type = 'application/json'
+
+        def encode(n, row):
+            return (', ' if n else '') + json.dumps(to_dict(row))
+
+    def generate():
+        batch = [head]
+        for n, row in enumerate(rows):
+            batch.append(encode(n, row))
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                yield ''.join(batch)
+                batch = []
+        chunk = ''.join(batch) + tail
+        if chunk:
+            yield chunk
+    # Keep the request, and its database session, open while streaming
+    return Response(stream_with_context(generate()),
+                    content_type=content_type)
+
+
+def percent(part, whole):
+    return round(100.0 * part / whole, 2) if whole else 0.0
+
+
+def pool_stats(expiring_within=STATS_EXPIRY_WINDOW, tenant_id=None):
+    """
+    Returns the size and utilisation of the virtual TN pool, and the number
+    of sessions that have expired but not yet been removed, or will expire
+    in the next 'expiring_within' minutes, of the tenant if given, otherwise
+    of every tenant.
+    """
+    pools = {}
+    for pool, size, used in VirtualTN.pool_counts(tenant_id):
+        pools[pool] = {"pool_size": size,
+                       "available": size - used,
+                       "in_use": used,
+                       "in_use_percent": percent(used, size)}
+    pool_size = sum(pool['pool_size'] for pool in pools.values())
+    in_use = sum(pool['in_use'] for pool in pools.values())
+    expired, expiring = ProxySession.count_expiring(expiring_within,
+                                                    tenant_id=tenant_id)
+    return {"pool_size": pool_size,
+            "available": pool_size - in_use,
+            "in_use": in_use,
+            "in_use_percent": percent(in_use, pool_size),
+            "available_percent": percent(pool_size - in_use, pool_size),
+            "pools": pools,
+            "expired_sessions": expired,
+            "expiring_sessions": expiring,
+            "expiring_within": expiring_within}
+
+
+def cached_pool_stats(expiring_within=STATS_EXPIRY_WINDOW, tenant_id=None):
+    """
+    Returns the 'pool_stats', reusing those computed within the last
+    STATS_CACHE_TTL seconds.
+    """
+    key = (tenant_id, expiring_within)
+    stats = stats_cache.get(key)
+    if stats is None:
+        stats = pool_stats(expiring_within, tenant_id)
+        stats_cache.set(key, stats)
+    return stats
+
+
+def tn_to_dict(row):
+    value, session_id, pool = row
+    return {'value': value, 'session_id': session_id, 'pool': pool}
+
+
+def session_to_dict(row):
+    (session_id, date_created, virtual_tn, participant_a, participant_b,
+     expiry_date) = row
+    return {'id': session_id,
+            'date_created': format_date(date_created),
+            'virtual_tn': virtual_tn,
+            'participant_a': participant_a,
+            'participant_b': participant_b,
+            'expiry_date': format_date(expiry_date)}
+
+
 @app.route("/tn", methods=['POST'])
 def add_virtual_tn():
     """
-    The VirtualTN resource endpoint for adding VirtualTN's from the pool.
+    The VirtualTN resource endpoint for adding VirtualTN's to the pool of
+    the tenant.
     """
+    tenant = current_tenant()
     body = request.json
     try:
         value = str(body['value'])
@@ -98,7 +451,13 @@ def add_virtual_tn():
             "Required argument: 'value' (str, length <= 18)",
             payload={'reason':
                      'invalidAPIUsage'})
-    virtual_tn = VirtualTN(value)
+    pool = body.get('pool')
+    if pool is not None and not valid_pool(pool):
+        raise InvalidAPIUsage(
+            "Optional argument: 'pool' (str, length <= 32)",
+            payload={'reason': 'invalidAPIUsage'})
+    virtual_tn = VirtualTN(value, pool, tenant.id)
+    pool = virtual_tn.pool
     try:
         db_session.add(virtual_tn)
         db_session.commit()
@@ -114,31 +473,192 @@ def add_virtual_tn():
     return Response(
         json.dumps(
             {"message": "Successfully added TN to pool",
-             "value": value}),
+             "value": value,
+             "pool": pool}),
         content_type="application/json")
 
 
 @app.route("/tn", methods=['GET'])
 def list_virtual_tns():
     """
-    The VirtualTN resource endpoint for listing VirtualTN's from the pool.
+    The VirtualTN resource endpoint for listing VirtualTN's from the pool,
+    a page at a time, in order of value. Only free, or only reserved,
+    virtual TNs are listed with 'available=true', or 'available=false',
+    and only those of one pool with 'pool'. With 'stream=ndjson' or
+    'stream=json' every virtual TN is streamed instead. Only the virtual
+    TNs of the tenant are listed.
+    """
+    tenant = current_tenant()
+    available = request.args.get('available')
+    if available is not None:
+        if available.lower() not in ('true', 'false'):
+            raise InvalidAPIUsage(
+                "Optional argument: 'available' (true or false)",
+                payload={'reason': 'invalidAPIUsage'})
+        available = available.lower() == 'true'
+    pool = request.args.get('pool')
+    fmt = stream_format()
+    if fmt is not None:
+        return stream_rows(
+            "virtual_tns",
+            VirtualTN.export(after=request.args.get('after'),
+                             available=available, pool=pool,
+                             tenant_id=tenant.id),
+            tn_to_dict, fmt)
+    limit, after = page_args()
+    rows = VirtualTN.page(limit + 1, after=after, available=available,
+                          pool=pool, tenant_id=tenant.id)
+    res = {"virtual_tns": [tn_to_dict(row) for row in rows[:limit]],
+           "next": next_cursor(rows, limit)}
+    if after is None:
+        # Counting scans the whole pool, so only the first page does it
+        res.update(pool_stats(tenant_id=tenant.id))
+    return Response(json.dumps(res), content_type="application/json")
+
+
+# The longest 'expiring_within' window, a year in minutes, so the window
+# stays within the dates the database can compare against
+MAX_EXPIRY_WINDOW = 525600
+
+
+@app.route("/tn/stats", methods=['GET'])
+def virtual_tn_stats():
+    """
+    The VirtualTN resource endpoint for the size and utilisation of the
+    tenant's pool, and the number of its sessions expiring within
+    'expiring_within' minutes. The statistics are cached for
+    STATS_CACHE_TTL seconds.
+    """
+    tenant = current_tenant()
+    try:
+        expiring_within = int(request.args.get('expiring_within',
+                                               STATS_EXPIRY_WINDOW))
+        assert 0 <= expiring_within <= MAX_EXPIRY_WINDOW
+    except (AssertionError, ValueError):
+        raise InvalidAPIUsage(
+            "Optional argument: 'expiring_within' (int, 0 to {} "
+            "minutes)".format(MAX_EXPIRY_WINDOW),
+            payload={'reason': 'invalidAPIUsage'})
+    return Response(json.dumps(cached_pool_stats(expiring_within,
+                                                 tenant.id)),
+                    content_type="application/json")
+
+
+def bulk_values():
+    """
+    Returns an (item, value) tuple for each item of a bulk request, given
+    as a JSON array, as a JSON object with a 'values' array, or one per
+    line of a plain text body. The value is None if the item is not a
+    string or number of at most 18 characters.
+    """
+    if request.mimetype == 'application/json':
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            body = body.get('values')
+        if not isinstance(body, list):
+            raise InvalidAPIUsage(
+                "Required argument: 'values' (list of str, length <= 18)",
+                payload={'reason': 'invalidAPIUsage'})
+    else:
+        body = [line.strip() for line in
+                request.get_data(as_text=True).splitlines()]
+        body = [line for line in body if line]
+    if len(body) > BULK_MAX_ITEMS:
+        raise InvalidAPIUsage(
+            "At most {} virtual TNs per request".format(BULK_MAX_ITEMS),
+            status_code=413,
+            payload={'reason': 'invalidAPIUsage'})
+    items = []
+    for item in body:
+        value = None
+        if not isinstance(item, bool) and isinstance(
+                item, string_types + integer_types):
+            value = str(item)
+            if not 0 < len(value) <= 18:
+                value = None
+        items.append((item, value))
+    return items
+
+
+def bulk_pool():
+    """
+    Returns the pool the virtual TNs of a bulk request are added to, given
+    as a 'pool' query argument, or in a JSON object body, if any.
     """
-    virtual_tns = VirtualTN.query.all()
-    res = [{'value': tn.value, 'session_id': tn.session_id} for tn in virtual_tns]
-    available = len([tn.value for tn in virtual_tns if tn.session_id is None])
+    pool = request.args.get('pool')
+    if pool is None and request.mimetype == 'application/json':
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            pool = body.get('pool')
+    if pool is not None and not valid_pool(pool):
+        raise InvalidAPIUsage(
+            "Optional argument: 'pool' (str, length <= 32)",
+            payload={'reason': 'invalidAPIUsage'})
+    return pool
+
+
+def bulk_response(items, results):
+    """
+    Returns a Response with the result for each item of a bulk request,
+    'invalid' for items without a value, and the number of items per
+    result.
+    """
+    results = iter(results)
+    res = []
+    for item, value in items:
+        if value is None:
+            res.append({"value": item, "result": "invalid"})
+        else:
+            value, result = next(results)
+            res.append({"value": value, "result": result})
+    counts = Counter(r['result'] for r in res)
     return Response(
-        json.dumps({"virtual_tns": res,
-                    "pool_size": len(res),
-                    "available": available,
-                    "in_use": len(res) - available}),
+        json.dumps({"results": res, "counts": counts}),
         content_type="application/json")
 
 
+@app.route("/tn/bulk", methods=['POST'])
+def add_virtual_tns():
+    """
+    The VirtualTN resource endpoint for adding many VirtualTN's to the pool
+    in batched transactions, to the tenant's 'pool' given, if any. Reports
+    whether each one was added, already in the pool, or invalid.
+    """
+    tenant = current_tenant()
+    items = bulk_values()
+    pool = bulk_pool()
+    results = VirtualTN.add_many(
+        [value for _, value in items if value is not None], pool=pool,
+        tenant_id=tenant.id)
+    log.info({"message": "Added {} virtual TNs to the pool".format(
+        sum(1 for _, result in results if result == 'added'))})
+    return bulk_response(items, results)
+
+
+@app.route("/tn/bulk", methods=['DELETE'])
+def remove_virtual_tns():
+    """
+    The VirtualTN resource endpoint for removing many VirtualTN's from the
+    tenant's pool in batched transactions. Reports whether each one was
+    removed, is in use by an active session, was not found, or is invalid.
+    """
+    tenant = current_tenant()
+    items = bulk_values()
+    results = VirtualTN.remove_many(
+        [value for _, value in items if value is not None],
+        tenant_id=tenant.id)
+    log.info({"message": "Removed {} virtual TNs from the pool".format(
+        sum(1 for _, result in results if result == 'removed'))})
+    return bulk_response(items, results)
+
+
 @app.route("/tn", methods=['DELETE'])
 def remove_virtual_tn():
     """
-    The VirtualTN resource endpoint for removing VirtualTN's from the pool.
+    The VirtualTN resource endpoint for removing VirtualTN's from the pool
+    of the tenant.
     """
+    tenant = current_tenant()
     body = request.json
     try:
         value = str(body['value'])
@@ -148,7 +668,8 @@ def remove_virtual_tn():
             payload={'reason':
                      'invalidAPIUsage'})
     try:
-        virtualTN = VirtualTN.query.filter_by(value=value).one()
+        virtualTN = VirtualTN.query.filter_by(value=value,
+                                              tenant_id=tenant.id).one()
     except NoResultFound:
         msg = ("Could not delete virtual TN ({})"
                " because it does not exist").format(value)
@@ -160,14 +681,19 @@ def remove_virtual_tn():
             payload={'reason':
                      'virtual TN not found'})
     else:
-        # Release any VirtualTNs from expired ProxySessions
-        ProxySession.clean_expired()
         try:
             active_session = ProxySession.query.filter_by(
                 virtual_TN=virtualTN.value).one()
         except NoResultFound:
+            active_session = None
+        if active_session is not None and active_session.is_expired():
+            # The reaper has not gotten to this session yet, release it now
+            ProxySession.terminate(active_session.id)
+            active_session = None
+        if active_session is None:
             db_session.delete(virtualTN)
             db_session.commit()
+            tn_tenant_cache.invalidate(value)
         else:
             msg = ("Cannot delete the number. There is an active "
                    "ProxySession {} using that VirtualTN.".format(
@@ -190,8 +716,12 @@ def remove_virtual_tn():
 def add_proxy_session():
     """
     The ProxySession resource endpoint for adding a new ProxySession
-    to the pool.
+    to the pool. The virtual TN is claimed from the preferred 'pool', or
+    list of pools, falling back to any other pool unless 'fallback' is
+    'none'. Only virtual TNs of the tenant are claimed, and the session is
+    refused once the tenant has as many active sessions as it may.
     """
+    tenant = current_tenant()
     body = request.json
     try:
         participant_a = body['participant_a']
@@ -207,22 +737,45 @@ def add_proxy_session():
         expiry_window = body['expiry_window']
     else:
         expiry_window = None
-    # Release any VirtualTNs from expired ProxySessions back to the pool
-    ProxySession.clean_expired()
-    virtual_tn = VirtualTN.get_next_available()
+    try:
+        pools = session_pools(body.get('pool'),
+                              body.get('fallback', TN_POOL_FALLBACK))
+    except ValueError as e:
+        raise InvalidAPIUsage(str(e), payload={'reason': 'invalidAPIUsage'})
+    if session_quota(tenant) == 0:
+        raise InvalidAPIUsage(quota_message(tenant), status_code=429,
+                              payload={'reason': 'session quota exceeded'})
+    if PARTICIPANT_MAX_SESSIONS > 0:
+        busy = busy_participant(SessionParticipant.count_active(
+            [participant_a, participant_b], tenant.id),
+            [participant_a, participant_b])
+        if busy is not None:
+            raise InvalidAPIUsage(
+                participant_limit_message(busy), status_code=429,
+                payload={'reason': 'participant limit exceeded'})
+    session = ProxySession(None, participant_a, participant_b, expiry_window,
+                           tenant.id)
+    virtual_tn = VirtualTN.claim(session.id, pools=pools,
+                                 tenant_id=tenant.id)
     if virtual_tn is None:
+        # The pools are exhausted, reclaim a session of one of them the
+        # reaper has not expired yet, if there is one
+        if ProxySession.clean_expired(limit=1, tenant_id=tenant.id,
+                                      pools=pools):
+            virtual_tn = VirtualTN.claim(session.id, pools=pools,
+                                         tenant_id=tenant.id)
+    if virtual_tn is None:
+        db_session.rollback()
         msg = "Could not create a new session -- No virtual TNs available."
         log.critical({"message": msg, "status": "failed"})
         return Response(
             json.dumps({"message": msg, "status": "failed"}),
             content_type="application/json", status=400)
     else:
-        session = ProxySession(virtual_tn.value, participant_a,
-                               participant_b, expiry_window)
         try:
-            virtual_tn.session_id = session.id
+            session.virtual_TN = virtual_tn
             db_session.add(session)
-            db_session.add(virtual_tn)
+            db_session.add_all(SessionParticipant.of(session))
             db_session.commit()
         except IntegrityError:
             db_session.rollback()
@@ -231,20 +784,25 @@ def add_proxy_session():
             return Response(
                 json.dumps({"message": msg, "status": "failed"}),
                 content_type="application/json", status=500)
-        expiry_date = session.expiry_date.strftime('%Y-%m-%d %H:%M:%S') if session.expiry_date else None
+        routing_cache.invalidate(virtual_tn)
+        expiry_date = format_date(session.expiry_date)
+        pool = VirtualTN.pool_of(virtual_tn)
         recipients = [participant_a, participant_b]
         try:
             send_message(
                 recipients,
-                virtual_tn.value,
-                SESSION_START_MSG,
+                virtual_tn,
+                tenant.session_start_msg,
                 session.id,
-                is_system_msg=True)
+                is_system_msg=True,
+                tenant=tenant)
         except InternalSMSDispatcherError as e:
             db_session.delete(session)
-            virtual_tn.session_id = None
-            db_session.add(virtual_tn)
+            SessionParticipant.remove([session.id])
+            VirtualTN.query.filter_by(value=virtual_tn).update(
+                {VirtualTN.session_id: None}, synchronize_session=False)
             db_session.commit()
+            routing_cache.invalidate(virtual_tn)
             raise e
         msg = "ProxySession {} started with participants {} and {}".format(
             session.id,
@@ -257,39 +815,302 @@ def add_proxy_session():
                  "status": "succeeded",
                  "session_id": session.id,
                  "expiry_date": expiry_date,
-                 "virtual_tn": virtual_tn.value,
+                 "virtual_tn": virtual_tn,
+                 "pool": pool,
                  "participant_a": participant_a,
                  "participant_b": participant_b}),
             content_type="application/json")
 
 
+def claim_by_pools(sessions, tenant_id):
+    """
+    Claims a virtual TN of the tenant for each (index, session, pools)
+    tuple, claiming for the sessions that share the same pools together.
+    Returns the value claimed for each session, in order, or None.
+    """
+    groups = OrderedDict()
+    for _, session, pools in sessions:
+        groups.setdefault(tuple(pools), []).append(session.id)
+    claimed = {}
+    for pools, session_ids in groups.items():
+        claimed.update(zip(session_ids,
+                           VirtualTN.claim_many(session_ids,
+                                                pools=list(pools),
+                                                tenant_id=tenant_id)))
+    return [claimed[session.id] for _, session, _ in sessions]
+
+
+@app.route("/session/batch", methods=['POST'])
+def add_proxy_sessions():
+    """
+    The ProxySession resource endpoint for starting many ProxySessions at
+    once. Virtual TNs are claimed for every pair of participants in a
+    single transaction, and the start messages of all sessions are sent
+    concurrently, as the rate limits allow. Each pair is reported as
+    succeeded or failed, and only the sessions that failed are rolled
+    back. Each pair may give a 'pool' and 'fallback', as for a single
+    session, or take those of the request.
+    Pairs beyond the tenant's limit of active sessions, or with a
+    participant already in as many sessions as they may be, fail.
+    """
+    tenant = current_tenant()
+    body = request.json
+    pairs = body.get('sessions') if isinstance(body, dict) else body
+    defaults = body if isinstance(body, dict) else {}
+    if not isinstance(pairs, list):
+        raise InvalidAPIUsage(
+            ("Required argument: 'sessions' (list of 'participant_a' "
+             "(str, length <= 18), 'participant_b' (str, length <= 18), "
+             "and optional 'expiry_window')"),
+            payload={'reason': 'invalidAPIUsage'})
+    if len(pairs) > SESSION_BATCH_MAX:
+        raise InvalidAPIUsage(
+            "At most {} sessions per request".format(SESSION_BATCH_MAX),
+            status_code=413,
+            payload={'reason': 'invalidAPIUsage'})
+    results = [None] * len(pairs)
+    sessions = []
+    quota = session_quota(tenant)
+    counts = {}
+    if PARTICIPANT_MAX_SESSIONS > 0:
+        # Count the active sessions of every participant of the batch at
+        # once, and keep counting the sessions the batch starts
+        counts = SessionParticipant.count_active(set(
+            pair.get(participant) for pair in pairs
+            if isinstance(pair, dict)
+            for participant in ('participant_a', 'participant_b')
+            if isinstance(pair.get(participant), string_types)), tenant.id)
+    for i, pair in enumerate(pairs):
+        try:
+            participant_a = pair['participant_a']
+            participant_b = pair['participant_b']
+            assert len(participant_a) <= 18
+            assert len(participant_b) <= 18
+            session = ProxySession(None, participant_a, participant_b,
+                                   pair.get('expiry_window'), tenant.id)
+        except (AssertionError, KeyError, TypeError):
+            results[i] = {"status": "failed",
+                          "message": ("Required argument: 'participant_a' "
+                                      "(str, length <= 18), 'participant_b' "
+                                      "(str, length <= 18)"),
+                          "reason": "invalidAPIUsage"}
+            continue
+        try:
+            pools = session_pools(
+                pair.get('pool', defaults.get('pool')),
+                pair.get('fallback', defaults.get('fallback',
+                                                  TN_POOL_FALLBACK)))
+        except ValueError as e:
+            results[i] = {"status": "failed", "message": str(e),
+                          "reason": "invalidAPIUsage"}
+            continue
+        participants = set([participant_a, participant_b])
+        busy = busy_participant(counts, participants)
+        if busy is not None:
+            results[i] = {"status": "failed",
+                          "message": participant_limit_message(busy),
+                          "reason": "participant limit exceeded"}
+            continue
+        if quota is not None and len(sessions) >= quota:
+            results[i] = {"status": "failed",
+                          "message": quota_message(tenant),
+                          "reason": "session quota exceeded"}
+            continue
+        for participant in participants:
+            counts[participant] = counts.get(participant, 0) + 1
+        sessions.append((i, session, pools))
+    virtual_tns = claim_by_pools(sessions, tenant.id)
+    shortfall = virtual_tns.count(None)
+    if shortfall and ProxySession.count_expiring(0, tenant_id=tenant.id)[0]:
+        # The pools are exhausted, reclaim sessions the reaper has not
+        # expired yet from the pools of the sessions still without a
+        # virtual TN, and claim again
+        db_session.rollback()
+        missing = OrderedDict()
+        for (_, _, pools), virtual_tn in zip(sessions, virtual_tns):
+            if virtual_tn is None:
+                missing[tuple(pools)] = missing.get(tuple(pools), 0) + 1
+        for pools, count in missing.items():
+            ProxySession.clean_expired(limit=count, tenant_id=tenant.id,
+                                       pools=list(pools))
+        virtual_tns = claim_by_pools(sessions, tenant.id)
+    started = []
+    for (i, session, _), virtual_tn in zip(sessions, virtual_tns):
+        if virtual_tn is None:
+            results[i] = {"status": "failed",
+                          "message": "No virtual TNs available.",
+                          "reason": "no virtual TN"}
+            continue
+        session.virtual_TN = virtual_tn
+        db_session.add(session)
+        db_session.add_all(SessionParticipant.of(session))
+        # Keep plain values, rather than reloading every session once the
+        # transaction is committed
+        started.append((i, {"status": "succeeded",
+                            "session_id": session.id,
+                            "expiry_date": format_date(session.expiry_date),
+                            "virtual_tn": virtual_tn,
+                            "participant_a": session.participant_a,
+                            "participant_b": session.participant_b}))
+    try:
+        db_session.commit()
+    except IntegrityError:
+        db_session.rollback()
+        msg = "There were two sessions attempting to reserve the same virtual tn. Please retry."
+        log.error({"message": msg, "status": "failed"})
+        for i, res in started:
+            results[i] = {"status": "failed", "message": msg,
+                          "reason": "conflict"}
+        started = []
+    for i, res in started:
+        routing_cache.invalidate(res['virtual_tn'])
+    msg = system_message(tenant, tenant.session_start_msg)
+    messages = []
+    for i, res in started:
+        recipients = [res['participant_a'], res['participant_b']]
+        delay = rate_limit_delay(res['virtual_tn'], len(recipients))
+        if delay > RATE_LIMIT_MAX_DELAY:
+            queue_message(recipients, res['virtual_tn'], msg,
+                          res['session_id'], delay=delay, tenant=tenant)
+            continue
+        elif delay > 0:
+            RATE_LIMITED.labels('delayed').inc(len(recipients))
+            RATE_LIMIT_DELAY.observe(delay)
+        messages.extend((delay, Message(to=recipient,
+                                        from_=res['virtual_tn'],
+                                        content=msg))
+                        for recipient in recipients)
+    result = dispatch_paced(tenant_controller(tenant), messages)
+    record_dispatch(result, dict((res['virtual_tn'], res['session_id'])
+                                 for i, res in started), tenant)
+    failed = {}
+    for message, e in result.failed:
+        strerr = vars(e).get('response_body', None)
+        log.critical({"message": "Raised an exception sending SMS",
+                      "status": "failed",
+                      "exc": e,
+                      "recipient": message.to,
+                      "strerr": strerr})
+        failed[message.mfrom] = strerr
+    discarded = []
+    for i, res in started:
+        if res['virtual_tn'] in failed:
+            discarded.append(res['session_id'])
+            res = {"status": "failed",
+                   "message": ("An error occured when requesting against "
+                               "Flowroute's API."),
+                   "strerr": failed[res['virtual_tn']],
+                   "reason": "InternalSMSDispatcherError"}
+        results[i] = res
+    if discarded:
+        ProxySession.discard(discarded)
+        for virtual_tn in failed:
+            routing_cache.invalidate(virtual_tn)
+    counts = Counter(res['status'] for res in results)
+    log.info({"message": "Started {} of {} sessions".format(
+        counts['succeeded'], len(results)),
+        "status": "succeeded" if counts['succeeded'] else "failed"})
+    return Response(
+        json.dumps({"results": results, "counts": counts}),
+        content_type="application/json")
+
+
 @app.route("/session", methods=["GET"])
 def list_proxy_sessions():
     """
     The ProxySession resource endpoint for listing ProxySessions
-    from the pool.
-    """
-    sessions = ProxySession.query.all()
-    res = [{
-        'id': s.id,
-        'date_created': s.date_created.strftime('%Y-%m-%d %H:%M:%S'),
-        'virtual_tn': s.virtual_TN,
-        'participant_a': s.participant_a,
-        'participant_b': s.participant_b,
-        'expiry_date': s.expiry_date.strftime('%Y-%m-%d %H:%M:%S')
-        if s.expiry_date else None}
-        for s in sessions]
-    return Response(
-        json.dumps({"total_sessions": len(res), "sessions": res}),
-        content_type="application/json")
+    from the pool, a page at a time, in order of id. Sessions can be
+    filtered by 'participant', and by 'expires_before' a date. With
+    'stream=ndjson' or 'stream=json' every matching session is streamed
+    instead. Only the sessions of the tenant are listed.
+    """
+    tenant = current_tenant()
+    participant = request.args.get('participant')
+    expires_before = request.args.get('expires_before')
+    if expires_before is not None:
+        try:
+            expires_before = datetime.strptime(expires_before, DATE_FORMAT)
+        except ValueError:
+            raise InvalidAPIUsage(
+                "Optional argument: 'expires_before' (str, {})".format(
+                    DATE_FORMAT.replace('%', '')),
+                payload={'reason': 'invalidAPIUsage'})
+    fmt = stream_format()
+    if fmt is not None:
+        return stream_rows(
+            "sessions",
+            ProxySession.export(after=request.args.get('after'),
+                                participant=participant,
+                                expires_before=expires_before,
+                                tenant_id=tenant.id),
+            session_to_dict, fmt)
+    limit, after = page_args()
+    rows = ProxySession.page(limit + 1, after=after, participant=participant,
+                             expires_before=expires_before,
+                             tenant_id=tenant.id)
+    res = {"sessions": [session_to_dict(row) for row in rows[:limit]],
+           "next": next_cursor(rows, limit)}
+    if after is None:
+        res["total_sessions"] = ProxySession.count(
+            participant=participant, expires_before=expires_before,
+            tenant_id=tenant.id)
+    return Response(json.dumps(res), content_type="application/json")
+
+
+@app.route("/participant/<participant>/sessions", methods=["GET"])
+def list_participant_sessions(participant):
+    """
+    The participant resource endpoint for listing the sessions of the
+    tenant a phone number takes part in, on either side, a page at a time,
+    in order of id. The first page also counts them, and those of them
+    that are active.
+    """
+    tenant = current_tenant()
+    limit, after = page_args()
+    rows = SessionParticipant.sessions(participant, tenant.id, limit + 1,
+                                       after=after)
+    res = {"participant": participant,
+           "sessions": [session_to_dict(row) for row in rows[:limit]],
+           "next": next_cursor(rows, limit)}
+    if after is None:
+        res["total_sessions"] = SessionParticipant.count(participant,
+                                                         tenant.id)
+        res["active_sessions"] = SessionParticipant.count_active(
+            [participant], tenant.id)[participant]
+    return Response(json.dumps(res), content_type="application/json")
+
+
+@app.route("/session/<session_id>/messages", methods=["GET"])
+def list_session_messages(session_id):
+    """
+    The message history resource endpoint for listing the messages received
+    and sent for a session of the tenant, a page at a time, in the order
+    they happened. The history outlives the session.
+    """
+    tenant = current_tenant()
+    limit, after = page_args()
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            raise InvalidAPIUsage(
+                "Optional argument: 'after' (int)",
+                payload={'reason': 'invalidAPIUsage'})
+    events = MessageEvent.page(session_id, limit + 1, after=after,
+                               tenant_id=tenant.id)
+    res = {"session_id": session_id,
+           "messages": [event_to_dict(event) for event in events[:limit]],
+           "next": events[limit - 1].id if len(events) > limit else None}
+    return Response(json.dumps(res), content_type="application/json")
 
 
 @app.route("/session", methods=["DELETE"])
 def delete_session():
     """
     The ProxySession resource endpoint for removing a ProxySession
-    to the pool.
+    of the tenant.
     """
+    tenant = current_tenant()
     body = request.json
     try:
         session_id = str(body['session_id'])
@@ -299,7 +1120,8 @@ def delete_session():
             payload={'reason':
                      'invalidAPIUsage'})
     try:
-        session = ProxySession.query.filter_by(id=session_id).one()
+        session = ProxySession.query.filter_by(id=session_id,
+                                               tenant_id=tenant.id).one()
     except NoResultFound:
         msg = ("ProxySession {} could not be deleted because"
                " it does not exist".format(session_id))
@@ -315,9 +1137,10 @@ def delete_session():
     send_message(
         recipients,
         virtual_tn.value,
-        SESSION_END_MSG,
+        tenant.session_end_msg,
         session_id,
-        is_system_msg=True)
+        is_system_msg=True,
+        tenant=tenant)
     msg = "Ended session {} and released {} back to pool".format(
         session_id, virtual_tn.value)
     log.info({"message": msg, "status": "succeeded"})
@@ -332,11 +1155,9 @@ def delete_session():
 def inbound_handler():
     """
     The inbound request handler for consuming HTTP wrapped SMS content from
-    Flowroute's messaging service.
+    Flowroute's messaging service. The message is forwarded for the tenant
+    the virtual TN belongs to.
     """
-    # We'll take this time to clear out any expired sessions and release
-    # TNs back to the pool if possible
-    ProxySession.clean_expired()
     body = request.json
     try:
         virtual_tn = body['to']
@@ -348,29 +1169,236 @@ def inbound_handler():
         msg = ("Malformed inbound message: {}".format(body))
         log.error({"message": msg, "status": "failed", "exc": str(e)})
         return Response('There was an issue parsing your request.', status=400)
-    rcv_participant, session_id = ProxySession.get_other_participant(
-        virtual_tn, tx_participant)
-    if rcv_participant is not None:
-        recipients = [rcv_participant]
-        send_message(
-            recipients,
-            virtual_tn,
-            message,
-            session_id)
-    else:
-        recipients = [tx_participant]
-        send_message(
-            recipients,
-            virtual_tn,
-            NO_SESSION_MSG,
-            None,
-            is_system_msg=True)
-        msg = ("ProxySession not found, or {} is not authorized "
-               "to participate".format(tx_participant))
+    # Flowroute redelivers messages it did not see a response to in time,
+    # acknowledge those without forwarding them again once they have been
+    # forwarded, and have Flowroute retry them while they are being
+    # forwarded, as that may yet fail
+    key = inbound_key(body)
+    status = app.duplicate_filter.check(key)
+    if status == InboundMessage.DONE:
+        msg = ("Inbound message {} was already received".format(key))
         log.info({"message": msg, "status": "succeeded"})
+        return Response(status=200)
+    elif status == InboundMessage.PROCESSING:
+        msg = ("Inbound message {} is still being forwarded".format(key))
+        log.info({"message": msg, "status": "failed"})
+        return Response(msg, status=503)
+    try:
+        rcv_participant, session_id = ProxySession.get_other_participant(
+            virtual_tn, tx_participant)
+        tenant = app.tenants.for_virtual_tn(virtual_tn)
+        app.history.record('inbound', 'received', tx_participant,
+                           virtual_tn, message, session_id, tenant.id)
+        # Return the connection to the pool rather than hold it while
+        # waiting on Flowroute, as under gevent workers many requests wait
+        # at once
+        db_session.close()
+        # Respond to Flowroute without waiting on its API when the outbox
+        # is enabled
+        forward = queue_message if OUTBOX_ENABLED else send_message
+        if rcv_participant is not None:
+            recipients = [rcv_participant]
+            forward(
+                recipients,
+                virtual_tn,
+                message,
+                session_id,
+                tenant=tenant)
+        else:
+            recipients = [tx_participant]
+            forward(
+                recipients,
+                virtual_tn,
+                tenant.no_session_msg,
+                None,
+                is_system_msg=True,
+                tenant=tenant)
+            msg = ("ProxySession not found, or {} is not authorized "
+                   "to participate".format(tx_participant))
+            log.info({"message": msg, "status": "succeeded"})
+    except Exception:
+        # Forward the message when Flowroute delivers it again
+        app.duplicate_filter.failed(key)
+        raise
+    app.duplicate_filter.processed(key)
     return Response(status=200)
 
 
+# The settings of a tenant that may be changed, with their greatest length
+TENANT_SETTINGS = (('org_name', 80),
+                   ('flowroute_access_key', 64),
+                   ('flowroute_secret_key', 64),
+                   ('session_start_msg', None),
+                   ('session_end_msg', None),
+                   ('no_session_msg', None))
+
+
+def tenant_to_dict(tenant):
+    res = {'id': tenant.id,
+           'max_sessions': tenant.max_sessions,
+           'has_credentials': tenant.flowroute_access_key is not None,
+           'created_at': format_date(tenant.created_at)}
+    for name, _ in TENANT_SETTINGS:
+        if not name.startswith('flowroute_'):
+            res[name] = getattr(tenant, name)
+    return res
+
+
+def tenant_settings(body):
+    """
+    Returns the settings given in the body of a tenant request, raising
+    InvalidAPIUsage if any is invalid. A setting of None falls back to the
+    service's own.
+    """
+    settings = {}
+    for name, length in TENANT_SETTINGS:
+        if name not in body:
+            continue
+        value = body[name]
+        if value is not None and not (isinstance(value, string_types) and (
+                length is None or len(value) <= length)):
+            raise InvalidAPIUsage(
+                "Optional argument: '{}' (str{})".format(
+                    name, ", length <= {}".format(length) if length else ""),
+                payload={'reason': 'invalidAPIUsage'})
+        settings[name] = value
+    if 'max_sessions' in body:
+        max_sessions = body['max_sessions']
+        if max_sessions is not None and (
+                isinstance(max_sessions, bool) or
+                not isinstance(max_sessions, integer_types) or
+                max_sessions < 0):
+            raise InvalidAPIUsage(
+                "Optional argument: 'max_sessions' (int >= 0)",
+                payload={'reason': 'invalidAPIUsage'})
+        settings['max_sessions'] = max_sessions
+    return settings
+
+
+@app.route("/tenant", methods=['POST'])
+def save_tenant():
+    """
+    The Tenant resource endpoint for adding a tenant, or changing the
+    settings of an existing one. Settings that are not given are left as
+    they are.
+    """
+    body = request.json
+    try:
+        tenant_id = body['id']
+        assert isinstance(tenant_id, string_types)
+        assert 0 < len(tenant_id) <= 32
+    except (AssertionError, KeyError, TypeError):
+        raise InvalidAPIUsage(
+            "Required argument: 'id' (str, length <= 32)",
+            payload={'reason': 'invalidAPIUsage'})
+    settings = tenant_settings(body)
+    tenant = db_session.query(Tenant).get(tenant_id)
+    created = tenant is None
+    if created:
+        tenant = Tenant(tenant_id)
+        db_session.add(tenant)
+    for name, value in settings.items():
+        setattr(tenant, name, value)
+    if (tenant.flowroute_access_key is None) != (
+            tenant.flowroute_secret_key is None):
+        db_session.rollback()
+        raise InvalidAPIUsage(
+            "'flowroute_access_key' and 'flowroute_secret_key' must be set "
+            "together",
+            payload={'reason': 'invalidAPIUsage'})
+    try:
+        db_session.commit()
+    except IntegrityError:
+        db_session.rollback()
+        raise InvalidAPIUsage(
+            "Tenant {} was created by another request, please retry".format(
+                tenant_id),
+            status_code=409,
+            payload={'reason': 'conflict'})
+    app.tenants.invalidate(tenant_id)
+    log.info({"message": "{} tenant {}".format(
+        "Created" if created else "Updated", tenant_id),
+        "status": "succeeded"})
+    res = tenant_to_dict(tenant)
+    res["message"] = "Successfully saved tenant"
+    return Response(json.dumps(res), content_type="application/json")
+
+
+@app.route("/tenant", methods=['GET'])
+def list_tenants():
+    """
+    The Tenant resource endpoint for listing tenants, in order of id.
+    Their Flowroute credentials are never returned.
+    """
+    tenants = Tenant.query.order_by(Tenant.id).all()
+    return Response(
+        json.dumps({"tenants": [tenant_to_dict(t) for t in tenants]}),
+        content_type="application/json")
+
+
+@app.route("/tenant", methods=['DELETE'])
+def delete_tenant():
+    """
+    The Tenant resource endpoint for removing a tenant that has no virtual
+    TNs or sessions left.
+    """
+    body = request.json
+    try:
+        tenant_id = str(body['id'])
+    except (KeyError, TypeError):
+        raise InvalidAPIUsage(
+            "Required argument: 'id' (str)",
+            payload={'reason': 'invalidAPIUsage'})
+    tenant = db_session.query(Tenant).get(tenant_id)
+    if tenant is None:
+        raise InvalidAPIUsage(
+            "Tenant {} does not exist".format(tenant_id),
+            status_code=404,
+            payload={'reason': 'tenant not found'})
+    if (VirtualTN.query.filter_by(tenant_id=tenant_id).first() is not None or
+            ProxySession.query.filter_by(tenant_id=tenant_id).first()
+            is not None):
+        raise InvalidAPIUsage(
+            "Tenant {} still has virtual TNs or sessions".format(tenant_id),
+            payload={'reason': 'tenant in use'})
+    db_session.delete(tenant)
+    db_session.commit()
+    app.tenants.discard(tenant_id)
+    log.info({"message": "Removed tenant {}".format(tenant_id),
+              "status": "succeeded"})
+    return Response(
+        json.dumps({"message": "Successfully removed tenant",
+                    "id": tenant_id,
+                    "status": "succeeded"}),
+        content_type="application/json")
+
+
+@app.route("/outbox", methods=["GET"])
+def outbox_stats():
+    """
+    The outbox resource endpoint for the number of queued and failed
+    messages, and how far behind the outbox workers are.
+    """
+    stats = app.outbox.stats()
+    return Response(
+        json.dumps({"depth": stats['depth'],
+                    "failed": stats['failed'],
+                    "lag": stats['lag'],
+                    "dispatch_lag": app.outbox_workers.dispatch_lag}),
+        content_type="application/json")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    The metrics endpoint, reporting request, database and upstream
+    latencies, cache lookups, and the utilisation of the virtual TN pools
+    of every tenant, in the Prometheus text format.
+    """
+    return Response(export(cached_pool_stats()),
+                    content_type=CONTENT_TYPE_LATEST)
+
+
 @app.errorhandler((InvalidAPIUsage, InternalSMSDispatcherError))
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
@@ -1,24 +1,56 @@
 from flask import Flask
-from FlowrouteMessagingLib.Controllers.APIController import APIController
 
-from sms_proxy.database import init_db
+from sms_proxy.cache import (routing_cache, stats_cache, inbound_cache,
+                             tenant_cache, tn_tenant_cache)
+from sms_proxy.database import init_db, engine
+from sms_proxy.dedup import DuplicateFilter
+from sms_proxy.dispatch import Dispatcher
+from sms_proxy.history import MessageLog
+from sms_proxy.metrics import (InstrumentedController, instrument_app,
+                               instrument_cache, instrument_engine)
+from sms_proxy.outbox import create_outbox, OutboxWorkerPool
+from sms_proxy.ratelimit import RateLimiter
+from sms_proxy.tenants import TenantRegistry
+from sms_proxy.transport import create_sms_controller
 from sms_proxy.settings import (FLOWROUTE_ACCESS_KEY, FLOWROUTE_SECRET_KEY,
-                                DEBUG_MODE, DB, TEST_DB)
+                                DEBUG_MODE, DATABASE_URL,
+                                OUTBOX_IN_PROCESS_WORKERS)
 
 
 def create_app():
     app = Flask(__name__)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    # Use prod, or dev database depending on debug mode
-    if DEBUG_MODE:
-        app.debug = DEBUG_MODE
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + TEST_DB
-    else:
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB
+    # DATABASE_URL is the prod, or dev database depending on debug mode
+    app.debug = DEBUG_MODE
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
     init_db()
-    sms_controller = APIController(username=FLOWROUTE_ACCESS_KEY,
-                                   password=FLOWROUTE_SECRET_KEY)
+    instrument_app(app)
+    instrument_engine(engine)
+    instrument_cache(routing_cache, 'routing')
+    instrument_cache(stats_cache, 'stats')
+    instrument_cache(inbound_cache, 'inbound')
+    instrument_cache(tenant_cache, 'tenant')
+    instrument_cache(tn_tenant_cache, 'tn_tenant')
+    sms_controller = InstrumentedController(create_sms_controller(
+        username=FLOWROUTE_ACCESS_KEY, password=FLOWROUTE_SECRET_KEY))
 
-    # Attach the Flowroute messaging controller to the app
+    # Attach the Flowroute messaging controller, and the dispatcher that
+    # sends through it, to the app
     app.sms_controller = sms_controller
+    app.dispatcher = Dispatcher()
+    # Paces the messages sent from each virtual TN, and in total
+    app.rate_limiter = RateLimiter()
+    # Recognises inbound messages that Flowroute delivers more than once
+    app.duplicate_filter = DuplicateFilter()
+    # The tenants, and the controllers of those with their own Flowroute
+    # account. Tenants without one send through 'sms_controller'.
+    app.tenants = TenantRegistry()
+    # Records every message received and sent, off of the request path
+    app.history = MessageLog()
+    # The outbox workers are started when the first message is queued, so
+    # that no threads exist before gunicorn forks its workers
+    app.outbox = create_outbox()
+    app.outbox_workers = OutboxWorkerPool(
+        app.outbox, sms_controller, workers=OUTBOX_IN_PROCESS_WORKERS,
+        tenants=app.tenants, history=app.history)
     return app
@@ -0,0 +1,85 @@
+import atexit
+import os
+import threading
+import time
+
+from six.moves import queue
+
+
+class BackgroundWriter(object):
+    """
+    Hands items to a background thread, which passes them to '_write' in
+    batches of up to 'batch_size', once that many are waiting or
+    'flush_interval' seconds after the first of them. When more than
+    'queue_size' items are waiting, further items are dropped and counted
+    in 'dropped'. With 'flush_at_exit', the items still waiting when the
+    process exits are written first.
+    """
+    def __init__(self, thread_name, queue_size, batch_size, flush_interval=0,
+                 flush_at_exit=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_at_exit = flush_at_exit
+        self.dropped = 0
+        self.queue = queue.Queue(queue_size)
+        self._thread_name = thread_name
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._exit_registered = False
+
+    def put(self, item):
+        """
+        Queues the item to be written, and returns False if it was dropped
+        """
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _ensure_thread(self):
+        # Started on first use, and again in a forked process, as threads
+        # do not survive gunicorn forking its workers
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self.flush_at_exit and not self._exit_registered:
+                    atexit.register(self.flush)
+                    self._exit_registered = True
+                self._thread = threading.Thread(target=self._run,
+                                                name=self._thread_name)
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while items[-1] is not None and len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get(
+                        timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            self._write([item for item in items if item is not None])
+            if items[-1] is None:
+                return
+
+    def _write(self, items):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Writes every item queued so far, and stops the background thread
+        until the next item is queued.
+        """
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                self.queue.put(None)
+                self._thread.join()
+                self._pid = None
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sms_proxy.settings import (ROUTING_CACHE_SIZE, ROUTING_CACHE_TTL,
+                                STATS_CACHE_TTL, INBOUND_DEDUP_WINDOW,
+                                INBOUND_DEDUP_CACHE_SIZE, TENANT_CACHE_SIZE,
+                                TENANT_CACHE_TTL)
+
+
+class TTLCache(object):
+    """
+    A bounded, thread safe, least recently used cache whose entries expire
+    'ttl' seconds after they were set. Keeps count of hits and misses.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value cached for 'key', or None if there is no entry or
+        the entry has expired.
+        """
+        with self._lock:
+            try:
+                value, expires_at = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at <= time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as the most recently used
+            self._entries[key] = (value, expires_at)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries),
+                    "maxsize": self.maxsize,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+# Maps a virtual TN to the Route of the session it is assigned to. Entries
+# are invalidated in this process when a session is created, terminated or
+# expired. Other processes find the session gone when they next use the
+# entry, as the session's id is checked on every hit.
+routing_cache = TTLCache(ROUTING_CACHE_SIZE, ROUTING_CACHE_TTL)
+
+# Maps a (tenant_id, expiring_within) key to the pool statistics last
+# reported by GET /tn/stats to that tenant for that expiry window, in minutes
+stats_cache = TTLCache(64, STATS_CACHE_TTL)
+
+# Maps the key of each inbound message forwarded by this process to True,
+# for as long as a redelivery of it is treated as a duplicate
+inbound_cache = TTLCache(INBOUND_DEDUP_CACHE_SIZE, INBOUND_DEDUP_WINDOW)
+
+# Maps a tenant id to the tenant's settings. Entries are invalidated in this
+# process when the tenant is changed, other processes see the change once the
+# entry's ttl has passed.
+tenant_cache = TTLCache(TENANT_CACHE_SIZE, TENANT_CACHE_TTL)
+
+# Maps a virtual TN to the id of the tenant it belongs to, so that inbound
+# messages are routed to their tenant without a query
+tn_tenant_cache = TTLCache(ROUTING_CACHE_SIZE, TENANT_CACHE_TTL)
@@ -1,14 +1,112 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
-from sms_proxy.settings import DB, TEST_DB, DEBUG_MODE
+from sms_proxy.settings import (DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+                                DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+                                SQLITE_BUSY_TIMEOUT, SQLITE_JOURNAL_MODE,
+                                SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE,
+                                SQLITE_CACHE_SIZE)
 
-if DEBUG_MODE:
-    engine = create_engine('sqlite:////tmp/{}'.format(TEST_DB),
-                           convert_unicode=True)
-else:
-    engine = create_engine('sqlite:///{}'.format(DB), convert_unicode=True)
+# Applied in order, busy_timeout first so that switching the journal mode
+# waits for other connections
+SQLITE_PRAGMAS = [
+    ('busy_timeout', SQLITE_BUSY_TIMEOUT),
+    ('journal_mode', SQLITE_JOURNAL_MODE),
+    ('synchronous', SQLITE_SYNCHRONOUS),
+    ('mmap_size', SQLITE_MMAP_SIZE),
+    ('cache_size', SQLITE_CACHE_SIZE),
+]
+
+
+def set_sqlite_pragmas(engine, pragmas=SQLITE_PRAGMAS):
+    """
+    Applies the (name, value) PRAGMAs to every connection the engine opens,
+    skipping those without a value.
+    """
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            if value:
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+
+def set_pre_ping(engine):
+    """
+    Tests each connection as it is checked out of the pool, replacing it if
+    the database has closed it, rather than failing the request using it.
+    """
+    @event.listens_for(engine, 'engine_connect')
+    def ping_connection(connection, branch):
+        if branch:
+            return
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except DBAPIError as e:
+            if e.connection_invalidated:
+                # The pool has been invalidated, retry with a new connection
+                connection.scalar(select([1]))
+            else:
+                raise
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+
+def create_db_engine(url, sqlite_pragmas=SQLITE_PRAGMAS,
+                     pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                     pool_recycle=DB_POOL_RECYCLE, pre_ping=DB_POOL_PRE_PING):
+    """
+    Creates an engine for the database URL. Connections are kept in a
+    QueuePool of 'pool_size' connections, plus up to 'max_overflow' more
+    under load.
+    """
+    url = make_url(url)
+    options = {'convert_unicode': True}
+    if url.drivername.startswith('sqlite'):
+        if url.database and url.database != ':memory:':
+            # Keep connections to file databases open between requests,
+            # rather than SQLAlchemy's default of reconnecting each time, so
+            # that the page cache and memory map of each connection are
+            # reused. The pool hands each connection to one thread at a
+            # time.
+            options.update(poolclass=QueuePool,
+                           pool_size=pool_size,
+                           max_overflow=max_overflow,
+                           connect_args={'check_same_thread': False})
+    else:
+        options.update(pool_size=pool_size,
+                       max_overflow=max_overflow,
+                       pool_recycle=pool_recycle)
+    engine = create_engine(url, **options)
+    if engine.dialect.name == 'sqlite':
+        set_sqlite_pragmas(engine, sqlite_pragmas)
+    elif pre_ping:
+        set_pre_ping(engine)
+    return engine
+
+
+def supports_skip_locked(engine):
+    """
+    Returns True if the database can skip rows locked by other transactions
+    with SELECT ... FOR UPDATE SKIP LOCKED
+    """
+    dialect = engine.dialect
+    version = dialect.server_version_info or ()
+    if dialect.name == 'postgresql':
+        return version >= (9, 5)
+    if dialect.name == 'mysql':
+        return version >= (8, 0, 1)
+    return False
+
+
+engine = create_db_engine(DATABASE_URL)
 
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
@@ -19,9 +117,9 @@ Base.query = db_session.query_property()
 
 
 def init_db():
-    import models
-    Base.metadata.create_all(bind=engine)
+    from sms_proxy import migrations
+    migrations.upgrade(engine)
 
 def destroy_db():
-    import models
+    from sms_proxy import migrations
     Base.metadata.drop_all(bind=engine)
@@ -0,0 +1,108 @@
+import hashlib
+from datetime import datetime, timedelta
+
+from sms_proxy.settings import INBOUND_DEDUP_WINDOW, INBOUND_PRUNE_INTERVAL
+from sms_proxy.cache import inbound_cache
+from sms_proxy.database import db_session
+from sms_proxy.log import log
+from sms_proxy.metrics import INBOUND_DUPLICATES
+from sms_proxy.models import InboundMessage
+
+
+def inbound_key(body):
+    """
+    Returns the key identifying an inbound message across redeliveries: its
+    Flowroute message id, or a hash of its participants, content and
+    timestamp. Returns None for a message with neither an id nor a
+    timestamp, as a participant sending the same text twice could not be
+    told apart from a redelivery.
+    """
+    if body.get('id'):
+        return u'id:{}'.format(body['id'])[:64]
+    if body.get('timestamp'):
+        content = u'\n'.join(u'{}'.format(body[field]) for field in
+                             ('to', 'from', 'body', 'timestamp'))
+        return 'sha1:' + hashlib.sha1(content.encode('utf-8')).hexdigest()
+    return None
+
+
+class DuplicateFilter(object):
+    """
+    Recognises redeliveries of inbound messages within 'window' seconds of
+    the first delivery. Each first delivery is recorded in the
+    inbound_message table, shared by every process, as processing until it
+    has been forwarded, and the keys of the messages forwarded by this
+    process are also kept in 'cache'. Counts the duplicates of forwarded
+    messages found in 'suppressed'. The records older than the window are
+    removed at most once every 'prune_interval' seconds.
+    """
+    def __init__(self, cache=inbound_cache, window=INBOUND_DEDUP_WINDOW,
+                 prune_interval=INBOUND_PRUNE_INTERVAL):
+        self.cache = cache
+        self.window = window
+        self.prune_interval = prune_interval
+        self.suppressed = 0
+        self._pruned_at = None
+
+    def check(self, key):
+        """
+        Returns None if the message with 'key' is to be forwarded, and
+        records this delivery as processing. Otherwise returns the status
+        of the earlier delivery: InboundMessage.DONE once it has been
+        forwarded, or InboundMessage.PROCESSING while it may still fail,
+        in which case this delivery must not be acknowledged. A message
+        without a key is always forwarded.
+        """
+        if key is None or self.window <= 0:
+            return None
+        if self.cache.get(key):
+            status = InboundMessage.DONE
+        else:
+            status = InboundMessage.record(key, self.window)
+        if status == InboundMessage.DONE:
+            self.suppressed += 1
+            INBOUND_DUPLICATES.inc()
+        return status
+
+    def processed(self, key):
+        """
+        Marks the message with 'key' as forwarded, so its redeliveries are
+        acknowledged, by this process without a query
+        """
+        if key is not None and self.window > 0:
+            InboundMessage.complete(key)
+            self.cache.set(key, True)
+            self.prune()
+
+    def prune(self, now=None):
+        """
+        Removes the records of messages first delivered longer ago than the
+        window, unless they were removed within the last 'prune_interval'
+        seconds. Returns the number removed.
+        """
+        now = now or datetime.utcnow()
+        if self.prune_interval <= 0 or (
+                self._pruned_at is not None and
+                now - self._pruned_at < timedelta(
+                    seconds=self.prune_interval)):
+            return 0
+        self._pruned_at = now
+        try:
+            return InboundMessage.prune(now - timedelta(seconds=self.window))
+        except Exception as e:
+            db_session.rollback()
+            log.error({"message": "Failed to prune inbound messages",
+                       "status": "failed",
+                       "exc": str(e)})
+            return 0
+
+    def failed(self, key):
+        """
+        Forgets the delivery of the message with 'key', which could not be
+        forwarded, so that its redelivery is forwarded
+        """
+        if key is None or self.window <= 0:
+            return
+        self.cache.invalidate(key)
+        db_session.rollback()
+        InboundMessage.forget(key)
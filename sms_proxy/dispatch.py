@@ -0,0 +1,76 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from sms_proxy.settings import DISPATCH_POOL_SIZE, DISPATCH_TIMEOUT
+
+
+class DispatchTimeout(Exception):
+    """
+    Raised in place of a send that did not complete within the timeout.
+    """
+
+
+class DispatchResult(object):
+    """
+    The outcome of sending a batch of messages. 'sent' holds the messages
+    that were accepted upstream, 'failed' holds (message, exception) pairs.
+    """
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+class Dispatcher(object):
+    """
+    Sends messages through a messaging controller concurrently, on a bounded
+    pool of threads, waiting at most 'timeout' seconds for the whole batch.
+    """
+    def __init__(self, max_workers=DISPATCH_POOL_SIZE, timeout=DISPATCH_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # Created on first use, so that no threads exist before gunicorn
+        # forks its workers
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers)
+        return self._executor
+
+    def dispatch(self, controller, messages, timeout=None):
+        """
+        Passes each message to 'controller.create_message', and returns a
+        DispatchResult once every send has completed or timed out. The
+        batch is given 'timeout' seconds, if set, instead of the default.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        result = DispatchResult()
+        futures = [(self.executor.submit(controller.create_message, message),
+                    message) for message in messages]
+        wait([future for future, message in futures], timeout=timeout)
+        for future, message in futures:
+            if not future.done():
+                future.cancel()
+                result.failed.append((message, DispatchTimeout(
+                    "Timed out after {}s sending to {}".format(
+                        timeout, message.to))))
+            elif future.exception() is not None:
+                result.failed.append((message, future.exception()))
+            else:
+                result.sent.append(message)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -0,0 +1,17 @@
+from prometheus_client import multiprocess
+
+
+def post_fork(server, worker):
+    # Under gevent workers, let other requests run while one waits on
+    # PostgreSQL, as psycopg2 is not made cooperative by monkey patching
+    if type(worker).__module__ == 'gunicorn.workers.ggevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            return
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    # Stop reporting the gauges of a worker that has exited
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,130 @@
+import gzip
+import os
+import time
+from datetime import datetime, timedelta
+
+import simplejson as json
+
+from sms_proxy.settings import (HISTORY_ENABLED, HISTORY_BUFFER_SIZE,
+                                HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL,
+                                HISTORY_RETENTION_DAYS,
+                                HISTORY_COMPACTION_BATCH_SIZE,
+                                HISTORY_ARCHIVE_DIR, DEFAULT_TENANT)
+from sms_proxy.background import BackgroundWriter
+from sms_proxy.database import db_session
+from sms_proxy.log import log
+from sms_proxy.metrics import HISTORY_DROPPED, HISTORY_FLUSH_LATENCY
+from sms_proxy.models import MessageEvent
+
+ARCHIVE_DATE_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def event_to_dict(event):
+    return {'id': event.id,
+            'session_id': event.session_id,
+            'tenant_id': event.tenant_id,
+            'direction': event.direction,
+            'status': event.status,
+            'from': event.from_number,
+            'to': event.to_number,
+            'body': event.body,
+            'created_at': event.created_at.isoformat()}
+
+
+class MessageLog(BackgroundWriter):
+    """
+    Records message events without writing to the database on the request
+    path. Events are buffered, and written by a background thread with a
+    single executemany once 'batch_size' of them are waiting, or
+    'flush_interval' seconds after the first of them. When more than
+    'buffer_size' events are waiting, further events are dropped and
+    counted in 'dropped'. Records nothing unless 'enabled'.
+    """
+    def __init__(self, enabled=HISTORY_ENABLED,
+                 buffer_size=HISTORY_BUFFER_SIZE,
+                 batch_size=HISTORY_BATCH_SIZE,
+                 flush_interval=HISTORY_FLUSH_INTERVAL):
+        BackgroundWriter.__init__(self, 'history-writer', buffer_size,
+                                  batch_size, flush_interval,
+                                  flush_at_exit=True)
+        self.enabled = enabled
+
+    def record(self, direction, status, from_number, to_number, body,
+               session_id=None, tenant_id=None):
+        if not self.enabled:
+            return
+        if not self.put({'session_id': session_id,
+                         'tenant_id': tenant_id or DEFAULT_TENANT,
+                         'direction': direction,
+                         'status': status,
+                         'from_number': from_number,
+                         'to_number': to_number,
+                         'body': body,
+                         'created_at': datetime.utcnow()}):
+            HISTORY_DROPPED.inc()
+
+    def _write(self, events):
+        if not events:
+            return
+        start = time.time()
+        try:
+            db_session.execute(MessageEvent.__table__.insert(), events)
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            self.dropped += len(events)
+            HISTORY_DROPPED.inc(len(events))
+            log.error({"message": "Failed to record {} message "
+                       "events".format(len(events)),
+                       "status": "failed",
+                       "exc": str(e)})
+        finally:
+            db_session.remove()
+            HISTORY_FLUSH_LATENCY.observe(time.time() - start)
+
+
+def archive(events, archive_dir):
+    """
+    Writes the events to a new gzipped file of newline delimited JSON in
+    'archive_dir', named after the first and last of them, and returns
+    its path
+    """
+    name = 'message_events-{}-{}-{}.ndjson.gz'.format(
+        events[0].created_at.strftime(ARCHIVE_DATE_FORMAT), events[0].id,
+        events[-1].id)
+    path = os.path.join(archive_dir, name)
+    f = gzip.open(path, 'wb')
+    try:
+        for event in events:
+            f.write((json.dumps(event_to_dict(event)) + '\n').encode('utf-8'))
+    finally:
+        f.close()
+    return path
+
+
+def compact(retention_days=HISTORY_RETENTION_DAYS,
+            archive_dir=HISTORY_ARCHIVE_DIR,
+            batch_size=HISTORY_COMPACTION_BATCH_SIZE, now=None):
+    """
+    Removes the events older than 'retention_days', 'batch_size' per
+    transaction, archiving each batch to 'archive_dir' first, if set.
+    A batch is only removed once its archive has been written, so an
+    interrupted compaction archives that batch again, to another file, when
+    it is run next. Returns the number of events removed.
+    """
+    if retention_days <= 0:
+        return 0
+    before = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    removed = 0
+    while True:
+        events = MessageEvent.oldest(before, batch_size)
+        if not events:
+            break
+        if archive_dir:
+            archive(events, archive_dir)
+        MessageEvent.remove([event.id for event in events])
+        db_session.commit()
+        removed += len(events)
+        if len(events) < batch_size:
+            break
+    return removed
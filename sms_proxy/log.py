@@ -1,12 +1,75 @@
 import sys
 import os
 import logging
+import random
+
 from pythonjsonlogger import jsonlogger
 
+from sms_proxy.background import BackgroundWriter
+from sms_proxy.settings import (LOG_ASYNC, LOG_QUEUE_SIZE, LOG_BATCH_SIZE,
+                                LOG_INFO_SAMPLE_RATE)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only a 'rate' fraction of the records at INFO level or below,
+    and every record above it.
+    """
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        return (record.levelno > logging.INFO or self.rate >= 1 or
+                random.random() < self.rate)
+
+
+class QueueHandler(BackgroundWriter, logging.Handler):
+    """
+    Hands records to a background thread, which formats them and writes
+    them to 'stream' in batches of up to 'batch_size', so that logging
+    does not block the thread handling a request. When more than
+    'queue_size' records are waiting, further records are dropped and
+    counted in 'dropped'.
+    """
+    def __init__(self, stream, formatter, queue_size=LOG_QUEUE_SIZE,
+                 batch_size=LOG_BATCH_SIZE):
+        BackgroundWriter.__init__(self, 'log-listener', queue_size,
+                                  batch_size)
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.setFormatter(formatter)
+
+    def emit(self, record):
+        self.put(record)
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + '\n')
+            except Exception:
+                self.handleError(record)
+        if lines:
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
 
 log = logging.getLogger()
-handler = logging.StreamHandler(sys.stdout)
 formatter = jsonlogger.JsonFormatter()
-handler.setFormatter(formatter)
+if LOG_ASYNC:
+    # Queued records are written by logging.shutdown when the process exits
+    handler = QueueHandler(sys.stdout, formatter)
+else:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(formatter)
+handler.addFilter(SamplingFilter(LOG_INFO_SAMPLE_RATE))
 log.addHandler(handler)
 log.setLevel(int(os.environ.get('LOG_LEVEL', 20)))  # Default to INFO log level
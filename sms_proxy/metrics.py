@@ -0,0 +1,191 @@
+import time
+
+from flask import g, request
+from prometheus_client import (CollectorRegistry, Counter, Histogram,
+                               REGISTRY, generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+from sms_proxy.settings import METRICS_MULTIPROC_DIR
+
+# Queries are expected to take well under the default request buckets
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0,
+              2.5, float('inf'))
+
+REQUEST_LATENCY = Histogram(
+    'sms_proxy_request_latency_seconds',
+    'Time spent handling HTTP requests, by route',
+    ['method', 'route'])
+REQUESTS = Counter(
+    'sms_proxy_requests_total',
+    'HTTP requests handled, by route and response status',
+    ['method', 'route', 'status'])
+DB_QUERY_LATENCY = Histogram(
+    'sms_proxy_db_query_latency_seconds',
+    'Time spent executing database statements, by statement type',
+    ['statement'], buckets=DB_BUCKETS)
+UPSTREAM_LATENCY = Histogram(
+    'sms_proxy_upstream_latency_seconds',
+    "Time spent sending a message through Flowroute's API")
+UPSTREAM_ERRORS = Counter(
+    'sms_proxy_upstream_errors_total',
+    "Messages Flowroute's API did not accept, by exception type",
+    ['exception'])
+INBOUND_DUPLICATES = Counter(
+    'sms_proxy_inbound_duplicates_total',
+    'Redelivered inbound messages acknowledged without being forwarded')
+RATE_LIMITED = Counter(
+    'sms_proxy_rate_limited_messages_total',
+    'Messages held back by the rate limits, by whether they were delayed '
+    'before sending or queued in the outbox',
+    ['action'])
+RATE_LIMIT_DELAY = Histogram(
+    'sms_proxy_rate_limit_delay_seconds',
+    'How long messages held back by the rate limits waited to be sent',
+    buckets=(.01, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+             float('inf')))
+HISTORY_DROPPED = Counter(
+    'sms_proxy_history_dropped_events_total',
+    'Message events not recorded, as the buffer was full or the write failed')
+HISTORY_FLUSH_LATENCY = Histogram(
+    'sms_proxy_history_flush_seconds',
+    'Time spent writing a batch of buffered message events',
+    buckets=DB_BUCKETS)
+CACHE_LOOKUPS = Counter(
+    'sms_proxy_cache_lookups_total',
+    'Cache lookups, by cache and whether they hit',
+    ['cache', 'result'])
+
+
+class PoolCollector(object):
+    """
+    Reports the size and utilisation of the virtual TN pool, from the
+    statistics returned by 'pool_stats'. The pool is shared by every
+    process, so it is read when scraped rather than recorded per process.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        virtual_tns = GaugeMetricFamily(
+            'sms_proxy_virtual_tns', 'Virtual TNs in the pool, by state',
+            labels=['state'])
+        virtual_tns.add_metric(['available'], self.stats['available'])
+        virtual_tns.add_metric(['in_use'], self.stats['in_use'])
+        yield virtual_tns
+        pool_tns = GaugeMetricFamily(
+            'sms_proxy_pool_virtual_tns',
+            'Virtual TNs in each pool, by state', labels=['pool', 'state'])
+        for pool, counts in sorted(self.stats['pools'].items()):
+            pool_tns.add_metric([pool, 'available'], counts['available'])
+            pool_tns.add_metric([pool, 'in_use'], counts['in_use'])
+        yield pool_tns
+        yield GaugeMetricFamily(
+            'sms_proxy_virtual_tn_utilisation_ratio',
+            'The fraction of the virtual TN pool in use by sessions',
+            value=self.stats['in_use_percent'] / 100.0)
+        yield GaugeMetricFamily(
+            'sms_proxy_expired_sessions',
+            'Sessions that have expired, but not been removed yet',
+            value=self.stats['expired_sessions'])
+        yield GaugeMetricFamily(
+            'sms_proxy_expiring_sessions',
+            'Sessions expiring within the statistics window',
+            value=self.stats['expiring_sessions'])
+
+
+def export(stats):
+    """
+    Returns the metrics of every process, and of the virtual TN pool, in
+    the Prometheus text format. With METRICS_MULTIPROC_DIR set, the
+    metrics recorded by each gunicorn worker are merged.
+    """
+    if METRICS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    pool = CollectorRegistry()
+    pool.register(PoolCollector(stats))
+    return generate_latest(registry) + generate_latest(pool)
+
+
+def instrument_app(app):
+    """
+    Records the latency, and response status, of every request to the app
+    """
+    @app.before_request
+    def start_timer():
+        g.request_start_time = time.time()
+
+    @app.after_request
+    def record_request(response):
+        start = getattr(g, 'request_start_time', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_LATENCY.labels(request.method, route).observe(
+                time.time() - start)
+            REQUESTS.labels(request.method, route,
+                            str(response.status_code)).inc()
+        return response
+
+
+def instrument_engine(engine):
+    """
+    Records the time spent executing each statement on the engine
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context,
+                     executemany):
+        start = conn.info['query_start_time'].pop()
+        DB_QUERY_LATENCY.labels(statement.split(None, 1)[0].upper()).observe(
+            time.time() - start)
+
+    @event.listens_for(engine, 'handle_error')
+    def discard_timer(context):
+        if context.connection is not None:
+            starts = context.connection.info.get('query_start_time')
+            if starts:
+                starts.pop()
+
+
+def instrument_cache(cache, name):
+    """
+    Counts the hits and misses of the cache's lookups
+    """
+    get = cache.get
+    hits = CACHE_LOOKUPS.labels(name, 'hit')
+    misses = CACHE_LOOKUPS.labels(name, 'miss')
+
+    def counted_get(key):
+        value = get(key)
+        (misses if value is None else hits).inc()
+        return value
+    cache.get = counted_get
+
+
+class InstrumentedController(object):
+    """
+    Wraps a messaging controller, recording the latency, and failures, of
+    every message sent through it.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+
+    def create_message(self, message):
+        start = time.time()
+        try:
+            return self.controller.create_message(message)
+        except Exception as e:
+            UPSTREAM_ERRORS.labels(type(e).__name__).inc()
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.controller, name)
@@ -0,0 +1,184 @@
+from datetime import datetime
+
+from sqlalchemy import (Table, MetaData, Column, Integer, DateTime, String,
+                        inspect, func, and_, or_, select)
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.schema import DropIndex
+
+from sms_proxy.database import Base
+from sms_proxy.settings import (TN_DEFAULT_POOL, TN_POOL_BY_AREA_CODE,
+                                DEFAULT_TENANT)
+from sms_proxy.log import log
+# Registers the tables of the models on Base
+from sms_proxy import models
+
+schema_version = Table(
+    'schema_version', Base.metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(80)),
+    Column('applied_at', DateTime))
+
+
+def _add_column(conn, table, column):
+    """
+    Adds the column, as declared on the model, to an existing table
+    """
+    if column.name in [c['name'] for c in inspect(conn).get_columns(table)]:
+        return
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        table, column.name, column_type))
+
+
+def _create_index(conn, table, name, columns=None):
+    """
+    Creates the index, as declared on the model, on an existing table. An
+    index the models no longer declare is created on its 'columns'.
+    """
+    if name in [i['name'] for i in inspect(conn).get_indexes(table)]:
+        return
+    if columns is not None:
+        conn.execute('CREATE INDEX {} ON {} ({})'.format(
+            name, table, ', '.join(columns)))
+        return
+    index, = [i for i in Base.metadata.tables[table].indexes
+              if i.name == name]
+    index.create(bind=conn)
+
+
+def _drop_index(conn, table, name):
+    """
+    Drops the index, as reflected from the existing table, as the models no
+    longer declare it. DropIndex names the table too where the database
+    needs it, as MySQL does.
+    """
+    for index in Table(table, MetaData(), autoload_with=conn).indexes:
+        if index.name == name:
+            conn.execute(DropIndex(index))
+
+
+def add_virtual_tn_released_at(conn):
+    _add_column(conn, 'virtual_tn',
+                Base.metadata.tables['virtual_tn'].c.released_at)
+    _create_index(conn, 'virtual_tn', 'ix_virtual_tn_session_id_released_at')
+
+
+def add_session_indexes(conn):
+    _create_index(conn, 'session', 'ix_session_expiry_date')
+    _create_index(conn, 'session', 'ix_session_participants')
+
+
+def add_virtual_tn_pool(conn):
+    virtual_tn = Base.metadata.tables['virtual_tn']
+    _add_column(conn, 'virtual_tn', virtual_tn.c.pool)
+    # Existing virtual TNs join the pool they would be added to now
+    if TN_POOL_BY_AREA_CODE:
+        conn.execute(virtual_tn.update().where(and_(
+            virtual_tn.c.pool.is_(None),
+            func.length(virtual_tn.c.value) == 11,
+            virtual_tn.c.value.like('1%'))).values(
+            pool=func.substr(virtual_tn.c.value, 2, 3)))
+    conn.execute(virtual_tn.update().where(
+        virtual_tn.c.pool.is_(None)).values(pool=TN_DEFAULT_POOL))
+    _create_index(conn, 'virtual_tn',
+                  'ix_virtual_tn_pool_session_id_released_at',
+                  ['pool', 'session_id', 'released_at'])
+
+
+def add_tenants(conn):
+    # The tenant table itself is created by create_all. Everything that
+    # exists already belongs to the default tenant.
+    for table in ('virtual_tn', 'session', 'outbox'):
+        columns = Base.metadata.tables[table].c
+        _add_column(conn, table, columns.tenant_id)
+        conn.execute(Base.metadata.tables[table].update().where(
+            columns.tenant_id.is_(None)).values(tenant_id=DEFAULT_TENANT))
+    # Free virtual TNs are looked up within a tenant, by pool or not
+    _drop_index(conn, 'virtual_tn',
+                'ix_virtual_tn_pool_session_id_released_at')
+    _create_index(conn, 'virtual_tn',
+                  'ix_virtual_tn_tenant_id_session_id_released_at')
+    _create_index(conn, 'virtual_tn',
+                  'ix_virtual_tn_tenant_id_pool_session_id_released_at')
+    _create_index(conn, 'session', 'ix_session_tenant_id_expiry_date')
+
+
+def add_session_participants(conn):
+    # The session_participant table itself is created by create_all. Each
+    # existing session is mapped from both of its participants.
+    sessions = Base.metadata.tables['session'].c
+    participants = Base.metadata.tables['session_participant']
+    columns = ['participant', 'tenant_id', 'session_id', 'expiry_date']
+    conn.execute(participants.insert().from_select(columns, select(
+        [sessions.participant_a, sessions.tenant_id, sessions.id,
+         sessions.expiry_date]).where(sessions.participant_a.isnot(None))))
+    conn.execute(participants.insert().from_select(columns, select(
+        [sessions.participant_b, sessions.tenant_id, sessions.id,
+         sessions.expiry_date]).where(and_(
+            sessions.participant_b.isnot(None),
+            or_(sessions.participant_a.is_(None),
+                sessions.participant_b != sessions.participant_a)))))
+
+
+def add_inbound_message_status(conn):
+    # Messages recorded before their status was tracked were forwarded
+    columns = Base.metadata.tables['inbound_message'].c
+    _add_column(conn, 'inbound_message', columns.status)
+    conn.execute(Base.metadata.tables['inbound_message'].update().where(
+        columns.status.is_(None)).values(status='done'))
+
+
+# (version, description, migration) in the order they are applied. Each
+# migration must be safe to run against a database that already has its
+# changes, as databases created by create_all do.
+MIGRATIONS = [
+    (1, 'Add virtual_tn.released_at', add_virtual_tn_released_at),
+    (2, 'Index session expiry date and participants', add_session_indexes),
+    (3, 'Add virtual_tn.pool', add_virtual_tn_pool),
+    (4, 'Add tenants', add_tenants),
+    (5, 'Add session participants', add_session_participants),
+    (6, 'Add inbound_message.status', add_inbound_message_status),
+]
+
+
+def applied_versions(conn):
+    return set(row[0] for row in conn.execute(
+        schema_version.select().with_only_columns([schema_version.c.version])))
+
+
+def upgrade(engine):
+    """
+    Brings the schema of an existing database up to date with the models,
+    applying each migration that has not been applied yet in its own
+    transaction. Returns the versions that were applied.
+    """
+    Base.metadata.create_all(bind=engine)
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        with engine.connect() as conn:
+            if version in applied_versions(conn):
+                continue
+            try:
+                with conn.begin():
+                    migration(conn)
+                    conn.execute(schema_version.insert().values(
+                        version=version, description=description,
+                        applied_at=datetime.utcnow()))
+            except (IntegrityError, OperationalError, ProgrammingError):
+                # Another process may have applied it at the same time
+                if version not in applied_versions(conn):
+                    raise
+            else:
+                log.info({"message": "Applied migration {}: {}".format(
+                    version, description)})
+                applied.append(version)
+    return applied
+
+
+def main():
+    from sms_proxy.database import engine
+    upgrade(engine)
+
+
+if __name__ == "__main__":
+    main()
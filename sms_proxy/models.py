@@ -1,12 +1,54 @@
+import random
+import time
 import uuid
+from collections import namedtuple, OrderedDict
 from datetime import datetime, timedelta
 
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import (Column, Integer, Float, String, DateTime, Text, Index,
+                        or_, and_, func, case, bindparam)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
-from sms_proxy.database import Base, db_session
+from sms_proxy.settings import (TN_ALLOCATION_POLICY, TN_CLAIM_ATTEMPTS,
+                                TN_RANDOM_SAMPLE, EXPORT_BATCH_SIZE,
+                                BULK_BATCH_SIZE, TN_DEFAULT_POOL,
+                                TN_POOL_BY_AREA_CODE, DEFAULT_TENANT,
+                                INBOUND_PROCESSING_TIMEOUT)
+from sms_proxy.cache import routing_cache, tn_tenant_cache
+from sms_proxy.database import Base, db_session, supports_skip_locked
 from sms_proxy.log import log
 
+EXPIRY_CHUNK_SIZE = 500
+
+
+def default_pool(value):
+    """
+    Returns the pool a virtual TN joins when added without one: the area
+    code of a 1NPANXXXXXX number with TN_POOL_BY_AREA_CODE on, otherwise
+    TN_DEFAULT_POOL.
+    """
+    if TN_POOL_BY_AREA_CODE and len(value) == 11 and value.startswith('1'):
+        return value[1:4]
+    return TN_DEFAULT_POOL
+
+
+def _has_expired(expiry_date, now=None):
+    if expiry_date is None:
+        return False
+    return expiry_date <= (now or datetime.utcnow())
+
+
+class Route(namedtuple('Route', ['participant_a', 'participant_b',
+                                 'session_id', 'expiry_date'])):
+    """
+    The participants, id and expiry date of the session a virtual TN is
+    assigned to, as held by the routing cache.
+    """
+    __slots__ = ()
+
+    def is_expired(self, now=None):
+        return _has_expired(self.expiry_date, now)
+
 
 class VirtualTN(Base):
     """
@@ -16,6 +58,14 @@ class VirtualTN(Base):
         The value of the virtual TN, (1NPANXXXXXX format)
     session_id (str):
         The session_id, if any, for which this virtual TN is assigned to.
+    pool (str):
+        The pool the virtual TN is allocated from, e.g. its area code or
+        region
+    tenant_id (str):
+        The id of the tenant the virtual TN belongs to
+    released_at (timestamp):
+        The timestamp, in UTC, of when the virtual TN was last released
+        from a session, if ever
     """
     @classmethod
     def get_next_available(cls):
@@ -28,14 +78,290 @@ class VirtualTN(Base):
         except NoResultFound:
             return None
 
+    @classmethod
+    def claim(cls, session_id, policy=TN_ALLOCATION_POLICY, pools=None,
+              tenant_id=DEFAULT_TENANT):
+        """
+        Assigns a virtual TN that does not already have a session attached
+        to it to the session, and returns its value, otherwise returns None.
+        The assignment only succeeds if the virtual TN is still free, so
+        concurrent claims never assign the same virtual TN twice. The
+        'policy' decides which free virtual TN is claimed:
+            'first': whichever free virtual TN the index yields first
+            'lru': the virtual TN that has been free for the longest
+            'random': one of the first TN_RANDOM_SAMPLE free virtual TNs
+        The virtual TN is claimed from the first of 'pools' with a free
+        one, where a pool of None stands for any pool. Without 'pools' it
+        is claimed from any pool. Only virtual TNs of the tenant are
+        claimed. The caller is responsible for committing the assignment.
+        """
+        return cls.claim_many([session_id], policy, pools, tenant_id)[0]
+
+    @classmethod
+    def claim_many(cls, session_ids, policy=TN_ALLOCATION_POLICY, pools=None,
+                   tenant_id=DEFAULT_TENANT):
+        """
+        Assigns a free virtual TN to each of the sessions, as 'claim' does,
+        within the current transaction. Returns the value of the virtual TN
+        claimed for each session, in order, or None for the sessions left
+        without one once the pools are exhausted. The caller is responsible
+        for committing the assignments.
+        """
+        claimed = {}
+        pending = list(session_ids)
+        for pool in pools or [None]:
+            claimed.update(cls._claim_from(pending, policy, pool, tenant_id))
+            pending = [session_id for session_id in pending
+                       if session_id not in claimed]
+            if not pending:
+                break
+        return [claimed.get(session_id) for session_id in session_ids]
+
+    @classmethod
+    def _claim_from(cls, session_ids, policy, pool, tenant_id):
+        """
+        Claims a free virtual TN of the tenant's 'pool', or of any of its
+        pools if it is None, for as many of the sessions as there are free
+        virtual TNs, and returns the value claimed for each session that
+        got one
+        """
+        # Where the database supports it, lock the picked rows and skip rows
+        # locked by other creators, so that the claims cannot be lost
+        skip_locked = policy != 'random' and supports_skip_locked(
+            db_session.get_bind())
+        claimed = {}
+        pending = list(session_ids)
+        for attempt in range(TN_CLAIM_ATTEMPTS):
+            values = cls._pick_free(policy, skip_locked, count=len(pending),
+                                    pool=pool, tenant_id=tenant_id)
+            lost = []
+            for session_id, value in zip(pending, values):
+                if cls.query.filter_by(value=value, session_id=None).update(
+                        {cls.session_id: session_id},
+                        synchronize_session=False):
+                    claimed[session_id] = value
+                else:
+                    lost.append(session_id)
+            if not lost:
+                # Every picked virtual TN was claimed, any session still
+                # pending is left without one as the pool is exhausted
+                return claimed
+            pending = lost + pending[len(values):]
+        log.error({"message": "Could not claim a virtual TN after {} "
+                   "attempts".format(TN_CLAIM_ATTEMPTS),
+                   "status": "failed"})
+        return claimed
+
+    @classmethod
+    def listing(cls, after=None, available=None, pool=None, tenant_id=None):
+        """
+        Returns a query of (value, session_id, pool) tuples of the virtual
+        TNs whose value follows 'after', in order of value. If 'available'
+        is True only free virtual TNs are returned, if False only those
+        assigned to a session. With 'pool', only the virtual TNs of that
+        pool are returned, and with 'tenant_id' only those of that tenant.
+        """
+        virtual_tns = db_session.query(cls.value, cls.session_id, cls.pool)
+        if tenant_id is not None:
+            virtual_tns = virtual_tns.filter(cls.tenant_id == tenant_id)
+        if after is not None:
+            virtual_tns = virtual_tns.filter(cls.value > after)
+        if pool is not None:
+            virtual_tns = virtual_tns.filter(cls.pool == pool)
+        if available is True:
+            virtual_tns = virtual_tns.filter(cls.session_id.is_(None))
+        elif available is False:
+            virtual_tns = virtual_tns.filter(cls.session_id.isnot(None))
+        return virtual_tns.order_by(cls.value)
+
+    @classmethod
+    def page(cls, limit, **filters):
+        """
+        Returns the first 'limit' tuples of the 'listing' query
+        """
+        return cls.listing(**filters).limit(limit).all()
+
+    @classmethod
+    def export(cls, batch_size=EXPORT_BATCH_SIZE, **filters):
+        """
+        Iterates over every tuple of the 'listing' query, fetching
+        'batch_size' rows at a time, from a server side cursor where the
+        database supports one
+        """
+        return cls.listing(**filters).yield_per(batch_size)
+
+    @classmethod
+    def pool_counts(cls, tenant_id=None):
+        """
+        Returns a (pool, virtual TNs, virtual TNs assigned to a session)
+        tuple for each pool, of the tenant if given, in order of pool
+        """
+        counts = db_session.query(cls.pool, func.count(cls.value),
+                                  func.count(cls.session_id))
+        if tenant_id is not None:
+            counts = counts.filter(cls.tenant_id == tenant_id)
+        return [tuple(row) for row in
+                counts.group_by(cls.pool).order_by(cls.pool)]
+
+    @classmethod
+    def pool_of(cls, value):
+        """
+        Returns the pool of the virtual TN, or None if it does not exist
+        """
+        return db_session.query(cls.pool).filter_by(value=value).scalar()
+
+    @classmethod
+    def tenant_of(cls, value):
+        """
+        Returns the id of the tenant the virtual TN belongs to, from the
+        cache if possible, or None if it does not exist
+        """
+        tenant_id = tn_tenant_cache.get(value)
+        if tenant_id is None:
+            tenant_id = db_session.query(cls.tenant_id).filter_by(
+                value=value).scalar()
+            if tenant_id is not None:
+                tn_tenant_cache.set(value, tenant_id)
+        return tenant_id
+
+    @classmethod
+    def add_many(cls, values, batch_size=BULK_BATCH_SIZE, pool=None,
+                 tenant_id=DEFAULT_TENANT):
+        """
+        Adds the virtual TNs to the tenant's 'pool', or each to its
+        'default_pool', inserting 'batch_size' of them per transaction with
+        a single executemany. Returns a (value, result) tuple for each
+        value, in order, where result is 'added', or 'duplicate' if the
+        value is already in the pool.
+        """
+        new_values = list(OrderedDict.fromkeys(values))
+        duplicates = set()
+        for i in range(0, len(new_values), batch_size):
+            batch = new_values[i:i + batch_size]
+            while True:
+                existing = set(value for value, in db_session.query(
+                    cls.value).filter(cls.value.in_(batch)))
+                rows = [{'value': value, 'session_id': None,
+                         'pool': pool or default_pool(value),
+                         'tenant_id': tenant_id}
+                        for value in batch if value not in existing]
+                try:
+                    if rows:
+                        db_session.execute(cls.__table__.insert(), rows)
+                    db_session.commit()
+                except IntegrityError:
+                    # Another request added some of the batch since it was
+                    # read, find out which and try again
+                    db_session.rollback()
+                    continue
+                break
+            duplicates.update(existing)
+        return cls._per_item(values, lambda value: (
+            'duplicate' if value in duplicates else 'added'), 'duplicate')
+
+    @classmethod
+    def remove_many(cls, values, batch_size=BULK_BATCH_SIZE, tenant_id=None):
+        """
+        Removes the virtual TNs from the pool, deleting 'batch_size' of them
+        per transaction with a single executemany. A virtual TN held by an
+        expired session is released first. Returns a (value, result) tuple
+        for each value, in order, where result is 'removed', 'in_use' if
+        an active session holds the virtual TN, or 'not_found', as it is
+        for virtual TNs of another tenant than 'tenant_id', if given.
+        """
+        results = dict((value, 'not_found') for value in values)
+        unique_values = list(OrderedDict.fromkeys(values))
+        table = cls.__table__
+        delete = table.delete().where(
+            (table.c.value == bindparam('tn')) &
+            (table.c.session_id.is_(None)))
+        for i in range(0, len(unique_values), batch_size):
+            batch = unique_values[i:i + batch_size]
+            found = db_session.query(cls.value, cls.session_id).filter(
+                cls.value.in_(batch))
+            if tenant_id is not None:
+                found = found.filter(cls.tenant_id == tenant_id)
+            found = found.all()
+            if not found:
+                continue
+            found_values = [value for value, _ in found]
+            in_use = [value for value, session_id in found if session_id]
+            released = (ProxySession.release_expired(in_use)
+                        if in_use else [])
+            db_session.execute(delete, [{'tn': value}
+                                        for value in found_values])
+            for value in found_values:
+                results[value] = 'removed'
+            # Virtual TNs held by an active session, or claimed since they
+            # were read, are left in the pool
+            for value, in db_session.query(cls.value).filter(
+                    cls.value.in_(found_values)):
+                results[value] = 'in_use'
+            db_session.commit()
+            for value in released:
+                routing_cache.invalidate(value)
+            for value in found_values:
+                tn_tenant_cache.invalidate(value)
+        return cls._per_item(values, results.get, 'not_found')
+
+    @staticmethod
+    def _per_item(values, result, repeated):
+        """
+        Returns a (value, result) tuple for each value, in order, with the
+        'repeated' result for values that appear more than once
+        """
+        seen = set()
+        results = []
+        for value in values:
+            results.append((value, repeated if value in seen
+                            else result(value)))
+            seen.add(value)
+        return results
+
+    @classmethod
+    def _pick_free(cls, policy, skip_locked=False, count=1, pool=None,
+                   tenant_id=DEFAULT_TENANT):
+        """
+        Returns the values of up to 'count' free virtual TNs of the tenant,
+        of 'pool' if given
+        """
+        free = db_session.query(cls.value).filter_by(session_id=None,
+                                                     tenant_id=tenant_id)
+        if pool is not None:
+            # Answered from the pool's own range of the free list index, so
+            # the cost does not grow with the other pools
+            free = free.filter(cls.pool == pool)
+        if policy == 'lru':
+            free = free.order_by(cls.released_at)
+        if policy == 'random':
+            values = [value for value, in free.limit(
+                max(count, TN_RANDOM_SAMPLE))]
+            return random.sample(values, min(count, len(values)))
+        if skip_locked:
+            free = free.suffix_with('FOR UPDATE SKIP LOCKED')
+        return [value for value, in free.limit(count)]
+
     __tablename__ = 'virtual_tn'
+    __table_args__ = (
+        Index('ix_virtual_tn_session_id_released_at',
+              'session_id', 'released_at'),
+        Index('ix_virtual_tn_tenant_id_session_id_released_at',
+              'tenant_id', 'session_id', 'released_at'),
+        Index('ix_virtual_tn_tenant_id_pool_session_id_released_at',
+              'tenant_id', 'pool', 'session_id', 'released_at'),
+    )
     id = Column(Integer)
     value = Column(String(18), primary_key=True)
     session_id = Column(String(40))
+    pool = Column(String(32))
+    tenant_id = Column(String(32))
+    released_at = Column(DateTime, nullable=True)
 
-    def __init__(self, value):
+    def __init__(self, value, pool=None, tenant_id=None):
         self.value = value
         self.session_id = None
+        self.pool = pool or default_pool(value)
+        self.tenant_id = tenant_id or DEFAULT_TENANT
 
 
 class ProxySession(Base):
@@ -54,21 +380,95 @@ class ProxySession(Base):
         The timestamp of when this session should expire.  If a time, in
         minutes, is not provided when creating the session, the
         DEFAULT_EXPIRATION in settings is used
+    tenant_id (str):
+        The id of the tenant the session belongs to
     """
     @classmethod
-    def clean_expired(cls):
+    def clean_expired(cls, limit=None, tenant_id=None, pools=None):
         """
-        Removes sessions that have an expiry date in the past and releases
-        the corresponding virtual TN back to the pool
+        Removes sessions, of the tenant if given, that have an expiry date
+        in the past and releases the corresponding virtual TN back to the
+        pool. Given 'pools', only the sessions holding a virtual TN of one
+        of them are removed, unless they include None, for any pool. At
+        most 'limit' sessions, oldest expiry first, are removed. The
+        virtual TNs are
+        released, and the sessions deleted, with set based statements in a
+        single transaction. Returns a (session_id, participant_a,
+        participant_b, virtual_tn) tuple for each removed session.
         """
         current_timestamp = datetime.utcnow()
-        try:
-            expired_sessions = db_session.query(ProxySession).filter(
-                ProxySession.expiry_date <= current_timestamp)
-        except NoResultFound:
-            return
-        for session in expired_sessions:
-            cls.terminate(session.id)
+        expired_sessions = db_session.query(
+            ProxySession.id,
+            ProxySession.participant_a,
+            ProxySession.participant_b,
+            ProxySession.virtual_TN).filter(
+            ProxySession.expiry_date <= current_timestamp)
+        if tenant_id is not None:
+            expired_sessions = expired_sessions.filter(
+                ProxySession.tenant_id == tenant_id)
+        if pools is not None and None not in pools:
+            expired_sessions = expired_sessions.join(
+                VirtualTN, VirtualTN.value == ProxySession.virtual_TN).filter(
+                VirtualTN.pool.in_(pools))
+            if tenant_id is not None:
+                expired_sessions = expired_sessions.filter(
+                    VirtualTN.tenant_id == tenant_id)
+        expired_sessions = expired_sessions.order_by(ProxySession.expiry_date)
+        if limit is not None:
+            expired_sessions = expired_sessions.limit(limit)
+        expired = [tuple(row) for row in expired_sessions.all()]
+        # Stay under the bound parameter limit of SQLite
+        for i in range(0, len(expired), EXPIRY_CHUNK_SIZE):
+            session_ids = [row[0] for row in expired[i:i + EXPIRY_CHUNK_SIZE]]
+            VirtualTN.query.filter(
+                VirtualTN.session_id.in_(session_ids)).update(
+                {VirtualTN.session_id: None,
+                 VirtualTN.released_at: current_timestamp},
+                synchronize_session=False)
+            cls.query.filter(cls.id.in_(session_ids)).delete(
+                synchronize_session=False)
+            SessionParticipant.remove(session_ids)
+        db_session.commit()
+        for row in expired:
+            routing_cache.invalidate(row[3])
+        return expired
+
+    @classmethod
+    def release_expired(cls, virtual_tns, now=None):
+        """
+        Deletes the expired sessions holding any of the virtual TNs, and
+        releases those virtual TNs, without committing. Returns the values
+        of the released virtual TNs.
+        """
+        now = now or datetime.utcnow()
+        expired = db_session.query(cls.id, cls.virtual_TN).filter(
+            cls.virtual_TN.in_(virtual_tns),
+            cls.expiry_date <= now).all()
+        if not expired:
+            return []
+        session_ids = [session_id for session_id, _ in expired]
+        VirtualTN.query.filter(VirtualTN.session_id.in_(session_ids)).update(
+            {VirtualTN.session_id: None, VirtualTN.released_at: now},
+            synchronize_session=False)
+        cls.query.filter(cls.id.in_(session_ids)).delete(
+            synchronize_session=False)
+        SessionParticipant.remove(session_ids)
+        return [virtual_tn for _, virtual_tn in expired]
+
+    @classmethod
+    def discard(cls, session_ids):
+        """
+        Deletes sessions that never started, and returns their virtual TNs
+        to the pool as they were, in a single transaction
+        """
+        for i in range(0, len(session_ids), EXPIRY_CHUNK_SIZE):
+            chunk = session_ids[i:i + EXPIRY_CHUNK_SIZE]
+            VirtualTN.query.filter(VirtualTN.session_id.in_(chunk)).update(
+                {VirtualTN.session_id: None}, synchronize_session=False)
+            cls.query.filter(cls.id.in_(chunk)).delete(
+                synchronize_session=False)
+            SessionParticipant.remove(chunk)
+        db_session.commit()
 
     @classmethod
     def terminate(cls, session_id):
@@ -80,53 +480,603 @@ class ProxySession(Base):
         participant_b = session.participant_b
         virtual_tn = VirtualTN.query.filter_by(session_id=session_id).one()
         virtual_tn.session_id = None
-        db_session.commit()
+        virtual_tn.released_at = datetime.utcnow()
+        # Release the virtual TN and delete the session in one transaction,
+        # so the virtual TN cannot be claimed while the session still holds it
         db_session.delete(session)
+        SessionParticipant.remove([session_id])
         db_session.commit()
+        routing_cache.invalidate(virtual_tn.value)
         return participant_a, participant_b, virtual_tn
 
+    @classmethod
+    def listing(cls, after=None, participant=None, expires_before=None,
+                tenant_id=None):
+        """
+        Returns a query of (id, date_created, virtual_TN, participant_a,
+        participant_b, expiry_date) tuples of the sessions whose id follows
+        'after', in order of id, optionally only those 'participant' takes
+        part in, that expire before 'expires_before', or of 'tenant_id'.
+        """
+        sessions = cls._filter(
+            db_session.query(cls.id, cls.date_created, cls.virtual_TN,
+                             cls.participant_a, cls.participant_b,
+                             cls.expiry_date),
+            participant, expires_before, tenant_id)
+        if after is not None:
+            sessions = sessions.filter(cls.id > after)
+        return sessions.order_by(cls.id)
+
+    @classmethod
+    def page(cls, limit, **filters):
+        """
+        Returns the first 'limit' tuples of the 'listing' query
+        """
+        return cls.listing(**filters).limit(limit).all()
+
+    @classmethod
+    def export(cls, batch_size=EXPORT_BATCH_SIZE, **filters):
+        """
+        Iterates over every tuple of the 'listing' query, fetching
+        'batch_size' rows at a time, from a server side cursor where the
+        database supports one
+        """
+        return cls.listing(**filters).yield_per(batch_size)
+
+    @classmethod
+    def count(cls, participant=None, expires_before=None, tenant_id=None):
+        """
+        Returns the number of sessions matching the filters of 'page'
+        """
+        return cls._filter(db_session.query(func.count(cls.id)),
+                           participant, expires_before, tenant_id).scalar()
+
+    @classmethod
+    def count_active(cls, tenant_id, now=None):
+        """
+        Returns the number of the tenant's sessions that have not expired,
+        counted over the tenant's range of the tenant and expiry date index
+        """
+        now = now or datetime.utcnow()
+        return db_session.query(func.count(cls.id)).filter(
+            cls.tenant_id == tenant_id,
+            or_(cls.expiry_date.is_(None), cls.expiry_date > now)).scalar()
+
+    @classmethod
+    def count_expiring(cls, within, now=None, tenant_id=None):
+        """
+        Returns the number of sessions, of the tenant if given, that have
+        expired but not yet been removed, and the number that will expire
+        in the next 'within' minutes, with a single aggregate over the
+        expiry date index
+        """
+        now = now or datetime.utcnow()
+        expiring = db_session.query(
+            func.sum(case([(cls.expiry_date <= now, 1)], else_=0)),
+            func.count(cls.id)).filter(
+            cls.expiry_date <= now + timedelta(minutes=within))
+        if tenant_id is not None:
+            expiring = expiring.filter(cls.tenant_id == tenant_id)
+        expired, expiring = expiring.one()
+        expired = expired or 0
+        return expired, expiring - expired
+
+    @classmethod
+    def _filter(cls, sessions, participant, expires_before, tenant_id=None):
+        if tenant_id is not None:
+            sessions = sessions.filter(cls.tenant_id == tenant_id)
+        if participant is not None:
+            sessions = sessions.filter(or_(cls.participant_a == participant,
+                                           cls.participant_b == participant))
+        if expires_before is not None:
+            sessions = sessions.filter(cls.expiry_date < expires_before)
+        return sessions
+
+    def is_expired(self, now=None):
+        """
+        Returns True if this session has an expiry date that has passed
+        """
+        return _has_expired(self.expiry_date, now)
+
+    @classmethod
+    def get_route(cls, virtual_tn):
+        """
+        Returns the Route of the session the virtual TN is assigned to,
+        from the routing cache if possible, otherwise None. A cached route
+        is only used while its session exists, so sessions ended or expired
+        by another process are not routed to.
+        """
+        route = routing_cache.get(virtual_tn)
+        if route is not None and not cls.exists(route.session_id):
+            routing_cache.invalidate(virtual_tn)
+            route = None
+        if route is None:
+            route = cls.load_route(virtual_tn)
+        return route
+
+    @classmethod
+    def exists(cls, session_id):
+        """
+        Returns True if the session has not been removed, looked up in the
+        primary key index alone
+        """
+        return db_session.query(cls.id).filter(
+            cls.id == session_id).first() is not None
+
+    @classmethod
+    def load_route(cls, virtual_tn):
+        """
+        Reads the Route of the session the virtual TN is assigned to from
+        the database, and caches it. Returns None if there is no session.
+        """
+        try:
+            session = cls.query.filter_by(virtual_TN=virtual_tn).one()
+        except NoResultFound:
+            routing_cache.invalidate(virtual_tn)
+            return None
+        route = Route(session.participant_a, session.participant_b,
+                      session.id, session.expiry_date)
+        routing_cache.set(virtual_tn, route)
+        return route
+
     @classmethod
     def get_other_participant(cls, virtual_tn, sender):
         """
         Returns the 2nd particpant and session when given the virtual TN
         and the first participant
         """
-        session = None
-        try:
-            session = ProxySession.query.filter_by(virtual_TN=virtual_tn).one()
-        except NoResultFound:
-                msg = ("A session with virtual TN '{}'"
-                       " could not be found").format(virtual_tn)
-                log.info({"message": msg})
-                return None, None
-        if session:
-            participant_a = session.participant_a
-            participant_b = session.participant_b
-            if participant_a == sender:
-                return participant_b, session.id
-            elif participant_b == sender:
-                return participant_a, session.id
-            else:
-                msg = ("{} is not a participant of session {}").format(
-                    sender,
-                    session.id)
-                log.info({"message": msg})
-                return None, None
+        route = cls.get_route(virtual_tn)
+        if route is not None and sender not in (route.participant_a,
+                                                route.participant_b):
+            # The cached route may belong to a session that has since been
+            # replaced by another process
+            route = cls.load_route(virtual_tn)
+        if route is None:
+            msg = ("A session with virtual TN '{}'"
+                   " could not be found").format(virtual_tn)
+            log.info({"message": msg})
+            return None, None
+        if route.is_expired():
+            msg = ("Session {} with virtual TN '{}' has expired").format(
+                route.session_id, virtual_tn)
+            log.info({"message": msg})
+            return None, None
+        if route.participant_a == sender:
+            return route.participant_b, route.session_id
+        elif route.participant_b == sender:
+            return route.participant_a, route.session_id
+        else:
+            msg = ("{} is not a participant of session {}").format(
+                sender,
+                route.session_id)
+            log.info({"message": msg})
+            return None, None
 
     __tablename__ = 'session'
+    __table_args__ = (
+        Index('ix_session_expiry_date', 'expiry_date'),
+        Index('ix_session_participants', 'participant_a', 'participant_b'),
+        Index('ix_session_tenant_id_expiry_date', 'tenant_id', 'expiry_date'),
+    )
     id = Column(String(40), primary_key=True)
     date_created = Column(DateTime)
     virtual_TN = Column(String(18), unique=True)
     participant_a = Column(String(18))
     participant_b = Column(String(18))
     expiry_date = Column(DateTime, nullable=True)
+    tenant_id = Column(String(32))
 
     def __init__(self, virtual_TN, participant_A,
-                 participant_B, expiry_window=None):
+                 participant_B, expiry_window=None, tenant_id=None):
         self.id = uuid.uuid4().hex
+        self.tenant_id = tenant_id or DEFAULT_TENANT
         self.date_created = datetime.utcnow()
         self.virtual_TN = virtual_TN
         self.participant_a = participant_A
         self.participant_b = participant_B
         self.expiry_date = self.date_created + timedelta(
             minutes=expiry_window) if expiry_window else None
+
+
+class SessionParticipant(Base):
+    """
+    participant (str):
+        The phone number of a participant of the session
+    tenant_id (str):
+        The id of the tenant the session belongs to
+    session_id (str):
+        The id of the session the phone number takes part in
+    expiry_date (timestamp):
+        The expiry date of the session
+
+    The sessions each phone number takes part in, on either side, kept
+    alongside the sessions they map, so the sessions of a phone number are
+    a range of the primary key rather than a scan of the session table.
+    """
+    __tablename__ = 'session_participant'
+    __table_args__ = (
+        Index('ix_session_participant_session_id', 'session_id'),
+    )
+    participant = Column(String(18), primary_key=True)
+    tenant_id = Column(String(32), primary_key=True)
+    session_id = Column(String(40), primary_key=True)
+    expiry_date = Column(DateTime, nullable=True)
+
+    def __init__(self, participant, session):
+        self.participant = participant
+        self.tenant_id = session.tenant_id
+        self.session_id = session.id
+        self.expiry_date = session.expiry_date
+
+    @classmethod
+    def of(cls, session):
+        """
+        Returns the rows mapping each of the session's participants to it
+        """
+        participants = OrderedDict.fromkeys(
+            [session.participant_a, session.participant_b])
+        return [cls(participant, session) for participant in participants
+                if participant is not None]
+
+    @classmethod
+    def sessions(cls, participant, tenant_id, limit, after=None):
+        """
+        Returns the first 'limit' of the tenant's sessions the phone number
+        takes part in, whose id follows 'after', in order of id, as the
+        tuples of ProxySession.listing. Answered from the participant's
+        range of the primary key, joined to the sessions by id.
+        """
+        sessions = db_session.query(
+            ProxySession.id, ProxySession.date_created,
+            ProxySession.virtual_TN, ProxySession.participant_a,
+            ProxySession.participant_b, ProxySession.expiry_date).join(
+            cls, cls.session_id == ProxySession.id).filter(
+            cls.participant == participant, cls.tenant_id == tenant_id)
+        if after is not None:
+            sessions = sessions.filter(cls.session_id > after)
+        return sessions.order_by(cls.session_id).limit(limit).all()
+
+    @classmethod
+    def count(cls, participant, tenant_id):
+        """
+        Returns the number of the tenant's sessions the phone number takes
+        part in
+        """
+        return db_session.query(func.count(cls.session_id)).filter(
+            cls.participant == participant,
+            cls.tenant_id == tenant_id).scalar()
+
+    @classmethod
+    def count_active(cls, participants, tenant_id, now=None):
+        """
+        Returns the number of the tenant's sessions that have not expired
+        each of the phone numbers takes part in, counted over their ranges
+        of the primary key
+        """
+        now = now or datetime.utcnow()
+        counts = dict((participant, 0) for participant in participants)
+        if not counts:
+            return counts
+        for participant, count in db_session.query(
+                cls.participant, func.count(cls.session_id)).filter(
+                cls.participant.in_(list(counts)),
+                cls.tenant_id == tenant_id,
+                or_(cls.expiry_date.is_(None),
+                    cls.expiry_date > now)).group_by(cls.participant):
+            counts[participant] = count
+        return counts
+
+    @classmethod
+    def remove(cls, session_ids):
+        """
+        Deletes the rows of the sessions, without committing
+        """
+        for i in range(0, len(session_ids), EXPIRY_CHUNK_SIZE):
+            cls.query.filter(cls.session_id.in_(
+                session_ids[i:i + EXPIRY_CHUNK_SIZE])).delete(
+                synchronize_session=False)
+
+
+class OutboundMessage(Base):
+    """
+    id (int):
+        The identifier of the queued message, also it's primary key
+    to (str):
+        The phone number the message is sent to
+    from_tn (str):
+        The virtual TN the message is sent from
+    body (str):
+        The content of the message
+    session_id (str):
+        The session_id, if any, the message was sent for
+    status (str):
+        'pending' until the message is sent, or 'failed' once it has run
+        out of attempts
+    attempts (int):
+        The number of times sending the message has been attempted
+    created_at (timestamp):
+        The timestamp, in UTC, of when the message was queued
+    next_attempt_at (timestamp):
+        The timestamp, in UTC, before which the message will not be claimed
+        by a dispatcher worker
+    claim_token (str):
+        The token of the dispatcher worker that last claimed the message
+    tenant_id (str):
+        The id of the tenant whose credentials the message is sent with
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    to = Column(String(18))
+    from_tn = Column(String(18))
+    body = Column(Text)
+    session_id = Column(String(40), nullable=True)
+    status = Column(String(10))
+    attempts = Column(Integer)
+    created_at = Column(DateTime)
+    next_attempt_at = Column(DateTime)
+    claim_token = Column(String(32), nullable=True)
+    tenant_id = Column(String(32))
+
+    def __init__(self, to, from_tn, body, session_id=None, tenant_id=None):
+        self.tenant_id = tenant_id or DEFAULT_TENANT
+        self.to = to
+        self.from_tn = from_tn
+        self.body = body
+        self.session_id = session_id
+        self.status = 'pending'
+        self.attempts = 0
+        self.created_at = datetime.utcnow()
+        self.next_attempt_at = self.created_at
+
+
+class InboundMessage(Base):
+    """
+    key (str):
+        The key of an inbound message delivered by Flowroute, its message id
+        or a hash of its content
+    received_at (timestamp):
+        The timestamp, in UTC, of when the message was first delivered
+    status (str):
+        'processing' while the message is being forwarded, and 'done' once
+        it has been
+    """
+    PROCESSING = 'processing'
+    DONE = 'done'
+
+    __tablename__ = 'inbound_message'
+    __table_args__ = (
+        Index('ix_inbound_message_received_at', 'received_at'),
+    )
+    key = Column(String(64), primary_key=True)
+    received_at = Column(DateTime)
+    status = Column(String(10))
+
+    @classmethod
+    def record(cls, key, window, now=None,
+               processing_timeout=INBOUND_PROCESSING_TIMEOUT):
+        """
+        Records the delivery of the message with 'key' as processing.
+        Returns None if this is its first delivery, otherwise the status of
+        the delivery within the last 'window' seconds that was recorded
+        first. An earlier delivery outside of the window, or one still
+        processing after 'processing_timeout' seconds, is replaced.
+        """
+        now = now or datetime.utcnow()
+        try:
+            db_session.execute(cls.__table__.insert(),
+                               {'key': key, 'received_at': now,
+                                'status': cls.PROCESSING})
+            db_session.commit()
+            return None
+        except IntegrityError:
+            db_session.rollback()
+        renewed = cls.query.filter(
+            cls.key == key,
+            or_(cls.received_at <= now - timedelta(seconds=window),
+                and_(cls.status == cls.PROCESSING,
+                     cls.received_at <= now - timedelta(
+                         seconds=processing_timeout)))).update(
+            {cls.received_at: now, cls.status: cls.PROCESSING},
+            synchronize_session=False)
+        db_session.commit()
+        if renewed == 1:
+            return None
+        # A record removed in the meantime was of a delivery that failed,
+        # which is retried
+        return db_session.query(cls.status).filter(
+            cls.key == key).scalar() or cls.PROCESSING
+
+    @classmethod
+    def complete(cls, key):
+        """
+        Marks the message with 'key' as forwarded
+        """
+        cls.query.filter_by(key=key).update({cls.status: cls.DONE},
+                                            synchronize_session=False)
+        db_session.commit()
+
+    @classmethod
+    def forget(cls, key):
+        """
+        Removes the record of the message with 'key', so that its next
+        delivery is processed
+        """
+        cls.query.filter_by(key=key).delete(synchronize_session=False)
+        db_session.commit()
+
+    @classmethod
+    def prune(cls, before):
+        """
+        Removes the records of messages first delivered before 'before',
+        returning the number removed
+        """
+        removed = cls.query.filter(cls.received_at < before).delete(
+            synchronize_session=False)
+        db_session.commit()
+        return removed
+
+
+class RateLimitBucket(Base):
+    """
+    key (str):
+        The virtual TN the bucket limits the messages of, or '*' for the
+        bucket shared by every message
+    tat (float):
+        The theoretical arrival time, in seconds since the epoch, of the next
+        message were messages sent at exactly the limit. The bucket is full
+        when it is in the past.
+    """
+    __tablename__ = 'rate_limit_bucket'
+    key = Column(String(18), primary_key=True)
+    # Double precision, as epoch seconds lose whole seconds in a float32
+    tat = Column(Float(53))
+
+    @classmethod
+    def reserve(cls, key, rate, burst, count=1, now=None):
+        """
+        Takes 'count' tokens from the bucket of 'key', which holds up to
+        'burst' tokens and is refilled at 'rate' tokens per second, and
+        returns how long, in seconds, to wait before sending the messages
+        they are taken for. Tokens are taken even when the bucket is short
+        of them, so that messages waiting on the bucket are sent in turn.
+        """
+        now = time.time() if now is None else now
+        interval = 1.0 / rate
+        cost = count * interval
+        # A single conditional UPDATE, so that concurrent reservations from
+        # other processes are serialised by the database
+        updated = cls.query.filter_by(key=key).update(
+            {cls.tat: case([(cls.tat > now, cls.tat)], else_=now) + cost},
+            synchronize_session=False)
+        if not updated:
+            try:
+                db_session.execute(cls.__table__.insert(),
+                                   {'key': key, 'tat': now + cost})
+            except IntegrityError:
+                db_session.rollback()
+                return cls.reserve(key, rate, burst, count, now)
+        tat = db_session.query(cls.tat).filter_by(key=key).scalar()
+        db_session.commit()
+        return max(0.0, tat - burst * interval - now)
+
+
+class Tenant(Base):
+    """
+    id (str):
+        The identifier of the tenant, passed in the X-Tenant header
+    org_name (str):
+        The name system messages are prefixed with, ORG_NAME if not set
+    flowroute_access_key (str):
+        The access key of the tenant's Flowroute account, if it has its own
+    flowroute_secret_key (str):
+        The secret key of the tenant's Flowroute account
+    session_start_msg, session_end_msg, no_session_msg (str):
+        The tenant's system messages, those in settings if not set
+    max_sessions (int):
+        The most sessions the tenant may have active at once, if limited
+    created_at (timestamp):
+        The timestamp, in UTC, of when the tenant was created
+    """
+    __tablename__ = 'tenant'
+    id = Column(String(32), primary_key=True)
+    org_name = Column(String(80), nullable=True)
+    flowroute_access_key = Column(String(64), nullable=True)
+    flowroute_secret_key = Column(String(64), nullable=True)
+    session_start_msg = Column(Text, nullable=True)
+    session_end_msg = Column(Text, nullable=True)
+    no_session_msg = Column(Text, nullable=True)
+    max_sessions = Column(Integer, nullable=True)
+    created_at = Column(DateTime)
+
+    def __init__(self, id):
+        self.id = id
+        self.created_at = datetime.utcnow()
+
+    @classmethod
+    def lock(cls, tenant_id):
+        """
+        Locks the tenant's row, if it is stored, until the transaction ends,
+        on the databases that lock rows
+        """
+        cls.query.filter_by(id=tenant_id).with_for_update().first()
+
+
+class MessageEvent(Base):
+    """
+    id (int):
+        The identifier of the event, also it's primary key
+    session_id (str):
+        The session_id, if any, the message was sent or received for
+    tenant_id (str):
+        The id of the tenant the message belongs to
+    direction (str):
+        'inbound' for a message received from Flowroute, 'outbound' for one
+        sent through it
+    status (str):
+        'received', 'sent', 'queued' in the outbox, or 'failed'
+    from_number (str):
+        The phone number, or virtual TN, the message was sent from
+    to_number (str):
+        The phone number, or virtual TN, the message was sent to
+    body (str):
+        The content of the message
+    created_at (timestamp):
+        The timestamp, in UTC, of when the message was received or sent
+    """
+    __tablename__ = 'message_event'
+    __table_args__ = (
+        Index('ix_message_event_session_id_created_at',
+              'session_id', 'created_at'),
+        Index('ix_message_event_created_at', 'created_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String(40), nullable=True)
+    tenant_id = Column(String(32))
+    direction = Column(String(8))
+    status = Column(String(10))
+    from_number = Column(String(18))
+    to_number = Column(String(18))
+    body = Column(Text)
+    created_at = Column(DateTime)
+
+    @classmethod
+    def page(cls, session_id, limit, after=None, tenant_id=None):
+        """
+        Returns the first 'limit' events of the session, of the tenant if
+        given, in the order they happened, following the event with id
+        'after'. Answered from the session's range of the session and
+        timestamp index.
+        """
+        events = cls.query.filter(cls.session_id == session_id)
+        if tenant_id is not None:
+            events = events.filter(cls.tenant_id == tenant_id)
+        if after is not None:
+            created_at = db_session.query(cls.created_at).filter(
+                cls.id == after).scalar()
+            if created_at is None:
+                return []
+            events = events.filter(or_(
+                cls.created_at > created_at,
+                and_(cls.created_at == created_at, cls.id > after)))
+        return events.order_by(cls.created_at, cls.id).limit(limit).all()
+
+    @classmethod
+    def oldest(cls, before, limit):
+        """
+        Returns up to 'limit' of the events that happened before 'before',
+        oldest first
+        """
+        return cls.query.filter(cls.created_at < before).order_by(
+            cls.created_at, cls.id).limit(limit).all()
+
+    @classmethod
+    def remove(cls, ids):
+        """
+        Deletes the events, without committing
+        """
+        for i in range(0, len(ids), EXPIRY_CHUNK_SIZE):
+            cls.query.filter(cls.id.in_(ids[i:i + EXPIRY_CHUNK_SIZE])).delete(
+                synchronize_session=False)
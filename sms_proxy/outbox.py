@@ -0,0 +1,290 @@
+import threading
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from FlowrouteMessagingLib.Models.Message import Message
+
+from sms_proxy.settings import (OUTBOX_BACKEND, OUTBOX_WORKERS,
+                                OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL,
+                                OUTBOX_LEASE, OUTBOX_MAX_ATTEMPTS,
+                                OUTBOX_BACKOFF, OUTBOX_MAX_BACKOFF)
+from sms_proxy.database import db_session
+from sms_proxy.log import log
+from sms_proxy.models import OutboundMessage
+
+
+OutboxItem = namedtuple('OutboxItem', ['id', 'to', 'from_tn', 'body',
+                                       'session_id', 'attempts',
+                                       'created_at', 'claim_token',
+                                       'tenant_id'])
+
+
+class OutboxBackend(object):
+    """
+    The interface of a durable queue of outbound messages. Messages are
+    claimed by dispatcher workers for a lease period, and are either
+    acknowledged once sent, scheduled for a retry, or marked as failed.
+    A message whose lease runs out before any of those happens is claimed
+    again.
+    """
+    def enqueue(self, recipients, from_tn, body, session_id=None, delay=0,
+                tenant_id=None):
+        """
+        Queues a message to each recipient, to be sent no sooner than
+        'delay' seconds from now, with the credentials of the tenant.
+        """
+        raise NotImplementedError
+
+    def claim(self, limit, lease=OUTBOX_LEASE):
+        """
+        Returns up to 'limit' OutboxItems that are due to be sent.
+        """
+        raise NotImplementedError
+
+    def ack(self, item):
+        raise NotImplementedError
+
+    def retry(self, item, delay):
+        raise NotImplementedError
+
+    def fail(self, item):
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns the number of pending and failed messages, and the age, in
+        seconds, of the oldest pending message.
+        """
+        raise NotImplementedError
+
+
+class DatabaseOutbox(OutboxBackend):
+    """
+    An outbox stored in the 'outbox' table of the application database.
+    """
+    def enqueue(self, recipients, from_tn, body, session_id=None, delay=0,
+                tenant_id=None):
+        for recipient in recipients:
+            message = OutboundMessage(recipient, from_tn, body, session_id,
+                                      tenant_id)
+            message.next_attempt_at += timedelta(seconds=delay)
+            db_session.add(message)
+        db_session.commit()
+
+    def claim(self, limit, lease=OUTBOX_LEASE):
+        now = datetime.utcnow()
+        due = db_session.query(OutboundMessage.id).filter(
+            OutboundMessage.status == 'pending',
+            OutboundMessage.next_attempt_at <= now).order_by(
+            OutboundMessage.next_attempt_at).limit(limit).all()
+        if not due:
+            return []
+        token = uuid.uuid4().hex
+        # Rows claimed by another worker since they were read no longer
+        # match, so each row is claimed by exactly one worker
+        OutboundMessage.query.filter(
+            OutboundMessage.id.in_([row[0] for row in due]),
+            OutboundMessage.status == 'pending',
+            OutboundMessage.next_attempt_at <= now).update(
+            {OutboundMessage.claim_token: token,
+             OutboundMessage.next_attempt_at: now + timedelta(seconds=lease),
+             OutboundMessage.attempts: OutboundMessage.attempts + 1},
+            synchronize_session=False)
+        db_session.commit()
+        claimed = OutboundMessage.query.filter_by(claim_token=token).all()
+        return [OutboxItem(m.id, m.to, m.from_tn, m.body, m.session_id,
+                           m.attempts, m.created_at, m.claim_token,
+                           m.tenant_id)
+                for m in claimed]
+
+    def _claimed(self, item):
+        return OutboundMessage.query.filter_by(id=item.id,
+                                               claim_token=item.claim_token)
+
+    def ack(self, item):
+        self._claimed(item).delete(synchronize_session=False)
+        db_session.commit()
+
+    def retry(self, item, delay):
+        self._claimed(item).update(
+            {OutboundMessage.claim_token: None,
+             OutboundMessage.next_attempt_at:
+             datetime.utcnow() + timedelta(seconds=delay)},
+            synchronize_session=False)
+        db_session.commit()
+
+    def fail(self, item):
+        self._claimed(item).update(
+            {OutboundMessage.claim_token: None,
+             OutboundMessage.status: 'failed'},
+            synchronize_session=False)
+        db_session.commit()
+
+    def stats(self):
+        pending, oldest = db_session.query(
+            func.count(OutboundMessage.id),
+            func.min(OutboundMessage.created_at)).filter(
+            OutboundMessage.status == 'pending').one()
+        failed = db_session.query(func.count(OutboundMessage.id)).filter(
+            OutboundMessage.status == 'failed').scalar()
+        lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+        return {"depth": pending, "failed": failed, "lag": lag}
+
+
+BACKENDS = {
+    'database': DatabaseOutbox,
+}
+
+
+def create_outbox(backend=OUTBOX_BACKEND):
+    return BACKENDS[backend]()
+
+
+def backoff(attempts):
+    """
+    Returns the delay, in seconds, before retrying a message that has been
+    attempted 'attempts' times.
+    """
+    return min(OUTBOX_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+
+
+class OutboxWorkerPool(object):
+    """
+    A pool of dispatcher threads draining an outbox through a messaging
+    controller, retrying failed sends with an exponential backoff. With a
+    TenantRegistry as 'tenants', the messages of a tenant with its own
+    Flowroute account are sent through the tenant's controller. With a
+    MessageLog as 'history', each message sent, or given up on, is recorded.
+    """
+    def __init__(self, outbox, controller, workers=OUTBOX_WORKERS,
+                 batch_size=OUTBOX_BATCH_SIZE,
+                 poll_interval=OUTBOX_POLL_INTERVAL,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, tenants=None,
+                 history=None):
+        self.outbox = outbox
+        self.controller = controller
+        self.tenants = tenants
+        self.history = history
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # The time, in seconds, between queueing and sending the most
+        # recently sent message
+        self.dispatch_lag = 0
+        self._threads = []
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        return bool(self._threads)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopped.clear()
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run,
+                                          name='outbox-worker-{}'.format(n))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def join(self):
+        for thread in self._threads:
+            # Join with a timeout, so that the main thread remains
+            # responsive to signals
+            while thread.is_alive():
+                thread.join(1)
+
+    def run_once(self):
+        """
+        Claims and sends a single batch of messages, and returns the number
+        of messages that were claimed.
+        """
+        try:
+            items = self.outbox.claim(self.batch_size)
+            for item in items:
+                self._send(item)
+            return len(items)
+        except Exception as e:
+            db_session.rollback()
+            log.error({"message": "Failed to drain the outbox",
+                       "status": "failed",
+                       "exc": str(e)})
+            return 0
+        finally:
+            db_session.remove()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self.run_once():
+                self._stopped.wait(self.poll_interval)
+
+    def _controller(self, item):
+        if self.tenants is not None and item.tenant_id is not None:
+            tenant = self.tenants.get(item.tenant_id)
+            if tenant is not None:
+                return self.tenants.controller(tenant) or self.controller
+        return self.controller
+
+    def _send(self, item):
+        message = Message(to=item.to, from_=item.from_tn, content=item.body)
+        try:
+            self._controller(item).create_message(message)
+        except Exception as e:
+            strerr = vars(e).get('response_body', None)
+            if item.attempts >= self.max_attempts:
+                self.outbox.fail(item)
+                self._record(item, 'failed')
+                log.critical({"message": "Giving up sending SMS to {} after "
+                              "{} attempts".format(item.to, item.attempts),
+                              "status": "failed",
+                              "exc": e,
+                              "strerr": strerr})
+            else:
+                delay = backoff(item.attempts)
+                self.outbox.retry(item, delay)
+                log.error({"message": "Raised an exception sending SMS, "
+                           "retrying in {}s".format(delay),
+                           "status": "failed",
+                           "exc": e,
+                           "strerr": strerr})
+        else:
+            self.outbox.ack(item)
+            self._record(item, 'sent')
+            self.dispatch_lag = (
+                datetime.utcnow() - item.created_at).total_seconds()
+            log.info(
+                {"message": "Message sent to {} for session {}".format(
+                 item.to, item.session_id),
+                 "status": "succeeded"})
+
+    def _record(self, item, status):
+        if self.history is not None:
+            self.history.record('outbound', status, item.from_tn, item.to,
+                                item.body, item.session_id, item.tenant_id)
+
+
+def main():
+    from sms_proxy.api import app
+    pool = OutboxWorkerPool(app.outbox, app.sms_controller,
+                            tenants=app.tenants, history=app.history)
+    pool.start()
+    pool.join()
+
+
+if __name__ == "__main__":
+    main()
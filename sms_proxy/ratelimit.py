@@ -0,0 +1,41 @@
+from sms_proxy.settings import (RATE_LIMIT_PER_TN, RATE_LIMIT_PER_TN_BURST,
+                                RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL_BURST)
+from sms_proxy.models import RateLimitBucket
+
+GLOBAL_KEY = '*'
+
+
+class RateLimiter(object):
+    """
+    Paces the messages sent from each virtual TN to 'per_tn' messages per
+    second, after a burst of 'per_tn_burst', and all messages to 'total'
+    per second, after a burst of 'total_burst'. A rate of 0 leaves that
+    limit off. The token buckets are kept in the rate_limit_bucket table,
+    so the limits hold across every process.
+    """
+    def __init__(self, per_tn=RATE_LIMIT_PER_TN,
+                 per_tn_burst=RATE_LIMIT_PER_TN_BURST,
+                 total=RATE_LIMIT_GLOBAL,
+                 total_burst=RATE_LIMIT_GLOBAL_BURST):
+        self.per_tn = per_tn
+        self.per_tn_burst = per_tn_burst
+        self.total = total
+        self.total_burst = total_burst
+
+    @property
+    def enabled(self):
+        return self.per_tn > 0 or self.total > 0
+
+    def reserve(self, virtual_tn, count=1):
+        """
+        Reserves the sending of 'count' messages from 'virtual_tn', and
+        returns how long, in seconds, to wait before sending them.
+        """
+        delay = 0.0
+        if self.total > 0:
+            delay = RateLimitBucket.reserve(GLOBAL_KEY, self.total,
+                                            self.total_burst, count)
+        if self.per_tn > 0:
+            delay = max(delay, RateLimitBucket.reserve(
+                virtual_tn, self.per_tn, self.per_tn_burst, count))
+        return delay
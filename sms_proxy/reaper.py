@@ -0,0 +1,100 @@
+import time
+from datetime import datetime, timedelta
+
+from sms_proxy.settings import (REAPER_INTERVAL, REAPER_BATCH_SIZE,
+                                INBOUND_DEDUP_WINDOW)
+from sms_proxy.database import db_session
+from sms_proxy.history import compact
+from sms_proxy.log import log
+from sms_proxy.models import ProxySession, InboundMessage
+
+
+class Reaper(object):
+    """
+    Expires ProxySessions whose expiry date has passed, and releases their
+    virtual TNs back to the pool. Sessions are expired in batches of
+    'batch_size' every 'interval' seconds, off of the request path. The
+    records of inbound messages delivered longer ago than the duplicate
+    window, and message events older than the history retention, are
+    removed at the same time.
+    """
+    def __init__(self, interval=REAPER_INTERVAL, batch_size=REAPER_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+
+    def run_once(self):
+        """
+        Expires batches of sessions until no expired sessions remain, and
+        returns the total number of sessions that were expired.
+        """
+        total = 0
+        while True:
+            try:
+                expired = ProxySession.clean_expired(limit=self.batch_size)
+            except Exception as e:
+                db_session.rollback()
+                log.error({"message": "Failed to expire sessions",
+                           "status": "failed",
+                           "exc": str(e)})
+                break
+            finally:
+                db_session.remove()
+            total += len(expired)
+            if len(expired) < self.batch_size:
+                break
+        if total:
+            log.info({"message": "Expired {} sessions".format(total),
+                      "status": "succeeded"})
+        return total
+
+    def prune_inbound(self):
+        """
+        Removes the records of inbound messages that can no longer be
+        redelivered as duplicates, and returns the number removed.
+        """
+        before = datetime.utcnow() - timedelta(seconds=INBOUND_DEDUP_WINDOW)
+        try:
+            return InboundMessage.prune(before)
+        except Exception as e:
+            db_session.rollback()
+            log.error({"message": "Failed to prune inbound messages",
+                       "status": "failed",
+                       "exc": str(e)})
+            return 0
+        finally:
+            db_session.remove()
+
+    def compact_history(self):
+        """
+        Archives and removes the message events older than the retention,
+        and returns the number removed.
+        """
+        try:
+            removed = compact()
+        except Exception as e:
+            db_session.rollback()
+            log.error({"message": "Failed to compact the message history",
+                       "status": "failed",
+                       "exc": str(e)})
+            return 0
+        finally:
+            db_session.remove()
+        if removed:
+            log.info({"message": "Compacted {} message events".format(
+                removed), "status": "succeeded"})
+        return removed
+
+    def run_forever(self):
+        while True:
+            self.run_once()
+            self.prune_inbound()
+            self.compact_history()
+            time.sleep(self.interval)
+
+
+def main():
+    Reaper().run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import threading
+from collections import namedtuple
+
+from sms_proxy.settings import (DEFAULT_TENANT, ORG_NAME, SESSION_START_MSG,
+                                SESSION_END_MSG, NO_SESSION_MSG)
+from sms_proxy.cache import tenant_cache
+from sms_proxy.database import db_session
+from sms_proxy.metrics import InstrumentedController
+from sms_proxy.models import Tenant, VirtualTN
+from sms_proxy.transport import create_sms_controller
+
+
+class TenantConfig(namedtuple('TenantConfig', [
+        'id', 'org_name', 'access_key', 'secret_key', 'session_start_msg',
+        'session_end_msg', 'no_session_msg', 'max_sessions'])):
+    """
+    The settings of a tenant, as held by the tenant cache, with those it
+    does not set taken from settings. A tenant without an 'access_key'
+    sends through the service's own Flowroute account.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_tenant(cls, tenant=None, tenant_id=DEFAULT_TENANT):
+        """
+        Returns the settings of the Tenant, or the settings of a tenant
+        with 'tenant_id' that overrides none of them
+        """
+        def setting(name, default):
+            value = getattr(tenant, name, None)
+            return default if value is None else value
+        return cls(tenant.id if tenant is not None else tenant_id,
+                   setting('org_name', ORG_NAME),
+                   setting('flowroute_access_key', None),
+                   setting('flowroute_secret_key', None),
+                   setting('session_start_msg', SESSION_START_MSG),
+                   setting('session_end_msg', SESSION_END_MSG),
+                   setting('no_session_msg', NO_SESSION_MSG),
+                   setting('max_sessions', None))
+
+
+class TenantRegistry(object):
+    """
+    Looks up tenants, and the tenant each virtual TN belongs to, through
+    the tenant caches, and keeps a messaging controller, with its own pool
+    of connections, for each tenant that has its own Flowroute account.
+    """
+    def __init__(self, default=DEFAULT_TENANT, cache=tenant_cache,
+                 create_controller=create_sms_controller):
+        self.default = default
+        self.cache = cache
+        self.create_controller = create_controller
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id):
+        """
+        Returns the TenantConfig of the tenant, or None if there is no such
+        tenant. The default tenant exists whether or not it is stored.
+        """
+        config = self.cache.get(tenant_id)
+        if config is None:
+            tenant = db_session.query(Tenant).get(tenant_id)
+            if tenant is None and tenant_id != self.default:
+                return None
+            config = TenantConfig.from_tenant(tenant, tenant_id)
+            self.cache.set(tenant_id, config)
+        return config
+
+    def for_virtual_tn(self, value):
+        """
+        Returns the TenantConfig of the tenant the virtual TN belongs to,
+        or of the default tenant if it belongs to none
+        """
+        return (self.get(VirtualTN.tenant_of(value) or self.default) or
+                self.get(self.default))
+
+    def invalidate(self, tenant_id):
+        self.cache.invalidate(tenant_id)
+
+    def controller(self, tenant):
+        """
+        Returns the messaging controller of the tenant's Flowroute account,
+        creating it on first use, and again once the tenant's credentials
+        change. Returns None for a tenant without an account of its own.
+        """
+        if tenant.access_key is None:
+            return None
+        credentials = (tenant.access_key, tenant.secret_key)
+        entry = self._controllers.get(tenant.id)
+        if entry is not None and entry[0] == credentials:
+            return entry[1]
+        with self._lock:
+            entry = self._controllers.get(tenant.id)
+            if entry is None or entry[0] != credentials:
+                if entry is not None:
+                    self._close(entry[1])
+                entry = (credentials, InstrumentedController(
+                    self.create_controller(username=tenant.access_key,
+                                           password=tenant.secret_key)))
+                self._controllers[tenant.id] = entry
+        return entry[1]
+
+    def discard(self, tenant_id):
+        """
+        Forgets the tenant, and closes the connections of its controller
+        """
+        self.invalidate(tenant_id)
+        with self._lock:
+            entry = self._controllers.pop(tenant_id, None)
+        if entry is not None:
+            self._close(entry[1])
+
+    @staticmethod
+    def _close(controller):
+        close = getattr(controller, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,77 @@
+import simplejson as json
+
+import requests
+from requests.adapters import HTTPAdapter
+from FlowrouteMessagingLib.Controllers.APIController import APIController
+
+from sms_proxy.settings import (SMS_TRANSPORT, FLOWROUTE_API_URL,
+                                TRANSPORT_POOL_SIZE, TRANSPORT_CONNECT_TIMEOUT,
+                                TRANSPORT_READ_TIMEOUT)
+
+
+class TransportError(Exception):
+    """
+    Raised when Flowroute's API does not accept a message. Mirrors the
+    attributes of the exceptions raised by Flowroute's APIController.
+    """
+    def __init__(self, reason, response_code=None, response_body=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.response_code = response_code
+        self.response_body = response_body
+
+
+class PooledMessagingController(object):
+    """
+    A drop-in replacement for Flowroute's APIController that sends messages
+    over a pool of keep-alive connections, rather than opening a connection,
+    and negotiating TLS, for every message.
+    """
+    def __init__(self, username, password, base_uri=FLOWROUTE_API_URL,
+                 pool_size=TRANSPORT_POOL_SIZE,
+                 connect_timeout=TRANSPORT_CONNECT_TIMEOUT,
+                 read_timeout=TRANSPORT_READ_TIMEOUT):
+        self.url = base_uri.rstrip('/') + '/messages'
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({
+            'user-agent': 'sms-proxy',
+            'content-type': 'application/json; charset=utf-8',
+            'accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def create_message(self, message):
+        body = json.dumps({'to': message.to,
+                           'from': message.mfrom,
+                           'body': message.content})
+        try:
+            response = self.session.post(self.url, data=body,
+                                         timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TransportError(str(e))
+        if response.status_code == 401:
+            raise TransportError("UNAUTHORIZED", 401, response.text)
+        elif response.status_code < 200 or response.status_code > 206:
+            raise TransportError("HTTP Response Not OK",
+                                 response.status_code, response.text)
+        try:
+            return response.json()
+        except ValueError:
+            return response.text
+
+    def close(self):
+        self.session.close()
+
+
+TRANSPORTS = {
+    'pooled': PooledMessagingController,
+    'unirest': APIController,
+}
+
+
+def create_sms_controller(username, password, transport=SMS_TRANSPORT):
+    return TRANSPORTS[transport](username=username, password=password)
@@ -0,0 +1,49 @@
+import pytest
+
+from sms_proxy.api import app
+
+
+class MockController(object):
+    """
+    Keeps the messages it is asked to send in 'requests' instead of sending
+    them. Each False in 'resp' fails the next message, in order.
+    """
+    def __init__(self, username=None, password=None):
+        self.username = username
+        self.requests = []
+        self.resp = []
+        self.closed = False
+
+    def create_message(self, msg):
+        self.requests.append(msg)
+        try:
+            err = self.resp.pop(0)
+        except IndexError:
+            pass
+        else:
+            if err is False:
+                raise Exception("Unkown exception from FlowrouteSDK.")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def mock_app(request):
+    """
+    The app, with the service's controller, and the controllers created
+    for tenants, replaced by mocks. The rate limiter and message history
+    are restored afterwards, so tests may replace them.
+    """
+    saved = (app.sms_controller, app.tenants.create_controller,
+             app.rate_limiter, app.history)
+    app.sms_controller = MockController()
+    app.tenants.create_controller = MockController
+
+    def restore():
+        app.history.flush()
+        (app.sms_controller, app.tenants.create_controller,
+         app.rate_limiter, app.history) = saved
+        app.tenants._controllers.clear()
+    request.addfinalizer(restore)
+    return app
@@ -2,48 +2,45 @@ import pytest
 import json
 import urllib
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from sms_proxy.api import app, VirtualTN, ProxySession, InternalSMSDispatcherError
+from sms_proxy.cache import routing_cache, stats_cache, inbound_cache
 from sms_proxy.database import db_session, init_db, destroy_db, engine
-from sms_proxy.settings import (TEST_DB, NO_SESSION_MSG, ORG_NAME,
-                                SESSION_END_MSG, SESSION_START_MSG)
+from sms_proxy.models import InboundMessage, SessionParticipant
+from sms_proxy.settings import (TEST_DATABASE_URL, NO_SESSION_MSG,
+                                ORG_NAME, SESSION_END_MSG, SESSION_START_MSG)
+from test.unit.conftest import MockController
 
 
 def teardown_module(module):
-    if TEST_DB in app.config['SQLALCHEMY_DATABASE_URI']:
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
         VirtualTN.query.delete()
         ProxySession.query.delete()
+        SessionParticipant.query.delete()
+        InboundMessage.query.delete()
         db_session.commit()
+        routing_cache.clear()
+        stats_cache.clear()
+        inbound_cache.clear()
     else:
         raise AttributeError(("The production database is turned on. "
-                              "Flip settings.DEBUG to True"))
+                              "Set DEBUG_MODE=true"))
 
 
 def setup_function(function):
-    if TEST_DB in app.config['SQLALCHEMY_DATABASE_URI']:
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
         VirtualTN.query.delete()
         ProxySession.query.delete()
+        SessionParticipant.query.delete()
+        InboundMessage.query.delete()
         db_session.commit()
+        routing_cache.clear()
+        stats_cache.clear()
+        inbound_cache.clear()
     else:
         raise AttributeError(("The production database is turned on. "
-                              "Flip settings.DEBUG to True"))
-
-
-class MockController():
-        def __init__(self):
-            self.requests = []
-            self.resp = []
-
-        def create_message(self, msg):
-            self.requests.append(msg)
-            try:
-                err = self.resp.pop(0)
-            except:
-                pass
-            else:
-                if err is False:
-                    raise Exception("Unkown exception from FlowrouteSDK.")
+                              "Set DEBUG_MODE=true"))
 
 
 mock_controller = MockController()
@@ -88,6 +85,213 @@ def test_get_tns():
     assert data['pool_size'] == 2
 
 
+def test_get_tns_paginated():
+    """
+    Virtual TNs are listed a page at a time, in order of value, following
+    the 'next' cursor, and can be filtered by availability.
+    """
+    client = app.test_client()
+    for n in range(5):
+        virtual_tn = VirtualTN('1222333000{}'.format(n))
+        if n % 2:
+            virtual_tn.session_id = 'session_{}'.format(n)
+        db_session.add(virtual_tn)
+    db_session.commit()
+    resp = client.get('/tn?limit=2')
+    data = json.loads(resp.data)
+    assert [tn['value'] for tn in data['virtual_tns']] == ['12223330000',
+                                                           '12223330001']
+    assert data['next'] == '12223330001'
+    assert data['pool_size'] == 5
+    assert data['available'] == 3
+    resp = client.get('/tn?limit=2&after={}'.format(data['next']))
+    data = json.loads(resp.data)
+    assert [tn['value'] for tn in data['virtual_tns']] == ['12223330002',
+                                                           '12223330003']
+    assert 'pool_size' not in data
+    resp = client.get('/tn?limit=2&after={}'.format(data['next']))
+    data = json.loads(resp.data)
+    assert [tn['value'] for tn in data['virtual_tns']] == ['12223330004']
+    assert data['next'] is None
+    resp = client.get('/tn?available=true')
+    data = json.loads(resp.data)
+    assert [tn['value'] for tn in data['virtual_tns']] == [
+        '12223330000', '12223330002', '12223330004']
+    resp = client.get('/tn?available=false')
+    data = json.loads(resp.data)
+    assert [tn['session_id'] for tn in data['virtual_tns']] == [
+        'session_1', 'session_3']
+    resp = client.get('/tn?limit=0')
+    assert resp.status_code == 400
+    resp = client.get('/tn?available=maybe')
+    assert resp.status_code == 400
+
+
+def test_get_tns_streamed(monkeypatch):
+    """
+    Every virtual TN is streamed, a batch at a time, as newline delimited
+    JSON, or as a JSON array.
+    """
+    monkeypatch.setattr('sms_proxy.api.EXPORT_BATCH_SIZE', 2)
+    client = app.test_client()
+    for n in range(5):
+        virtual_tn = VirtualTN('1222333000{}'.format(n))
+        if n == 3:
+            virtual_tn.session_id = 'session_3'
+        db_session.add(virtual_tn)
+    db_session.commit()
+    resp = client.get('/tn?stream=ndjson')
+    assert resp.status_code == 200
+    assert resp.content_type == 'application/x-ndjson'
+    lines = resp.data.decode('utf-8').splitlines()
+    assert [json.loads(line)['value'] for line in lines] == [
+        '1222333000{}'.format(n) for n in range(5)]
+    resp = client.get('/tn?stream=json&available=true')
+    data = json.loads(resp.data)
+    assert [tn['value'] for tn in data['virtual_tns']] == [
+        '12223330000', '12223330001', '12223330002', '12223330004']
+    resp = client.get('/tn?stream=csv')
+    assert resp.status_code == 400
+    VirtualTN.query.delete()
+    db_session.commit()
+    resp = client.get('/tn?stream=json')
+    assert json.loads(resp.data) == {'virtual_tns': []}
+    resp = client.get('/tn?stream=ndjson')
+    assert resp.data == b''
+
+
+def test_get_tn_stats():
+    """
+    The '/tn/stats' GET route reports the utilisation of the pool, and the
+    sessions expiring within the requested window, and caches the result.
+    """
+    client = app.test_client()
+    for n in range(3):
+        db_session.add(VirtualTN('1222333000{}'.format(n)))
+    db_session.add(VirtualTN('12223330003', 'west'))
+    sess_1 = ProxySession('12223330000', 'cust_1_num', 'cust_2_num', 5)
+    sess_2 = ProxySession('12223330001', 'cust_1_num', 'cust_2_num', 60)
+    sess_3 = ProxySession('12223330002', 'cust_1_num', 'cust_2_num', 10)
+    sess_3.expiry_date = datetime.utcnow() - timedelta(minutes=1)
+    db_session.add_all([sess_1, sess_2, sess_3])
+    db_session.commit()
+    VirtualTN.query.filter(VirtualTN.value != '12223330003').update(
+        {VirtualTN.session_id: 'session'}, synchronize_session=False)
+    db_session.commit()
+    resp = client.get('/tn/stats')
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert data == {"pool_size": 4,
+                    "available": 1,
+                    "in_use": 3,
+                    "in_use_percent": 75.0,
+                    "available_percent": 25.0,
+                    "pools": {"default": {"pool_size": 3,
+                                          "available": 0,
+                                          "in_use": 3,
+                                          "in_use_percent": 100.0},
+                              "west": {"pool_size": 1,
+                                       "available": 1,
+                                       "in_use": 0,
+                                       "in_use_percent": 0.0}},
+                    "expired_sessions": 1,
+                    "expiring_sessions": 1,
+                    "expiring_within": 15}
+    data = json.loads(client.get('/tn/stats?expiring_within=90').data)
+    assert data['expiring_sessions'] == 2
+    VirtualTN.query.delete()
+    db_session.commit()
+    data = json.loads(client.get('/tn/stats').data)
+    assert data['pool_size'] == 4
+    data = json.loads(client.get('/tn').data)
+    assert data['pool_size'] == 0
+    assert data['in_use_percent'] == 0.0
+    resp = client.get('/tn/stats?expiring_within=-1')
+    assert resp.status_code == 400
+    resp = client.get('/tn/stats?expiring_within=99999999999999999999')
+    assert resp.status_code == 400
+
+
+def test_post_tn_bulk():
+    """
+    Many virtual TNs are added at once, from a JSON array or one per line,
+    with a result for each.
+    """
+    client = app.test_client()
+    db_session.add(VirtualTN('12223330000'))
+    db_session.commit()
+    resp = client.post('/tn/bulk',
+                       data=json.dumps({'values': [
+                           '12223330000', '12223330001', 12223330002,
+                           '12223330001', '1' * 19, None]}),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert [(r['value'], r['result']) for r in data['results']] == [
+        ('12223330000', 'duplicate'),
+        ('12223330001', 'added'),
+        ('12223330002', 'added'),
+        ('12223330001', 'duplicate'),
+        ('1' * 19, 'invalid'),
+        (None, 'invalid')]
+    assert data['counts'] == {'added': 2, 'duplicate': 2, 'invalid': 2}
+    resp = client.post('/tn/bulk', data='12223330003\n\n12223330002\n',
+                       content_type='text/plain')
+    data = json.loads(resp.data)
+    assert data['counts'] == {'added': 1, 'duplicate': 1}
+    assert VirtualTN.query.count() == 4
+    resp = client.post('/tn/bulk?pool=west', data='12223330004\n',
+                       content_type='text/plain')
+    assert VirtualTN.pool_of('12223330004') == 'west'
+    client.post('/tn/bulk', data=json.dumps({'values': ['12223330005'],
+                                             'pool': 'east'}),
+                content_type='application/json')
+    assert VirtualTN.pool_of('12223330005') == 'east'
+    assert VirtualTN.pool_of('12223330003') == 'default'
+    resp = client.post('/tn/bulk', data=json.dumps({'value': '1'}),
+                       content_type='application/json')
+    assert resp.status_code == 400
+    resp = client.post('/tn/bulk?pool=', data='12223330006\n',
+                       content_type='text/plain')
+    assert resp.status_code == 400
+
+
+def test_delete_tn_bulk():
+    """
+    Many virtual TNs are removed at once, leaving those held by an active
+    session, and releasing those held by an expired session.
+    """
+    client = app.test_client()
+    for n in range(4):
+        db_session.add(VirtualTN('1222333000{}'.format(n)))
+    active = ProxySession('12223330001', 'cust_1_num', 'cust_2_num', 10)
+    expired = ProxySession('12223330002', 'cust_1_num', 'cust_2_num', 10)
+    expired.expiry_date = datetime.utcnow() - timedelta(minutes=1)
+    db_session.add_all([active, expired])
+    db_session.commit()
+    VirtualTN.query.filter_by(value='12223330001').update(
+        {VirtualTN.session_id: active.id}, synchronize_session=False)
+    VirtualTN.query.filter_by(value='12223330002').update(
+        {VirtualTN.session_id: expired.id}, synchronize_session=False)
+    db_session.commit()
+    resp = client.delete('/tn/bulk',
+                         data=json.dumps(['12223330000', '12223330001',
+                                          '12223330002', '12223339999',
+                                          '12223330000']),
+                         content_type='application/json')
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert [(r['value'], r['result']) for r in data['results']] == [
+        ('12223330000', 'removed'),
+        ('12223330001', 'in_use'),
+        ('12223330002', 'removed'),
+        ('12223339999', 'not_found'),
+        ('12223330000', 'not_found')]
+    assert sorted(tn.value for tn in VirtualTN.query.all()) == [
+        '12223330001', '12223330003']
+    assert ProxySession.query.count() == 1
+
+
 def test_delete_tn():
     """
     Creates a new virtual tn attached to a session, and requests to
@@ -161,7 +365,7 @@ def test_post_session():
     assert resp.status_code == 200
     data = json.loads(resp.data)
     assert 'Created new session' in data['message']
-    assert data['virtual_tn'] == vnum.value
+    assert data['virtual_tn'] == test_num
     assert len(mock_controller.requests) == 2
     msg = "[{}]: {}".format(ORG_NAME.upper(), SESSION_START_MSG)
     sms = mock_controller.requests[0]
@@ -169,6 +373,73 @@ def test_post_session():
     assert data['session_id'] is not None
 
 
+def test_post_session_pools():
+    """
+    A session is given a virtual TN from its preferred pools, in order,
+    falling back to any other pool unless asked not to.
+    """
+    app.sms_controller = MockController()
+    client = app.test_client()
+    for value, pool in (('12223330000', 'east'), ('12223330001', 'west'),
+                        ('12223330002', 'west')):
+        resp = client.post('/tn', data=json.dumps({'value': value,
+                                                   'pool': pool}),
+                           content_type='application/json')
+        assert json.loads(resp.data)['pool'] == pool
+
+    def start(**options):
+        options.update(participant_a='13334445555',
+                       participant_b='14445556666')
+        return client.post('/session', data=json.dumps(options),
+                           content_type='application/json')
+    data = json.loads(start(pool='west').data)
+    assert data['pool'] == 'west'
+    data = json.loads(start(pool=['north', 'east']).data)
+    assert (data['virtual_tn'], data['pool']) == ('12223330000', 'east')
+    resp = start(pool='east', fallback='none')
+    assert resp.status_code == 400
+    data = json.loads(start(pool='east').data)
+    assert (data['virtual_tn'], data['pool']) == ('12223330002', 'west')
+    assert start(pool='x' * 33).status_code == 400
+    assert start(pool='east', fallback='sometimes').status_code == 400
+    data = json.loads(client.get('/tn?pool=west').data)
+    assert [(tn['value'], tn['pool']) for tn in data['virtual_tns']] == [
+        ('12223330001', 'west'), ('12223330002', 'west')]
+
+
+def test_post_session_reclaims_within_pools():
+    """
+    When a session's pools are exhausted, the expired sessions holding a
+    virtual TN of those pools are reclaimed, rather than those of other
+    pools.
+    """
+    app.sms_controller = MockController()
+    client = app.test_client()
+    pair = {'participant_a': '13334445555', 'participant_b': '14445556666',
+            'pool': 'west', 'fallback': 'none'}
+
+    def add_expired_session(value, pool, minutes_ago):
+        virtual_tn = VirtualTN(value, pool=pool)
+        session = ProxySession(value, 'cust_1_num', 'cust_2_num')
+        session.expiry_date = datetime.utcnow() - timedelta(
+            minutes=minutes_ago)
+        virtual_tn.session_id = session.id
+        db_session.add_all([virtual_tn, session])
+        db_session.commit()
+        return session.id
+    for path, body in (('/session', pair),
+                       ('/session/batch', {'sessions': [pair]})):
+        setup_function(None)
+        other = add_expired_session('12223330000', 'default', 10)
+        expired = add_expired_session('12223330001', 'west', 1)
+        resp = client.post(path, data=json.dumps(body),
+                           content_type='application/json')
+        assert resp.status_code == 200
+        assert 'failed' not in resp.data.decode('utf-8')
+        assert ProxySession.query.get(expired) is None
+        assert ProxySession.query.get(other) is not None
+
+
 def test_post_session_dispatch_failure():
     """
     Initially attempts to create a session when there are no VirtualTN's
@@ -198,6 +469,78 @@ def test_post_session_dispatch_failure():
     assert data['message'] == "An error occured when requesting against Flowroute's API."
 
 
+def test_post_session_batch():
+    """
+    Starts many sessions at once. Pairs that are invalid, that find the pool
+    exhausted, or whose start message cannot be sent are reported as
+    failed, and only their sessions are rolled back.
+    """
+    class FailingController(MockController):
+        def create_message(self, msg):
+            self.requests.append(msg)
+            if msg.to == '15550000004':
+                raise Exception("Unkown exception from FlowrouteSDK.")
+
+    controller = FailingController()
+    app.sms_controller = controller
+    client = app.test_client()
+    for n in range(3):
+        db_session.add(VirtualTN('1222333000{}'.format(n)))
+    db_session.commit()
+    pairs = [{'participant_a': '15550000001', 'participant_b': '15550000002',
+              'expiry_window': 10},
+             {'participant_a': '15550000003'},
+             {'participant_a': '15550000003', 'participant_b': '15550000004'},
+             {'participant_a': '15550000005', 'participant_b': '15550000006'},
+             {'participant_a': '15550000007', 'participant_b': '15550000008'}]
+    resp = client.post('/session/batch', data=json.dumps({'sessions': pairs}),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert [r['status'] for r in data['results']] == [
+        'succeeded', 'failed', 'failed', 'succeeded', 'failed']
+    assert [r['reason'] for r in data['results'] if 'reason' in r] == [
+        'invalidAPIUsage', 'InternalSMSDispatcherError', 'no virtual TN']
+    assert data['counts'] == {'succeeded': 2, 'failed': 3}
+    assert data['results'][0]['expiry_date'] is not None
+    assert len(controller.requests) == 6
+    sessions = dict((s.id, s.virtual_TN) for s in ProxySession.query.all())
+    assert sessions == dict((r['session_id'], r['virtual_tn'])
+                            for r in data['results'] if 'session_id' in r)
+    in_use = dict((tn.session_id, tn.value) for tn in VirtualTN.query.filter(
+        VirtualTN.session_id != None))
+    assert in_use == sessions
+    resp = client.post('/session/batch', data=json.dumps({'pairs': []}),
+                       content_type='application/json')
+    assert resp.status_code == 400
+
+
+def test_post_session_batch_pools():
+    """
+    The pairs of a batch are given virtual TNs from their own pools, or
+    from those of the request.
+    """
+    app.sms_controller = MockController()
+    client = app.test_client()
+    VirtualTN.add_many(['12223330000', '12223330001'], pool='east')
+    VirtualTN.add_many(['12223330002'], pool='west')
+    pairs = [{'participant_a': '15550000001', 'participant_b': '15550000002',
+              'pool': 'west'},
+             {'participant_a': '15550000003', 'participant_b': '15550000004'},
+             {'participant_a': '15550000005', 'participant_b': '15550000006',
+              'pool': 'west', 'fallback': 'none'},
+             {'participant_a': '15550000007', 'participant_b': '15550000008',
+              'pool': 7}]
+    resp = client.post('/session/batch',
+                       data=json.dumps({'sessions': pairs, 'pool': 'east'}),
+                       content_type='application/json')
+    results = json.loads(resp.data)['results']
+    assert results[0]['virtual_tn'] == '12223330002'
+    assert results[1]['virtual_tn'] in ('12223330000', '12223330001')
+    assert results[2]['reason'] == 'no virtual TN'
+    assert results[3]['reason'] == 'invalidAPIUsage'
+
+
 def test_get_session():
     """
     Ensures the '/session' GET method returns json reflecting the state of the
@@ -220,6 +563,60 @@ def test_get_session():
     assert data['total_sessions'] == 2
 
 
+def test_get_session_filtered():
+    """
+    Sessions are listed a page at a time, following the 'next' cursor, and
+    can be filtered by participant and expiry date.
+    """
+    client = app.test_client()
+    sess_1 = ProxySession('12223334444', 'cust_1_num', 'cust_2_num', 10)
+    sess_2 = ProxySession('12223335555', 'cust_3_num', 'cust_1_num', 60)
+    sess_3 = ProxySession('12223336666', 'cust_3_num', 'cust_4_num')
+    ids = sorted([sess_1.id, sess_2.id, sess_3.id])
+    expires_before = (sess_1.expiry_date + timedelta(minutes=1)).strftime(
+        '%Y-%m-%d %H:%M:%S')
+    db_session.add_all([sess_1, sess_2, sess_3])
+    db_session.commit()
+    resp = client.get('/session?limit=2')
+    data = json.loads(resp.data)
+    assert [s['id'] for s in data['sessions']] == ids[:2]
+    assert data['total_sessions'] == 3
+    resp = client.get('/session?limit=2&after={}'.format(data['next']))
+    data = json.loads(resp.data)
+    assert [s['id'] for s in data['sessions']] == ids[2:]
+    assert data['next'] is None
+    resp = client.get('/session?participant=cust_1_num')
+    data = json.loads(resp.data)
+    assert data['total_sessions'] == 2
+    assert sorted(s['virtual_tn'] for s in data['sessions']) == [
+        '12223334444', '12223335555']
+    resp = client.get('/session?expires_before={}'.format(
+        urllib.quote(expires_before)))
+    data = json.loads(resp.data)
+    assert [s['virtual_tn'] for s in data['sessions']] == ['12223334444']
+    resp = client.get('/session?expires_before=tomorrow')
+    assert resp.status_code == 400
+
+
+def test_get_session_streamed():
+    """
+    Every session matching the filters is streamed as newline delimited
+    JSON.
+    """
+    client = app.test_client()
+    sess_1 = ProxySession('12223334444', 'cust_1_num', 'cust_2_num', 10)
+    sess_2 = ProxySession('12223335555', 'cust_3_num', 'cust_4_num')
+    db_session.add_all([sess_1, sess_2])
+    db_session.commit()
+    resp = client.get('/session?stream=ndjson&participant=cust_2_num')
+    sessions = [json.loads(line)
+                for line in resp.data.decode('utf-8').splitlines()]
+    assert len(sessions) == 1
+    assert sessions[0]['virtual_tn'] == '12223334444'
+    assert sessions[0]['participant_a'] == 'cust_1_num'
+    assert sessions[0]['expiry_date'] is not None
+
+
 def test_delete_session():
     """
     Initially tries to delete a session from an id that is unknown. The service
@@ -325,6 +722,87 @@ def test_inbound_handler_success_b_traverse(valid_session, fake_app):
     assert len(fake_app.sms_controller.requests) == 1
 
 
+def test_inbound_handler_duplicate_delivery(valid_session, fake_app):
+    """
+    A message Flowroute delivers again is acknowledged without being
+    forwarded again, unless forwarding it the first time failed.
+    """
+    client = fake_app.test_client()
+    req = {'to': valid_session.virtual_TN,
+           'from': valid_session.participant_a,
+           'body': 'hello from participant a',
+           'id': 'mdr1-inbound'}
+    suppressed = fake_app.duplicate_filter.suppressed
+    fake_app.sms_controller.resp.append(False)
+    resp = client.post('/', data=json.dumps(req),
+                       content_type='application/json')
+    assert resp.status_code == 500
+    for attempt in range(3):
+        resp = client.post('/', data=json.dumps(req),
+                           content_type='application/json')
+        assert resp.status_code == 200
+    assert len(fake_app.sms_controller.requests) == 2
+    assert fake_app.duplicate_filter.suppressed == suppressed + 2
+    # Processes without the message cached recognise it from the database
+    inbound_cache.clear()
+    resp = client.post('/', data=json.dumps(req),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    assert len(fake_app.sms_controller.requests) == 2
+
+
+def test_inbound_handler_delivery_in_progress(valid_session, fake_app):
+    """
+    A message delivered again while its first delivery is still being
+    forwarded is not acknowledged, so that Flowroute retries it.
+    """
+    client = fake_app.test_client()
+    req = {'to': valid_session.virtual_TN,
+           'from': valid_session.participant_a,
+           'body': 'hello from participant a',
+           'id': 'mdr1-in-progress'}
+    InboundMessage.record('id:mdr1-in-progress', 600)
+    resp = client.post('/', data=json.dumps(req),
+                       content_type='application/json')
+    assert resp.status_code == 503
+    assert fake_app.sms_controller.requests == []
+    # The first delivery failed, and the retry is forwarded
+    InboundMessage.forget('id:mdr1-in-progress')
+    resp = client.post('/', data=json.dumps(req),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    assert len(fake_app.sms_controller.requests) == 1
+    resp = client.post('/', data=json.dumps(req),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    assert len(fake_app.sms_controller.requests) == 1
+
+
+def test_inbound_handler_lookup_failure(valid_session, fake_app,
+                                        monkeypatch):
+    """
+    A message that fails before it is forwarded is forwarded when it is
+    delivered again, rather than taken to be still in progress.
+    """
+    def fail(*args, **kwargs):
+        raise Exception("Could not look up the tenant")
+    client = fake_app.test_client()
+    req = {'to': valid_session.virtual_TN,
+           'from': valid_session.participant_a,
+           'body': 'hello from participant a',
+           'id': 'mdr1-lookup-failure'}
+    monkeypatch.setattr(fake_app.tenants, 'for_virtual_tn', fail)
+    with pytest.raises(Exception):
+        client.post('/', data=json.dumps(req),
+                    content_type='application/json')
+    assert InboundMessage.query.get('id:mdr1-lookup-failure') is None
+    monkeypatch.undo()
+    resp = client.post('/', data=json.dumps(req),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    assert len(fake_app.sms_controller.requests) == 1
+
+
 def test_inbound_handler_expired_session(fake_app, valid_session):
     """
     An inbound message intended for a VirtualTN that is no longer
@@ -0,0 +1,55 @@
+import time
+
+from sms_proxy.cache import TTLCache
+
+
+def test_get_and_set():
+    """
+    Values that were set are returned, and lookups are counted as hits
+    or misses.
+    """
+    cache = TTLCache(10, 60)
+    assert cache.get('12223334444') is None
+    cache.set('12223334444', 'route')
+    assert cache.get('12223334444') == 'route'
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 1
+    assert stats['hit_rate'] == 0.5
+
+
+def test_least_recently_used_eviction():
+    """
+    Once the cache is full, the least recently used entry is evicted.
+    """
+    cache = TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_ttl_expiry():
+    """
+    Entries are not returned once their ttl has passed.
+    """
+    cache = TTLCache(10, 0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.misses == 1
+
+
+def test_invalidate_and_clear():
+    cache = TTLCache(10, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    cache.clear()
+    assert cache.get('b') is None
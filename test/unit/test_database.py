@@ -0,0 +1,86 @@
+import os
+import tempfile
+from collections import namedtuple
+
+import pytest
+
+from sms_proxy.database import create_db_engine, supports_skip_locked
+
+
+@pytest.fixture
+def db_path():
+    return os.path.join(tempfile.mkdtemp(), 'pragmas.db')
+
+
+def pragma(engine, name):
+    return engine.execute('PRAGMA {}'.format(name)).scalar()
+
+
+def test_sqlite_pragmas(db_path):
+    """
+    Every connection to a SQLite database is tuned with the PRAGMAs from
+    settings.
+    """
+    engine = create_db_engine('sqlite:///{}'.format(db_path), [
+        ('busy_timeout', '2500'),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', '1048576'),
+        ('cache_size', '-4000')])
+    assert pragma(engine, 'busy_timeout') == 2500
+    assert pragma(engine, 'journal_mode').lower() == 'wal'
+    # NORMAL
+    assert pragma(engine, 'synchronous') == 1
+    assert pragma(engine, 'cache_size') == -4000
+
+
+def test_sqlite_pragmas_skipped(db_path):
+    """
+    PRAGMAs without a value keep SQLite's default.
+    """
+    engine = create_db_engine('sqlite:///{}'.format(db_path), [
+        ('journal_mode', '')])
+    assert pragma(engine, 'journal_mode').lower() == 'delete'
+
+
+def test_sqlite_connections_reused(db_path):
+    """
+    Connections to a SQLite file database are kept open and reused.
+    """
+    engine = create_db_engine('sqlite:///{}'.format(db_path))
+    conn = engine.connect()
+    dbapi_connection = conn.connection.connection
+    conn.close()
+    conn = engine.connect()
+    assert conn.connection.connection is dbapi_connection
+    conn.close()
+
+
+def test_sqlite_pool_size(db_path):
+    """
+    The connection pool of a SQLite file database is sized from settings.
+    """
+    engine = create_db_engine('sqlite:///{}'.format(db_path), pool_size=3,
+                              max_overflow=2)
+    assert engine.pool.size() == 3
+    assert engine.pool._max_overflow == 2
+
+
+Engine = namedtuple('Engine', ['dialect'])
+Dialect = namedtuple('Dialect', ['name', 'server_version_info'])
+
+
+@pytest.mark.parametrize('dialect,version,expected', [
+    ('postgresql', (9, 4), False),
+    ('postgresql', (9, 5), True),
+    ('mysql', (5, 7, 20), False),
+    ('mysql', (8, 0, 1), True),
+    ('sqlite', (3, 22, 0), False),
+])
+def test_supports_skip_locked(dialect, version, expected):
+    """
+    Virtual TNs are claimed with SKIP LOCKED only on databases that
+    support it.
+    """
+    engine = Engine(Dialect(dialect, version))
+    assert supports_skip_locked(engine) is expected
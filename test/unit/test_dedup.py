@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+from sms_proxy.api import app
+from sms_proxy.cache import TTLCache
+from sms_proxy.database import db_session
+from sms_proxy.dedup import DuplicateFilter, inbound_key
+from sms_proxy.models import InboundMessage
+from sms_proxy.settings import TEST_DATABASE_URL
+
+
+def setup_function(function):
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
+        InboundMessage.query.delete()
+        db_session.commit()
+    else:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+def test_inbound_key():
+    """
+    Messages are keyed by their id, or by a hash of their content and
+    timestamp, and messages with neither are not keyed.
+    """
+    message = {'to': '12223334444', 'from': '13334445555', 'body': 'hello'}
+    assert inbound_key(message) is None
+    assert inbound_key(dict(message, id='mdr1-abc')) == 'id:mdr1-abc'
+    sent = dict(message, timestamp='2016-06-01T00:00:00Z')
+    key = inbound_key(sent)
+    assert key.startswith('sha1:') and len(key) <= 64
+    assert inbound_key(dict(sent)) == key
+    assert inbound_key(dict(sent, body='hello again')) != key
+    assert inbound_key(dict(sent, timestamp='2016-06-01T00:00:01Z')) != key
+
+
+def test_record_window():
+    """
+    A delivery is a duplicate within the window of the first delivery, and
+    a new message after it. Until the first delivery is forwarded, the
+    duplicates find it processing.
+    """
+    now = datetime.utcnow()
+
+    def record(seconds):
+        return InboundMessage.record('id:1', 60, now + timedelta(
+            seconds=seconds), processing_timeout=20)
+    assert record(0) is None
+    assert record(10) == InboundMessage.PROCESSING
+    InboundMessage.complete('id:1')
+    assert record(30) == InboundMessage.DONE
+    assert record(61) is None
+    InboundMessage.complete('id:1')
+    assert record(62) == InboundMessage.DONE
+
+
+def test_record_processing_timeout():
+    """
+    A delivery still processing after the timeout is taken to have been
+    lost, and the next delivery is forwarded in its place.
+    """
+    now = datetime.utcnow()
+    assert InboundMessage.record('id:1', 600, now,
+                                 processing_timeout=20) is None
+    assert InboundMessage.record('id:1', 600, now + timedelta(seconds=21),
+                                 processing_timeout=20) is None
+    assert InboundMessage.record('id:1', 600, now + timedelta(seconds=22),
+                                 processing_timeout=20) == (
+        InboundMessage.PROCESSING)
+
+
+def test_duplicate_filter():
+    """
+    Duplicates of forwarded messages are counted and cached, duplicates of
+    messages being forwarded are reported as such, and a message that
+    failed to be forwarded is processed when delivered again.
+    """
+    cache = TTLCache(10, 60)
+    dedup = DuplicateFilter(cache, window=60)
+    assert dedup.check(None) is None
+    assert dedup.check('id:1') is None
+    dedup.failed('id:1')
+    assert dedup.check('id:1') is None
+    assert dedup.check('id:1') == InboundMessage.PROCESSING
+    assert dedup.suppressed == 0
+    assert cache.get('id:1') is None
+    dedup.processed('id:1')
+    assert cache.get('id:1') is True
+    assert dedup.check('id:1') == InboundMessage.DONE
+    cache.clear()
+    assert dedup.check('id:1') == InboundMessage.DONE
+    assert dedup.suppressed == 2
+    assert DuplicateFilter(cache, window=0).check('id:1') is None
+
+
+def test_prune():
+    """
+    Only the records of messages delivered before the cutoff are removed.
+    """
+    now = datetime.utcnow()
+    InboundMessage.record('id:old', 60, now - timedelta(minutes=20))
+    InboundMessage.record('id:new', 60, now)
+    assert InboundMessage.prune(now - timedelta(minutes=10)) == 1
+    assert [m.key for m in InboundMessage.query.all()] == ['id:new']
+
+
+def test_duplicate_filter_prunes():
+    """
+    Forwarded messages prune the records older than the window, at most
+    once every interval.
+    """
+    now = datetime.utcnow()
+    dedup = DuplicateFilter(TTLCache(10, 60), window=60, prune_interval=30)
+    InboundMessage.record('id:old', 60, now - timedelta(minutes=20))
+    assert dedup.check('id:new') is None
+    dedup.processed('id:new')
+    assert [m.key for m in InboundMessage.query.all()] == ['id:new']
+    InboundMessage.record('id:old', 60, now - timedelta(minutes=20))
+    assert dedup.prune() == 0
+    assert dedup.prune(now + timedelta(seconds=90)) == 2
+    assert DuplicateFilter(window=60, prune_interval=0).prune() == 0
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from sms_proxy.dispatch import Dispatcher, DispatchTimeout
+
+
+class FakeMessage(object):
+    def __init__(self, to):
+        self.to = to
+
+
+class SlowController(object):
+    """
+    Takes 'delay' seconds to send each message, and fails to send to any
+    recipient in 'fail_for'.
+    """
+    def __init__(self, delay=0, fail_for=()):
+        self.delay = delay
+        self.fail_for = fail_for
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def create_message(self, msg):
+        time.sleep(self.delay)
+        with self.lock:
+            self.requests.append(msg)
+        if msg.to in self.fail_for:
+            raise Exception("Unkown exception from FlowrouteSDK.")
+
+
+def test_dispatch_concurrently():
+    """
+    Messages to several recipients are sent at the same time rather than
+    one after another.
+    """
+    controller = SlowController(delay=0.2)
+    dispatcher = Dispatcher(max_workers=4, timeout=5)
+    messages = [FakeMessage(str(n)) for n in range(4)]
+    start = time.time()
+    result = dispatcher.dispatch(controller, messages)
+    assert time.time() - start < 0.6
+    assert result.ok
+    assert len(result.sent) == 4
+    assert len(controller.requests) == 4
+    dispatcher.shutdown()
+
+
+def test_dispatch_partial_failure():
+    """
+    A failure to send to one recipient is reported without affecting the
+    other recipients.
+    """
+    controller = SlowController(fail_for=('2',))
+    dispatcher = Dispatcher(max_workers=2, timeout=5)
+    result = dispatcher.dispatch(
+        controller, [FakeMessage('1'), FakeMessage('2')])
+    assert not result.ok
+    assert [m.to for m in result.sent] == ['1']
+    message, e = result.failed[0]
+    assert message.to == '2'
+    dispatcher.shutdown()
+
+
+def test_dispatch_timeout():
+    """
+    Sends that do not complete within the timeout are reported as failed.
+    """
+    controller = SlowController(delay=0.5)
+    dispatcher = Dispatcher(max_workers=1, timeout=0.1)
+    result = dispatcher.dispatch(controller, [FakeMessage('1')])
+    assert not result.ok
+    message, e = result.failed[0]
+    assert isinstance(e, DispatchTimeout)
+    dispatcher.shutdown()
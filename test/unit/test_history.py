@@ -0,0 +1,186 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from sms_proxy.api import app
+from sms_proxy.cache import routing_cache, inbound_cache
+from sms_proxy.database import db_session
+from sms_proxy.history import MessageLog, compact
+from sms_proxy.models import VirtualTN, ProxySession, MessageEvent
+from sms_proxy.reaper import Reaper
+from sms_proxy.settings import TEST_DATABASE_URL
+
+
+def setup_function(function):
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
+        VirtualTN.query.delete()
+        ProxySession.query.delete()
+        MessageEvent.query.delete()
+        db_session.commit()
+        routing_cache.clear()
+        inbound_cache.clear()
+    else:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+@pytest.fixture
+def history_app(mock_app):
+    mock_app.history = MessageLog(enabled=True, batch_size=100,
+                                  flush_interval=0.05)
+    return mock_app
+
+
+def add_events(session_id, count, created_at):
+    for n in range(count):
+        db_session.add(MessageEvent(
+            session_id=session_id, tenant_id='default', direction='inbound',
+            status='received', from_number='12223334444',
+            to_number='13334445555', body='message {}'.format(n),
+            created_at=created_at + timedelta(seconds=n)))
+    db_session.commit()
+
+
+def test_message_log_batches():
+    """
+    Recorded events are written once a batch fills up, or the flush
+    interval has passed, and every event is written by flush.
+    """
+    history = MessageLog(enabled=True, batch_size=3, flush_interval=30)
+    for n in range(4):
+        history.record('inbound', 'received', '12223334444', '13334445555',
+                       'message {}'.format(n), 'session_id')
+    deadline = time.time() + 5
+    while MessageEvent.query.count() < 3 and time.time() < deadline:
+        db_session.remove()
+        time.sleep(0.01)
+    assert MessageEvent.query.count() == 3
+    history.flush()
+    assert [e.body for e in MessageEvent.query.order_by(MessageEvent.id)] == [
+        'message {}'.format(n) for n in range(4)]
+
+    history = MessageLog(enabled=True, batch_size=100, flush_interval=0.05)
+    history.record('outbound', 'sent', '13334445555', '12223334444', 'late')
+    deadline = time.time() + 5
+    while MessageEvent.query.count() < 5 and time.time() < deadline:
+        db_session.remove()
+        time.sleep(0.01)
+    assert MessageEvent.query.count() == 5
+    history.flush()
+
+
+def test_message_log_full_or_disabled():
+    """
+    Events beyond the buffer are dropped and counted, and a disabled log
+    records nothing.
+    """
+    history = MessageLog(enabled=False)
+    history.record('inbound', 'received', '1', '2', 'ignored')
+    assert history.queue.qsize() == 0
+    history = MessageLog(enabled=True, buffer_size=1, batch_size=100,
+                         flush_interval=30)
+    # Hold the writer back, so the buffer stays full
+    history._pid = os.getpid()
+    history.record('inbound', 'received', '1', '2', 'first')
+    history.record('inbound', 'received', '1', '2', 'second')
+    assert history.dropped == 1
+
+
+def test_message_log_flushes_at_exit_once(monkeypatch):
+    """
+    The writer is started again after each flush, but registered to be
+    flushed at exit only once.
+    """
+    registered = []
+    monkeypatch.setattr('atexit.register', registered.append)
+    history = MessageLog(enabled=True, batch_size=100, flush_interval=30)
+    for n in range(3):
+        history.record('inbound', 'received', '1', '2', 'message')
+        history.flush()
+    assert registered == [history.flush]
+    assert MessageEvent.query.count() == 3
+
+
+def test_page_by_session():
+    """
+    A session's events are paged through in the order they happened,
+    using the id of the last event as the cursor.
+    """
+    start = datetime(2016, 5, 19, 22, 0, 0)
+    add_events('session_a', 5, start)
+    add_events('session_b', 2, start)
+    first = MessageEvent.page('session_a', 3)
+    assert [e.body for e in first] == ['message 0', 'message 1', 'message 2']
+    rest = MessageEvent.page('session_a', 3, after=first[-1].id)
+    assert [e.body for e in rest] == ['message 3', 'message 4']
+    assert MessageEvent.page('session_a', 3, tenant_id='acme') == []
+
+
+def test_compact_archives_and_removes():
+    """
+    Events older than the retention are archived, a batch per file, and
+    removed, and newer events are kept.
+    """
+    now = datetime(2016, 5, 19, 22, 0, 0)
+    add_events('old', 5, now - timedelta(days=40))
+    add_events('new', 2, now - timedelta(days=1))
+    archive_dir = tempfile.mkdtemp()
+    assert compact(retention_days=30, archive_dir=archive_dir, batch_size=2,
+                   now=now) == 5
+    assert set(e.session_id for e in MessageEvent.query) == set(['new'])
+    archived = []
+    for name in sorted(os.listdir(archive_dir)):
+        with gzip.open(os.path.join(archive_dir, name)) as f:
+            archived.extend(json.loads(line.decode('utf-8'))['body']
+                            for line in f)
+    assert len(os.listdir(archive_dir)) == 3
+    assert archived == ['message {}'.format(n) for n in range(5)]
+    assert compact(retention_days=0, now=now + timedelta(days=365)) == 0
+    assert MessageEvent.query.count() == 2
+
+
+def test_reaper_compacts(monkeypatch):
+    monkeypatch.setattr('sms_proxy.history.HISTORY_RETENTION_DAYS', 30)
+    monkeypatch.setattr('sms_proxy.history.HISTORY_ARCHIVE_DIR', '')
+    add_events('old', 3, datetime.utcnow() - timedelta(days=31))
+    add_events('new', 1, datetime.utcnow())
+    assert Reaper().compact_history() == 3
+    assert MessageEvent.query.count() == 1
+
+
+def test_session_messages(history_app):
+    """
+    Messages received and sent for a session are listed by the session's
+    messages resource, once they have been written.
+    """
+    virtual_tn = VirtualTN('12069992222')
+    session = ProxySession(virtual_tn.value, '12223334444', '12223335555')
+    virtual_tn.session_id = session.id
+    db_session.add(virtual_tn)
+    db_session.add(session)
+    db_session.commit()
+    session_id = session.id
+    client = history_app.test_client()
+    resp = client.post('/', data=json.dumps({
+        'to': '12069992222', 'from': '12223334444', 'body': 'hello'}),
+        content_type='application/json')
+    assert resp.status_code == 200
+    history_app.history.flush()
+    resp = client.get('/session/{}/messages?limit=1'.format(session_id))
+    data = json.loads(resp.data)
+    inbound, = data['messages']
+    assert (inbound['direction'], inbound['status'], inbound['from'],
+            inbound['body']) == ('inbound', 'received', '12223334444', 'hello')
+    data = json.loads(client.get('/session/{}/messages?after={}'.format(
+        session_id, data['next'])).data)
+    outbound, = data['messages']
+    assert (outbound['direction'], outbound['status'], outbound['to']) == (
+        'outbound', 'sent', '12223335555')
+    assert data['next'] is None
+    resp = client.get('/session/{}/messages?after=x'.format(session_id))
+    assert resp.status_code == 400
@@ -0,0 +1,79 @@
+import json
+import logging
+import threading
+
+from six import StringIO
+
+from pythonjsonlogger import jsonlogger
+
+from sms_proxy.log import QueueHandler, SamplingFilter
+
+
+def make_logger(handler):
+    logger = logging.getLogger('test_log_{}'.format(id(handler)))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
+
+
+def test_queue_handler_writes_in_background():
+    """
+    Records are formatted and written by the background thread, in order,
+    once flushed.
+    """
+    stream = StringIO()
+    handler = QueueHandler(stream, jsonlogger.JsonFormatter(), batch_size=2)
+    logger = make_logger(handler)
+    for n in range(5):
+        logger.info({"message": "message {}".format(n)})
+    handler.flush()
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line)['message'] for line in lines] == [
+        'message {}'.format(n) for n in range(5)]
+    logger.info({"message": "after flush"})
+    handler.close()
+    assert 'after flush' in stream.getvalue()
+
+
+def test_queue_handler_drops_when_full():
+    """
+    Records are dropped, rather than blocking the caller, when the
+    background thread has fallen behind.
+    """
+    class BlockedStream(object):
+        def __init__(self):
+            self.unblocked = threading.Event()
+            self.lines = []
+
+        def write(self, data):
+            self.unblocked.wait()
+            self.lines.extend(data.splitlines())
+
+        def flush(self):
+            pass
+
+    stream = BlockedStream()
+    handler = QueueHandler(stream, jsonlogger.JsonFormatter(),
+                           queue_size=2, batch_size=1)
+    logger = make_logger(handler)
+    for n in range(20):
+        logger.info({"message": "message {}".format(n)})
+    assert handler.dropped >= 17
+    stream.unblocked.set()
+    handler.close()
+    assert len(stream.lines) == 20 - handler.dropped
+
+
+def test_sampling_filter():
+    """
+    INFO records are sampled, warnings and errors are always passed.
+    """
+    sampling = SamplingFilter(0)
+    info = logging.LogRecord('test', logging.INFO, __file__, 1, 'msg',
+                             None, None)
+    error = logging.LogRecord('test', logging.ERROR, __file__, 1, 'msg',
+                              None, None)
+    assert not sampling.filter(info)
+    assert sampling.filter(error)
+    assert SamplingFilter(1).filter(info)
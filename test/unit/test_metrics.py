@@ -0,0 +1,78 @@
+import pytest
+
+from prometheus_client import REGISTRY
+
+from sms_proxy.api import app
+from sms_proxy.cache import TTLCache
+from sms_proxy.metrics import InstrumentedController, instrument_cache
+from sms_proxy.settings import TEST_DATABASE_URL
+
+
+def setup_function(function):
+    if app.config['SQLALCHEMY_DATABASE_URI'] != TEST_DATABASE_URL:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_endpoint():
+    """
+    Requests, and the queries they run, are recorded per route, and
+    reported with the utilisation of the pool.
+    """
+    client = app.test_client()
+    requests = sample('sms_proxy_requests_total',
+                      method='GET', route='/tn', status='200')
+    queries = sample('sms_proxy_db_query_latency_seconds_count',
+                     statement='SELECT')
+    client.get('/tn')
+    assert sample('sms_proxy_requests_total', method='GET', route='/tn',
+                  status='200') == requests + 1
+    assert sample('sms_proxy_request_latency_seconds_count',
+                  method='GET', route='/tn') >= 1
+    assert sample('sms_proxy_db_query_latency_seconds_count',
+                  statement='SELECT') > queries
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    body = resp.data.decode('utf-8')
+    assert 'sms_proxy_request_latency_seconds_bucket{' in body
+    assert 'sms_proxy_virtual_tns{state="available"}' in body
+    assert 'sms_proxy_virtual_tn_utilisation_ratio' in body
+
+
+def test_instrumented_controller():
+    """
+    The latency of every message sent upstream is recorded, and failures
+    are counted by exception type.
+    """
+    class FailingController(object):
+        def create_message(self, message):
+            raise ValueError("HTTP Response Not OK")
+
+    sent = sample('sms_proxy_upstream_latency_seconds_count')
+    errors = sample('sms_proxy_upstream_errors_total',
+                    exception='ValueError')
+    controller = InstrumentedController(FailingController())
+    with pytest.raises(ValueError):
+        controller.create_message('message')
+    assert sample('sms_proxy_upstream_latency_seconds_count') == sent + 1
+    assert sample('sms_proxy_upstream_errors_total',
+                  exception='ValueError') == errors + 1
+
+
+def test_instrumented_cache():
+    """
+    Cache lookups are counted as hits or misses.
+    """
+    cache = TTLCache(10, 60)
+    instrument_cache(cache, 'test')
+    cache.get('12223334444')
+    cache.set('12223334444', 'route')
+    cache.get('12223334444')
+    assert sample('sms_proxy_cache_lookups_total',
+                  cache='test', result='hit') == 1
+    assert sample('sms_proxy_cache_lookups_total',
+                  cache='test', result='miss') == 1
@@ -0,0 +1,191 @@
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from sms_proxy.database import db_session
+from sms_proxy.migrations import MIGRATIONS, applied_versions, upgrade
+from sms_proxy.models import (VirtualTN, ProxySession, SessionParticipant,
+                              MessageEvent)
+
+# The schema of databases created before migrations were introduced
+BASELINE_SCHEMA = [
+    """CREATE TABLE virtual_tn (
+        id INTEGER,
+        value VARCHAR(18) NOT NULL,
+        session_id VARCHAR(40),
+        PRIMARY KEY (value))""",
+    """CREATE TABLE session (
+        id VARCHAR(40) NOT NULL,
+        date_created DATETIME,
+        "virtual_TN" VARCHAR(18),
+        participant_a VARCHAR(18),
+        participant_b VARCHAR(18),
+        expiry_date DATETIME,
+        PRIMARY KEY (id),
+        UNIQUE ("virtual_TN"))""",
+]
+
+
+@pytest.fixture
+def engine():
+    path = os.path.join(tempfile.mkdtemp(), 'migrations.db')
+    return create_engine('sqlite:///{}'.format(path))
+
+
+@pytest.fixture
+def baseline_engine(engine):
+    for statement in BASELINE_SCHEMA:
+        engine.execute(statement)
+    engine.execute("INSERT INTO virtual_tn (value, session_id) "
+                   "VALUES ('12223334444', NULL)")
+    return engine
+
+
+def index_names(engine, table):
+    return set(i['name'] for i in inspect(engine).get_indexes(table))
+
+
+def explain(engine, query):
+    """
+    Returns the SQLite query plan of an ORM query as a single string.
+    """
+    compiled = query.statement.compile(dialect=engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return ' '.join(str(row[-1]) for row in cursor.fetchall())
+    finally:
+        conn.close()
+
+
+def test_upgrade_baseline_database(baseline_engine):
+    """
+    A database created before migrations existed is upgraded in place,
+    keeping its rows, and every migration is recorded.
+    """
+    applied = upgrade(baseline_engine)
+    assert applied == [version for version, _, _ in MIGRATIONS]
+    columns = [c['name'] for c in
+               inspect(baseline_engine).get_columns('virtual_tn')]
+    assert 'released_at' in columns
+    assert 'ix_virtual_tn_session_id_released_at' in index_names(
+        baseline_engine, 'virtual_tn')
+    assert set(['ix_session_expiry_date', 'ix_session_participants']) <= (
+        index_names(baseline_engine, 'session'))
+    assert set(['ix_virtual_tn_tenant_id_session_id_released_at',
+                'ix_virtual_tn_tenant_id_pool_session_id_released_at']) <= (
+        index_names(baseline_engine, 'virtual_tn'))
+    assert 'ix_virtual_tn_pool_session_id_released_at' not in index_names(
+        baseline_engine, 'virtual_tn')
+    assert 'ix_session_tenant_id_expiry_date' in index_names(
+        baseline_engine, 'session')
+    rows = baseline_engine.execute(
+        "SELECT value, session_id, released_at, pool, tenant_id "
+        "FROM virtual_tn").fetchall()
+    assert [tuple(row) for row in rows] == [
+        ('12223334444', None, None, 'default', 'default')]
+
+
+def test_upgrade_maps_session_participants(baseline_engine):
+    """
+    The sessions of an upgraded database are mapped from each of their
+    participants, once when both are the same phone number.
+    """
+    baseline_engine.execute(
+        "INSERT INTO session (id, participant_a, participant_b) VALUES "
+        "('session_1', '13334445555', '14445556666'), "
+        "('session_2', '13334445555', '13334445555')")
+    upgrade(baseline_engine)
+    rows = baseline_engine.execute(
+        "SELECT participant, tenant_id, session_id FROM session_participant "
+        "ORDER BY session_id, participant").fetchall()
+    assert [tuple(row) for row in rows] == [
+        ('13334445555', 'default', 'session_1'),
+        ('14445556666', 'default', 'session_1'),
+        ('13334445555', 'default', 'session_2')]
+
+
+def test_upgrade_marks_inbound_messages_done(baseline_engine):
+    """
+    Inbound messages recorded before their status was tracked had been
+    forwarded, and are marked done.
+    """
+    baseline_engine.execute(
+        "CREATE TABLE inbound_message (key VARCHAR(64) NOT NULL, "
+        "received_at DATETIME, PRIMARY KEY (key))")
+    baseline_engine.execute(
+        "INSERT INTO inbound_message (key, received_at) "
+        "VALUES ('id:1', '2016-05-19 22:09:58')")
+    upgrade(baseline_engine)
+    rows = baseline_engine.execute(
+        "SELECT key, status FROM inbound_message").fetchall()
+    assert [tuple(row) for row in rows] == [('id:1', 'done')]
+
+
+def test_upgrade_is_idempotent(engine):
+    """
+    Migrations are applied to a new database once, and upgrading an up to
+    date database does nothing.
+    """
+    assert len(upgrade(engine)) == len(MIGRATIONS)
+    assert upgrade(engine) == []
+    with engine.connect() as conn:
+        assert applied_versions(conn) == set(
+            version for version, _, _ in MIGRATIONS)
+
+
+@pytest.mark.parametrize("query, index", [
+    (lambda: db_session.query(VirtualTN.value).filter_by(session_id=None),
+     'ix_virtual_tn_session_id_released_at'),
+    (lambda: db_session.query(VirtualTN.value).filter_by(
+        session_id=None).order_by(VirtualTN.released_at),
+     'ix_virtual_tn_session_id_released_at'),
+    (lambda: VirtualTN.query.filter_by(session_id='session_id'),
+     'ix_virtual_tn_session_id_released_at'),
+    (lambda: db_session.query(VirtualTN.value).filter_by(
+        session_id=None, tenant_id='default').order_by(
+        VirtualTN.released_at),
+     'ix_virtual_tn_tenant_id_session_id_released_at'),
+    (lambda: db_session.query(VirtualTN.value).filter_by(
+        session_id=None, tenant_id='default', pool='east').order_by(
+        VirtualTN.released_at),
+     'ix_virtual_tn_tenant_id_pool_session_id_released_at'),
+    (lambda: db_session.query(ProxySession.id).filter(
+        ProxySession.tenant_id == 'default',
+        ProxySession.expiry_date > datetime.utcnow()),
+     'ix_session_tenant_id_expiry_date'),
+    (lambda: db_session.query(ProxySession.id).filter(
+        ProxySession.expiry_date <= datetime.utcnow()).order_by(
+        ProxySession.expiry_date),
+     'ix_session_expiry_date'),
+    (lambda: ProxySession.query.filter_by(virtual_TN='12223334444'),
+     'sqlite_autoindex_session'),
+    (lambda: ProxySession.query.filter_by(participant_a='12223334444',
+                                          participant_b='12223335555'),
+     'ix_session_participants'),
+    (lambda: db_session.query(SessionParticipant.session_id).filter(
+        SessionParticipant.participant == '12223334444',
+        SessionParticipant.tenant_id == 'default',
+        SessionParticipant.session_id > 'session_id').order_by(
+        SessionParticipant.session_id),
+     'sqlite_autoindex_session_participant'),
+    (lambda: MessageEvent.query.filter(
+        MessageEvent.session_id == 'session_id').order_by(
+        MessageEvent.created_at, MessageEvent.id),
+     'ix_message_event_session_id_created_at'),
+])
+def test_hot_queries_use_indexes(baseline_engine, query, index):
+    """
+    The queries on the hot paths are answered from an index, rather than
+    by scanning the table, once a baseline database has been upgraded.
+    """
+    upgrade(baseline_engine)
+    plan = explain(baseline_engine, query())
+    assert plan.startswith('SEARCH')
+    assert index in plan
+    assert 'TEMP B-TREE' not in plan
@@ -2,31 +2,34 @@ import pytest
 import json
 import urllib
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from sms_proxy.api import app, VirtualTN, ProxySession
+from sms_proxy.cache import routing_cache
 from sms_proxy.database import db_session, init_db, destroy_db, engine
-from sms_proxy.settings import TEST_DB
+from sms_proxy.settings import TEST_DATABASE_URL
 
 
 def teardown_module(module):
-    if TEST_DB in app.config['SQLALCHEMY_DATABASE_URI']:
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
         VirtualTN.query.delete()
         ProxySession.query.delete()
         db_session.commit()
+        routing_cache.clear()
     else:
         raise AttributeError(("The production database is turned on. "
-                              "Flip settings.DEBUG to True"))
+                              "Set DEBUG_MODE=true"))
 
 
 def setup_module(module):
-    if TEST_DB in app.config['SQLALCHEMY_DATABASE_URI']:
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
         VirtualTN.query.delete()
         ProxySession.query.delete()
         db_session.commit()
+        routing_cache.clear()
     else:
         raise AttributeError(("The production database is turned on. "
-                              "Flip settings.DEBUG to True"))
+                              "Set DEBUG_MODE=true"))
 
 
 @pytest.fixture
@@ -37,6 +40,7 @@ def fresh_session():
     """
     VirtualTN.query.delete()
     ProxySession.query.delete()
+    routing_cache.clear()
     new_tn = VirtualTN('1234567897')
     db_session.add(new_tn)
     db_session.commit()
@@ -123,3 +127,196 @@ def test_get_other_participant(fresh_session):
         new_tn.value, new_session.participant_b)
     assert other_participant == new_session.participant_a
     assert session_id == new_session.id
+
+
+def test_clean_expired_sessions_limit(fresh_session):
+    """
+    The 'clean_expired' method removes at most 'limit' expired sessions
+    and returns the participants and virtual TN of each of them.
+    """
+    new_tn, new_session = fresh_session
+    new_session.expiry_date = datetime.utcnow()
+    db_session.add(new_session)
+    db_session.commit()
+    expected = (new_session.id, new_session.participant_a,
+                new_session.participant_b, new_tn.value)
+    assert ProxySession.clean_expired(limit=0) == []
+    assert len(ProxySession.query.all()) == 1
+    expired = ProxySession.clean_expired(limit=1)
+    assert len(expired) == 1
+    assert expired[0] == expected
+    assert len(ProxySession.query.all()) == 0
+    released_tn = VirtualTN.query.filter_by(value=expected[3]).one()
+    assert released_tn.session_id is None
+
+
+def test_reaper_run_once(fresh_session):
+    """
+    The reaper expires every expired session, in batches, and leaves
+    active sessions alone.
+    """
+    from sms_proxy.reaper import Reaper
+    new_tn, new_session = fresh_session
+    session_id, tn_value = new_session.id, new_tn.value
+    assert Reaper(batch_size=1).run_once() == 0
+    assert len(ProxySession.query.all()) == 1
+    new_session = ProxySession.query.filter_by(id=session_id).one()
+    new_session.expiry_date = datetime.utcnow()
+    db_session.add(new_session)
+    db_session.commit()
+    assert Reaper(batch_size=1).run_once() == 1
+    assert len(ProxySession.query.all()) == 0
+    released_tn = VirtualTN.query.filter_by(value=tn_value).one()
+    assert released_tn.session_id is None
+
+
+def test_get_other_participant_expired(fresh_session):
+    """
+    The 'get_other_participant' method does not route messages for a
+    session that has expired but has not been reaped yet.
+    """
+    new_tn, new_session = fresh_session
+    new_session.expiry_date = datetime.utcnow()
+    db_session.add(new_session)
+    db_session.commit()
+    other_participant, session_id = ProxySession.get_other_participant(
+        new_tn.value, new_session.participant_a)
+    assert other_participant is None
+    assert session_id is None
+
+
+def test_get_other_participant_cached(fresh_session):
+    """
+    Once a route has been read from the database it is served from the
+    routing cache, and terminating the session invalidates it.
+    """
+    new_tn, new_session = fresh_session
+    ProxySession.get_other_participant(new_tn.value, new_session.participant_a)
+    hits = routing_cache.hits
+    other_participant, session_id = ProxySession.get_other_participant(
+        new_tn.value, new_session.participant_a)
+    assert routing_cache.hits == hits + 1
+    assert other_participant == new_session.participant_b
+    assert session_id == new_session.id
+    ProxySession.terminate(new_session.id)
+    other_participant, session_id = ProxySession.get_other_participant(
+        new_tn.value, new_session.participant_a)
+    assert other_participant is None
+    assert session_id is None
+
+
+def test_get_other_participant_ended_elsewhere(fresh_session):
+    """
+    A cached route is not used once its session has been removed by
+    another process, which cannot invalidate this process's cache.
+    """
+    new_tn, new_session = fresh_session
+    tn_value, participant = new_tn.value, new_session.participant_a
+    ProxySession.get_other_participant(tn_value, participant)
+    assert routing_cache.get(tn_value) is not None
+    ProxySession.query.filter_by(id=new_session.id).delete()
+    db_session.commit()
+    other_participant, session_id = ProxySession.get_other_participant(
+        tn_value, participant)
+    assert (other_participant, session_id) == (None, None)
+    assert routing_cache.get(tn_value) is None
+
+
+def test_claim_virtual_tn():
+    """
+    The 'claim' method assigns a free VirtualTN to the session, never one
+    that is already reserved, and returns None once the pool is exhausted.
+    """
+    VirtualTN.query.delete()
+    reserved = VirtualTN('1234567891')
+    reserved.session_id = 'active_session_id'
+    db_session.add(reserved)
+    db_session.add(VirtualTN('1234567892'))
+    db_session.commit()
+    assert VirtualTN.claim('new_session_id') == '1234567892'
+    db_session.commit()
+    claimed = VirtualTN.query.filter_by(value='1234567892').one()
+    assert claimed.session_id == 'new_session_id'
+    assert VirtualTN.claim('another_session_id') is None
+
+
+@pytest.mark.parametrize("policy", ['first', 'lru', 'random'])
+def test_claim_virtual_tn_policy(policy):
+    """
+    Every allocation policy only hands out free VirtualTNs, and the 'lru'
+    policy hands out the VirtualTN that has been free for the longest.
+    """
+    VirtualTN.query.delete()
+    now = datetime.utcnow()
+    for minutes, num in enumerate(['1234567893', '1234567894',
+                                   '1234567895']):
+        new_tn = VirtualTN(num)
+        new_tn.released_at = now - timedelta(minutes=minutes)
+        db_session.add(new_tn)
+    db_session.commit()
+    claimed = set()
+    for n in range(3):
+        value = VirtualTN.claim('session_{}'.format(n), policy=policy)
+        db_session.commit()
+        if policy == 'lru' and n == 0:
+            assert value == '1234567895'
+        claimed.add(value)
+    assert claimed == set(['1234567893', '1234567894', '1234567895'])
+    assert VirtualTN.claim('session_3', policy=policy) is None
+
+
+@pytest.mark.parametrize("policy", ['first', 'lru', 'random'])
+def test_claim_many_from_pools(policy):
+    """
+    Virtual TNs are claimed from each pool in turn, where None stands for
+    any pool, and only from the pools given.
+    """
+    VirtualTN.query.delete()
+    VirtualTN.add_many(['12223330000', '12223330001'], pool='east')
+    VirtualTN.add_many(['12223330002'], pool='west')
+    VirtualTN.add_many(['12223330003'], pool='north')
+    claimed = VirtualTN.claim_many(['a', 'b'], policy, pools=['west'])
+    assert claimed == ['12223330002', None]
+    claimed = VirtualTN.claim_many(['c', 'd', 'e'], policy,
+                                   pools=['west', 'east'])
+    assert sorted(claimed[:2]) == ['12223330000', '12223330001']
+    assert claimed[2] is None
+    assert VirtualTN.claim('f', policy, pools=['east', None]) == \
+        '12223330003'
+    db_session.commit()
+    assert VirtualTN.pool_counts() == [('east', 2, 2), ('north', 1, 1),
+                                       ('west', 1, 1)]
+
+
+def test_default_pool(monkeypatch):
+    """
+    Virtual TNs join the default pool, or the pool of their area code.
+    """
+    from sms_proxy import models
+    assert VirtualTN('12223334444').pool == 'default'
+    assert VirtualTN('12223334444', 'east').pool == 'east'
+    monkeypatch.setattr(models, 'TN_POOL_BY_AREA_CODE', True)
+    assert VirtualTN('12223334444').pool == '222'
+    assert VirtualTN('2223334444').pool == 'default'
+
+
+def test_add_and_remove_many_in_batches():
+    """
+    Virtual TNs are added and removed in batches, with the same results as
+    a single batch.
+    """
+    VirtualTN.query.delete()
+    db_session.commit()
+    values = [str(12223330000 + n) for n in range(7)]
+    db_session.add(VirtualTN(values[3]))
+    db_session.commit()
+    results = VirtualTN.add_many(values + [values[0]], batch_size=3)
+    assert results == [(value, 'duplicate' if value == values[3]
+                        else 'added') for value in values] + [
+        (values[0], 'duplicate')]
+    assert VirtualTN.query.count() == 7
+    results = VirtualTN.remove_many(values[1:] + ['12223339999'],
+                                    batch_size=2)
+    assert results == [(value, 'removed') for value in values[1:]] + [
+        ('12223339999', 'not_found')]
+    assert [tn.value for tn in VirtualTN.query.all()] == values[:1]
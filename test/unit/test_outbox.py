@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+
+from sms_proxy.api import app
+from sms_proxy.models import OutboundMessage
+from sms_proxy.database import db_session
+from sms_proxy.outbox import DatabaseOutbox, OutboxWorkerPool, backoff
+from sms_proxy.settings import TEST_DATABASE_URL
+from test.unit.conftest import MockController
+
+
+def setup_function(function):
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
+        OutboundMessage.query.delete()
+        db_session.commit()
+    else:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+def test_claim_and_ack():
+    """
+    Queued messages are claimed once, and are removed from the outbox when
+    acknowledged.
+    """
+    outbox = DatabaseOutbox()
+    outbox.enqueue(['12223334444', '12223335555'], '13334445555', 'hello',
+                   'session_id')
+    assert outbox.stats()['depth'] == 2
+    items = outbox.claim(10)
+    assert len(items) == 2
+    assert outbox.claim(10) == []
+    for item in items:
+        assert item.attempts == 1
+        assert item.from_tn == '13334445555'
+        outbox.ack(item)
+    stats = outbox.stats()
+    assert stats['depth'] == 0
+    assert stats['lag'] == 0
+
+
+def test_claim_expired_lease():
+    """
+    A message whose lease has run out is claimed again, and the worker that
+    lost the lease can no longer acknowledge it.
+    """
+    outbox = DatabaseOutbox()
+    outbox.enqueue(['12223334444'], '13334445555', 'hello')
+    first, = outbox.claim(10, lease=-1)
+    second, = outbox.claim(10)
+    assert second.attempts == 2
+    outbox.ack(first)
+    assert outbox.stats()['depth'] == 1
+    outbox.ack(second)
+    assert outbox.stats()['depth'] == 0
+
+
+def test_worker_retries_with_backoff():
+    """
+    A failed send is retried after a backoff, and the message is marked as
+    failed once it has run out of attempts.
+    """
+    controller = MockController()
+    controller.resp = [False, False]
+    outbox = DatabaseOutbox()
+    pool = OutboxWorkerPool(outbox, controller, workers=0, max_attempts=2)
+    outbox.enqueue(['12223334444'], '13334445555', 'hello')
+    assert pool.run_once() == 1
+    message = OutboundMessage.query.one()
+    assert message.status == 'pending'
+    assert message.next_attempt_at > datetime.utcnow()
+    assert message.next_attempt_at <= (
+        datetime.utcnow() + timedelta(seconds=backoff(1)))
+    # Nothing is due until the backoff has passed
+    assert pool.run_once() == 0
+    OutboundMessage.query.update(
+        {OutboundMessage.next_attempt_at: datetime.utcnow()})
+    db_session.commit()
+    assert pool.run_once() == 1
+    stats = outbox.stats()
+    assert stats['depth'] == 0
+    assert stats['failed'] == 1
+    assert len(controller.requests) == 2
+
+
+def test_worker_sends():
+    controller = MockController()
+    outbox = DatabaseOutbox()
+    pool = OutboxWorkerPool(outbox, controller, workers=0)
+    outbox.enqueue(['12223334444'], '13334445555', 'hello', 'session_id')
+    assert pool.run_once() == 1
+    sms = controller.requests[0]
+    assert sms.to == '12223334444'
+    assert sms.mfrom == '13334445555'
+    assert sms.content == 'hello'
+    assert outbox.stats()['depth'] == 0
+
+
+class MockTenants(object):
+    def __init__(self, controllers):
+        self.controllers = controllers
+
+    def get(self, tenant_id):
+        return tenant_id
+
+    def controller(self, tenant):
+        return self.controllers.get(tenant)
+
+
+def test_worker_sends_per_tenant():
+    """
+    Messages of a tenant with its own Flowroute account are sent through
+    the tenant's controller, and the others through the worker's own.
+    """
+    controller, acme = MockController(), MockController()
+    outbox = DatabaseOutbox()
+    pool = OutboxWorkerPool(outbox, controller, workers=0,
+                            tenants=MockTenants({'acme': acme}))
+    outbox.enqueue(['12223334444'], '13334445555', 'hello', tenant_id='acme')
+    outbox.enqueue(['12223334444'], '13334446666', 'hello')
+    assert pool.run_once() == 2
+    assert [sms.mfrom for sms in acme.requests] == ['13334445555']
+    assert [sms.mfrom for sms in controller.requests] == ['13334446666']
+
+
+def test_inbound_handler_queues(monkeypatch):
+    """
+    With the outbox enabled, inbound messages are queued rather than sent
+    before responding.
+    """
+    import sms_proxy.api
+    monkeypatch.setattr(sms_proxy.api, 'OUTBOX_ENABLED', True)
+    controller = MockController()
+    app.sms_controller = controller
+    client = app.test_client()
+    resp = client.post('/', data='{"to": "12223334444", "from": "12223335555",'
+                                 ' "body": "hello"}',
+                       content_type='application/json')
+    assert resp.status_code == 200
+    assert controller.requests == []
+    message = OutboundMessage.query.one()
+    assert message.to == '12223335555'
+    assert message.from_tn == '12223334444'
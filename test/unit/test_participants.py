@@ -0,0 +1,131 @@
+import json
+from datetime import datetime, timedelta
+
+from sms_proxy.api import app
+from sms_proxy.cache import routing_cache, stats_cache
+from sms_proxy.database import db_session
+from sms_proxy.models import VirtualTN, ProxySession, SessionParticipant
+from sms_proxy.settings import TEST_DATABASE_URL
+
+
+def clear():
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
+        VirtualTN.query.delete()
+        ProxySession.query.delete()
+        SessionParticipant.query.delete()
+        db_session.commit()
+        routing_cache.clear()
+        stats_cache.clear()
+    else:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+def setup_function(function):
+    clear()
+
+
+def teardown_module(module):
+    clear()
+
+
+def add_tns(count):
+    VirtualTN.add_many([str(12223330000 + n) for n in range(count)])
+    db_session.commit()
+
+
+def start(client, participant_a, participant_b, **body):
+    body.update(participant_a=participant_a, participant_b=participant_b)
+    return client.post('/session', data=json.dumps(body),
+                       content_type='application/json')
+
+
+def participants():
+    return sorted((row.participant, row.session_id)
+                  for row in SessionParticipant.query)
+
+
+def test_sessions_are_mapped_from_participants(mock_app):
+    """
+    Starting a session maps it from each of its participants, and ending
+    or expiring it removes the mapping.
+    """
+    add_tns(3)
+    client = mock_app.test_client()
+    first = json.loads(start(client, '13334445555', '14445556666').data)
+    second = json.loads(start(client, '13334445555', '13334445555').data)
+    assert participants() == sorted([
+        ('13334445555', first['session_id']),
+        ('14445556666', first['session_id']),
+        ('13334445555', second['session_id'])])
+    resp = client.delete('/session', data=json.dumps({
+        'session_id': first['session_id']}),
+        content_type='application/json')
+    assert resp.status_code == 200
+    assert participants() == [('13334445555', second['session_id'])]
+    ProxySession.query.update({ProxySession.expiry_date:
+                               datetime.utcnow() - timedelta(minutes=1)})
+    db_session.commit()
+    ProxySession.clean_expired()
+    assert participants() == []
+
+
+def test_participant_sessions(mock_app):
+    """
+    The sessions of the tenant a phone number takes part in, on either
+    side, are listed a page at a time, with the active ones counted.
+    """
+    add_tns(4)
+    client = mock_app.test_client()
+    ids = sorted(json.loads(start(client, *pair).data)['session_id']
+                 for pair in (('13334445555', '14445556666'),
+                              ('15556667777', '13334445555'),
+                              ('13334445555', '16667778888')))
+    start(client, '14445556666', '15556667777')
+    SessionParticipant.query.filter_by(session_id=ids[0]).update(
+        {SessionParticipant.expiry_date:
+         datetime.utcnow() - timedelta(minutes=1)})
+    db_session.commit()
+    data = json.loads(client.get(
+        '/participant/13334445555/sessions?limit=2').data)
+    assert [s['id'] for s in data['sessions']] == ids[:2]
+    assert (data['total_sessions'], data['active_sessions']) == (3, 2)
+    data = json.loads(client.get(
+        '/participant/13334445555/sessions?limit=2&after={}'.format(
+            data['next'])).data)
+    assert [s['id'] for s in data['sessions']] == ids[2:]
+    assert data['next'] is None
+    assert 'total_sessions' not in data
+    data = json.loads(client.get('/participant/19990000000/sessions').data)
+    assert (data['sessions'], data['total_sessions']) == ([], 0)
+    resp = client.get('/participant/13334445555/sessions',
+                      headers={'X-Tenant': 'unknown'})
+    assert resp.status_code == 404
+
+
+def test_participant_limit(mock_app, monkeypatch):
+    """
+    A phone number may not take part in more active sessions than
+    PARTICIPANT_MAX_SESSIONS, for single sessions and batches alike.
+    """
+    monkeypatch.setattr('sms_proxy.api.PARTICIPANT_MAX_SESSIONS', 2)
+    add_tns(6)
+    client = mock_app.test_client()
+    assert start(client, '13334445555', '14445556666').status_code == 200
+    resp = client.post('/session/batch', data=json.dumps({'sessions': [
+        {'participant_a': '13334445555', 'participant_b': '15556667777'},
+        {'participant_a': '16667778888', 'participant_b': '13334445555'},
+        {'participant_a': '14445556666', 'participant_b': '15556667777'}]}),
+        content_type='application/json')
+    results = json.loads(resp.data)['results']
+    assert [r['status'] for r in results] == ['succeeded', 'failed',
+                                              'succeeded']
+    assert results[1]['reason'] == 'participant limit exceeded'
+    resp = start(client, '13334445555', '17778889999')
+    assert resp.status_code == 429
+    assert json.loads(resp.data)['reason'] == 'participant limit exceeded'
+    # Expired sessions are not counted
+    SessionParticipant.query.update({SessionParticipant.expiry_date:
+                                     datetime.utcnow() - timedelta(minutes=1)})
+    db_session.commit()
+    assert start(client, '13334445555', '17778889999').status_code == 200
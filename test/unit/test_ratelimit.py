@@ -0,0 +1,104 @@
+import json
+
+from sms_proxy.api import app, send_message
+from sms_proxy.database import db_session
+from sms_proxy.models import (OutboundMessage, RateLimitBucket, VirtualTN,
+                              ProxySession)
+from sms_proxy.ratelimit import RateLimiter
+from sms_proxy.settings import TEST_DATABASE_URL
+
+
+def setup_function(function):
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
+        RateLimitBucket.query.delete()
+        OutboundMessage.query.delete()
+        VirtualTN.query.delete()
+        ProxySession.query.delete()
+        db_session.commit()
+    else:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+def test_reserve_burst_and_rate():
+    """
+    A full bucket lets a burst through without waiting, after which
+    messages wait for the bucket to refill at the rate.
+    """
+    now = 1000.0
+    for n in range(3):
+        assert RateLimitBucket.reserve('13334445555', 2, 3, now=now) == 0
+    assert RateLimitBucket.reserve('13334445555', 2, 3, now=now) == 0.5
+    assert RateLimitBucket.reserve('13334445555', 2, 3, now=now) == 1.0
+    # Other virtual TNs have buckets of their own
+    assert RateLimitBucket.reserve('13334446666', 2, 3, now=now) == 0
+    # The reserved messages have been sent, and the bucket refilled
+    assert RateLimitBucket.reserve('13334445555', 2, 3, now=now + 10) == 0
+    assert RateLimitBucket.reserve('13334445555', 2, 3, count=4,
+                                   now=now + 10) == 1.0
+
+
+def test_rate_limiter():
+    """
+    The longest wait of the per TN and global limits is returned, and
+    disabled limits are not counted.
+    """
+    assert not RateLimiter(0, 1, 0, 1).enabled
+    limiter = RateLimiter(per_tn=1, per_tn_burst=1, total=10, total_burst=10)
+    assert limiter.enabled
+    assert limiter.reserve('13334445555') == 0
+    assert 0.9 < limiter.reserve('13334445555') <= 1.0
+    assert limiter.reserve('13334446666') == 0
+    assert RateLimitBucket.query.count() == 3
+
+
+def test_send_message_queued(mock_app):
+    """
+    Messages that fit the limits are sent immediately, and those that do
+    not are queued in the outbox to be sent once they fit.
+    """
+    mock_app.rate_limiter = RateLimiter(per_tn=0.1, per_tn_burst=1,
+                                        total=0, total_burst=0)
+    send_message(['12223334444'], '13334445555', 'first', 'session_id')
+    send_message(['12223334444'], '13334445555', 'second', 'session_id')
+    assert [m.content for m in mock_app.sms_controller.requests] == [
+        'first']
+    queued = OutboundMessage.query.one()
+    assert queued.body == 'second'
+    assert 9 < (queued.next_attempt_at -
+                queued.created_at).total_seconds() <= 10
+
+
+def test_send_message_delayed(mock_app):
+    """
+    Messages held back for less than RATE_LIMIT_MAX_DELAY are sent once
+    they fit the limits.
+    """
+    mock_app.rate_limiter = RateLimiter(per_tn=0, per_tn_burst=0,
+                                        total=20, total_burst=1)
+    send_message(['12223334444', '12223335555'], '13334445555', 'hello',
+                 'session_id')
+    assert len(mock_app.sms_controller.requests) == 2
+    assert OutboundMessage.query.count() == 0
+
+
+def test_session_batch_paced(mock_app, monkeypatch):
+    """
+    The start messages of a batch of sessions are paced by the limits,
+    sent once they fit, or queued when they would wait too long.
+    """
+    monkeypatch.setattr('sms_proxy.api.RATE_LIMIT_MAX_DELAY', 0.2)
+    mock_app.rate_limiter = RateLimiter(per_tn=0, per_tn_burst=0,
+                                        total=20, total_burst=2)
+    VirtualTN.add_many([str(12223330000 + n) for n in range(4)])
+    db_session.commit()
+    client = mock_app.test_client()
+    resp = client.post('/session/batch', data=json.dumps({'sessions': [
+        {'participant_a': str(13334440000 + n),
+         'participant_b': str(14445550000 + n)} for n in range(4)]}),
+        content_type='application/json')
+    results = json.loads(resp.data)['results']
+    assert [r['status'] for r in results] == ['succeeded'] * 4
+    # A burst of 2, then one message every 50ms for up to 200ms
+    assert len(mock_app.sms_controller.requests) == 6
+    assert OutboundMessage.query.count() == 2
@@ -0,0 +1,273 @@
+import json
+from datetime import datetime, timedelta
+
+from sms_proxy.api import app
+from sms_proxy.cache import (routing_cache, stats_cache, tenant_cache,
+                             tn_tenant_cache)
+from sms_proxy.database import db_session
+from sms_proxy.models import (VirtualTN, ProxySession, SessionParticipant,
+                              Tenant)
+from sms_proxy.settings import (TEST_DATABASE_URL, ORG_NAME, NO_SESSION_MSG,
+                                SESSION_START_MSG)
+from sms_proxy.tenants import TenantRegistry
+from test.unit.conftest import MockController
+
+
+def clear():
+    if app.config['SQLALCHEMY_DATABASE_URI'] == TEST_DATABASE_URL:
+        VirtualTN.query.delete()
+        ProxySession.query.delete()
+        SessionParticipant.query.delete()
+        Tenant.query.delete()
+        db_session.commit()
+        for cache in (routing_cache, stats_cache, tenant_cache,
+                      tn_tenant_cache):
+            cache.clear()
+    else:
+        raise AttributeError(("The production database is turned on. "
+                              "Set DEBUG_MODE=true"))
+
+
+def setup_function(function):
+    clear()
+
+
+def teardown_module(module):
+    clear()
+
+
+def add_tenant(tenant_id, **settings):
+    tenant = Tenant(tenant_id)
+    for name, value in settings.items():
+        setattr(tenant, name, value)
+    db_session.add(tenant)
+    db_session.commit()
+    return tenant
+
+
+def test_registry_get():
+    """
+    Tenants are read once and cached, with the settings they do not set
+    taken from settings. The default tenant exists without being stored.
+    """
+    registry = TenantRegistry()
+    default = registry.get('default')
+    assert (default.org_name, default.access_key, default.max_sessions) == (
+        ORG_NAME, None, None)
+    assert registry.get('acme') is None
+    add_tenant('acme', org_name='Acme', max_sessions=2)
+    acme = registry.get('acme')
+    assert (acme.org_name, acme.no_session_msg, acme.max_sessions) == (
+        'Acme', NO_SESSION_MSG, 2)
+    Tenant.query.filter_by(id='acme').update({Tenant.org_name: 'Acme Inc'})
+    db_session.commit()
+    assert registry.get('acme').org_name == 'Acme'
+    registry.invalidate('acme')
+    assert registry.get('acme').org_name == 'Acme Inc'
+
+
+def test_registry_for_virtual_tn():
+    """
+    A virtual TN is routed to the tenant it belongs to, and an unknown
+    virtual TN to the default tenant.
+    """
+    registry = TenantRegistry()
+    add_tenant('acme')
+    db_session.add(VirtualTN('12223334444', tenant_id='acme'))
+    db_session.commit()
+    assert registry.for_virtual_tn('12223334444').id == 'acme'
+    assert tn_tenant_cache.get('12223334444') == 'acme'
+    assert registry.for_virtual_tn('19998887777').id == 'default'
+
+
+def test_registry_controller():
+    """
+    Tenants without a Flowroute account of their own have no controller,
+    the others one each, replaced when their credentials change.
+    """
+    registry = TenantRegistry(create_controller=MockController)
+    add_tenant('acme', flowroute_access_key='key',
+               flowroute_secret_key='secret')
+    assert registry.controller(registry.get('default')) is None
+    controller = registry.controller(registry.get('acme'))
+    assert controller.username == 'key'
+    assert registry.controller(registry.get('acme')) is controller
+    Tenant.query.filter_by(id='acme').update(
+        {Tenant.flowroute_access_key: 'other'})
+    db_session.commit()
+    registry.invalidate('acme')
+    replaced = registry.controller(registry.get('acme'))
+    assert replaced.username == 'other'
+    assert controller.closed
+    registry.discard('acme')
+    assert replaced.closed
+
+
+def test_tenants_are_isolated(mock_app):
+    """
+    Virtual TNs and sessions are only visible to, and claimed for, the
+    tenant named by the X-Tenant header.
+    """
+    client = mock_app.test_client()
+    resp = client.post('/tenant', data=json.dumps({'id': 'acme',
+                                                   'org_name': 'Acme'}),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    acme = {'X-Tenant': 'acme'}
+    client.post('/tn', data=json.dumps({'value': '12223330000'}),
+                content_type='application/json')
+    client.post('/tn', data=json.dumps({'value': '12223330001'}),
+                content_type='application/json', headers=acme)
+    data = json.loads(client.get('/tn', headers=acme).data)
+    assert [tn['value'] for tn in data['virtual_tns']] == ['12223330001']
+    assert data['pool_size'] == 1
+    resp = client.post('/session', data=json.dumps({
+        'participant_a': '13334445555', 'participant_b': '14445556666'}),
+        content_type='application/json', headers=acme)
+    session = json.loads(resp.data)
+    assert session['virtual_tn'] == '12223330001'
+    sms = mock_app.sms_controller.requests[0]
+    assert sms.content == "[ACME]: {}".format(SESSION_START_MSG)
+    # Another tenant's sessions and virtual TNs cannot be seen or ended
+    assert json.loads(client.get('/session').data)['total_sessions'] == 0
+    resp = client.delete('/session', data=json.dumps({
+        'session_id': session['session_id']}),
+        content_type='application/json')
+    assert resp.status_code == 404
+    resp = client.delete('/tn', data=json.dumps({'value': '12223330001'}),
+                         content_type='application/json')
+    assert resp.status_code == 404
+    resp = client.get('/tn', headers={'X-Tenant': 'unknown'})
+    assert resp.status_code == 404
+
+
+def test_inbound_uses_tenant_account(mock_app):
+    """
+    Inbound messages to a tenant's virtual TN are answered with the
+    tenant's messages, through the tenant's own Flowroute account.
+    """
+    add_tenant('acme', org_name='Acme', no_session_msg='No session',
+               flowroute_access_key='key', flowroute_secret_key='secret')
+    db_session.add(VirtualTN('12223330000', tenant_id='acme'))
+    db_session.commit()
+    client = mock_app.test_client()
+    resp = client.post('/', data=json.dumps({
+        'to': '12223330000', 'from': '13334445555', 'body': 'hello'}),
+        content_type='application/json')
+    assert resp.status_code == 200
+    assert mock_app.sms_controller.requests == []
+    controller = mock_app.tenants.controller(
+        mock_app.tenants.get('acme'))
+    sms, = controller.requests
+    assert sms.content == '[ACME]: No session'
+    assert sms.mfrom == '12223330000'
+
+
+def test_session_quota(mock_app):
+    """
+    A tenant may not have more active sessions than its limit, for single
+    sessions and batches alike.
+    """
+    client = mock_app.test_client()
+    client.post('/tenant', data=json.dumps({'id': 'acme',
+                                            'max_sessions': 2}),
+                content_type='application/json')
+    acme = {'X-Tenant': 'acme'}
+    client.post('/tn/bulk', data='\n'.join(
+        str(12223330000 + n) for n in range(4)), headers=acme)
+    pair = {'participant_a': '13334445555', 'participant_b': '14445556666'}
+    resp = client.post('/session', data=json.dumps(pair),
+                       content_type='application/json', headers=acme)
+    assert resp.status_code == 200
+    resp = client.post('/session/batch',
+                       data=json.dumps({'sessions': [pair, pair]}),
+                       content_type='application/json', headers=acme)
+    results = json.loads(resp.data)['results']
+    assert [r['status'] for r in results] == ['succeeded', 'failed']
+    assert results[1]['reason'] == 'session quota exceeded'
+    resp = client.post('/session', data=json.dumps(pair),
+                       content_type='application/json', headers=acme)
+    assert resp.status_code == 429
+    # The default tenant is not limited
+    client.post('/tn', data=json.dumps({'value': '12223339999'}),
+                content_type='application/json')
+    resp = client.post('/session', data=json.dumps(pair),
+                       content_type='application/json')
+    assert resp.status_code == 200
+
+
+def add_expired_session(virtual_tn, tenant_id, minutes_ago):
+    tn = VirtualTN(virtual_tn, tenant_id=tenant_id)
+    session = ProxySession(virtual_tn, '13334445555', '14445556666',
+                           tenant_id=tenant_id)
+    session.expiry_date = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    tn.session_id = session.id
+    db_session.add_all([tn, session])
+    db_session.commit()
+    return session.id
+
+
+def test_reclaims_within_tenant(mock_app):
+    """
+    When a tenant's virtual TNs are all in use, the expired sessions of
+    that tenant are reclaimed, rather than those of other tenants.
+    """
+    add_tenant('acme')
+    acme = {'X-Tenant': 'acme'}
+    client = mock_app.test_client()
+    pair = {'participant_a': '13334445555', 'participant_b': '14445556666'}
+    for start in (
+            lambda: client.post('/session', data=json.dumps(pair),
+                                content_type='application/json',
+                                headers=acme),
+            lambda: client.post('/session/batch',
+                                data=json.dumps({'sessions': [pair]}),
+                                content_type='application/json',
+                                headers=acme)):
+        clear()
+        add_tenant('acme')
+        other = add_expired_session('12223339999', 'default', 10)
+        expired = add_expired_session('12223330000', 'acme', 1)
+        resp = start()
+        assert resp.status_code == 200
+        assert 'failed' not in resp.data.decode('utf-8')
+        assert ProxySession.query.get(expired) is None
+        assert ProxySession.query.get(other) is not None
+
+
+def test_tenant_resource(mock_app):
+    """
+    Tenants are created, updated, listed without their credentials, and
+    removed once they have no virtual TNs left.
+    """
+    client = mock_app.test_client()
+
+    def save(**body):
+        return client.post('/tenant', data=json.dumps(body),
+                           content_type='application/json')
+    assert save(id='acme', flowroute_access_key='key').status_code == 400
+    assert save(id='acme', max_sessions=-1).status_code == 400
+    assert save(id='x' * 33).status_code == 400
+    data = json.loads(save(id='acme', org_name='Acme',
+                           flowroute_access_key='key',
+                           flowroute_secret_key='secret').data)
+    assert (data['org_name'], data['has_credentials']) == ('Acme', True)
+    assert 'flowroute_secret_key' not in data
+    data = json.loads(save(id='acme', max_sessions=5).data)
+    assert (data['org_name'], data['max_sessions']) == ('Acme', 5)
+    assert mock_app.tenants.get('acme').max_sessions == 5
+    tenants = json.loads(client.get('/tenant').data)['tenants']
+    assert [t['id'] for t in tenants] == ['acme']
+    client.post('/tn', data=json.dumps({'value': '12223330000'}),
+                content_type='application/json', headers={'X-Tenant': 'acme'})
+
+    def delete():
+        return client.delete('/tenant', data=json.dumps({'id': 'acme'}),
+                             content_type='application/json')
+    assert delete().status_code == 400
+    client.delete('/tn', data=json.dumps({'value': '12223330000'}),
+                  content_type='application/json',
+                  headers={'X-Tenant': 'acme'})
+    assert delete().status_code == 200
+    assert mock_app.tenants.get('acme') is None
+    assert delete().status_code == 404
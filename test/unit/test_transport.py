@@ -0,0 +1,79 @@
+import json
+
+import pytest
+import requests
+
+from FlowrouteMessagingLib.Models.Message import Message
+
+from sms_proxy.transport import PooledMessagingController, TransportError
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+@pytest.fixture
+def controller():
+    return PooledMessagingController('access_key', 'secret_key',
+                                     base_uri='http://localhost:9999/v2')
+
+
+def test_create_message(controller, monkeypatch):
+    """
+    Messages are posted as JSON to the messages resource, over the shared
+    session.
+    """
+    requests_made = []
+
+    def post(url, data=None, timeout=None):
+        requests_made.append((url, json.loads(data), timeout))
+        return FakeResponse(202, '{"data": {"id": "mdr1"}}')
+
+    monkeypatch.setattr(controller.session, 'post', post)
+    resp = controller.create_message(
+        Message(to='12223334444', from_='13334445555', content='hello'))
+    assert resp == {"data": {"id": "mdr1"}}
+    url, body, timeout = requests_made[0]
+    assert url == 'http://localhost:9999/v2/messages'
+    assert body == {'to': '12223334444', 'from': '13334445555',
+                    'body': 'hello'}
+    assert timeout == controller.timeout
+    assert controller.session.auth == ('access_key', 'secret_key')
+
+
+@pytest.mark.parametrize("status_code, reason", [
+    (401, "UNAUTHORIZED"),
+    (400, "HTTP Response Not OK"),
+    (500, "HTTP Response Not OK"),
+])
+def test_create_message_rejected(controller, monkeypatch, status_code,
+                                 reason):
+    """
+    A response outside of the 2xx range raises a TransportError carrying
+    the response body, as Flowroute's APIController does.
+    """
+    monkeypatch.setattr(
+        controller.session, 'post',
+        lambda url, data=None, timeout=None: FakeResponse(status_code,
+                                                          'error body'))
+    with pytest.raises(TransportError) as e:
+        controller.create_message(
+            Message(to='12223334444', from_='13334445555', content='hello'))
+    assert e.value.reason == reason
+    assert e.value.response_code == status_code
+    assert vars(e.value)['response_body'] == 'error body'
+
+
+def test_create_message_connection_error(controller, monkeypatch):
+    def post(url, data=None, timeout=None):
+        raise requests.ConnectionError("Connection refused")
+
+    monkeypatch.setattr(controller.session, 'post', post)
+    with pytest.raises(TransportError):
+        controller.create_message(
+            Message(to='12223334444', from_='13334445555', content='hello'))